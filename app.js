@@ -306,6 +306,9 @@ async function uploadBatchFiles(files) {
         // Store batch ID
         currentBatchId = data.batch_id;
         
+        // Wait for the queued documents to be processed
+        await waitForBatch(data.batch_id);
+        
         // Show batch results
         displayBatchResults(data.batch_id);
         
@@ -318,6 +321,26 @@ async function uploadBatchFiles(files) {
     }
 }
 
+async function waitForBatch(batchId) {
+    // Poll batch status until the background workers have finished
+    while (true) {
+        const response = await fetch(`${window.APP_CONFIG.apiUrl}/api/batch-status/${batchId}`);
+        if (!response.ok) {
+            throw new Error(`Failed to fetch batch status: ${response.statusText}`);
+        }
+        
+        const status = await response.json();
+        batchProgressFill.style.width = `${status.progress}%`;
+        batchProgressText.textContent = `Processing batch... ${status.processed_files + status.failed_files} of ${status.total_files} files`;
+        
+        if (status.status === 'completed' || status.status === 'failed') {
+            return status;
+        }
+        
+        await new Promise(resolve => setTimeout(resolve, 1000));
+    }
+}
+
 function simulateProgress(start, end, text) {
     let progress = start;
     const interval = setInterval(() => {
@@ -0,0 +1,52 @@
+import os
+from config import Config
+
+# Members smaller than this are exempt from the compression ratio check
+RATIO_CHECK_MIN_BYTES = 1024 * 1024
+
+class ArchiveLimitError(Exception):
+    """Raised when a ZIP archive exceeds the member count, size or compression ratio limits"""
+    pass
+
+def archive_members(archive, max_members=None, max_total_bytes=None, max_ratio=None):
+    """List a ZIP archive's file entries, checking the whole archive against the limits up front"""
+    max_members = Config.ZIP_MAX_MEMBERS if max_members is None else max_members
+    max_total_bytes = Config.ZIP_MAX_TOTAL_BYTES if max_total_bytes is None else max_total_bytes
+    max_ratio = Config.ZIP_MAX_RATIO if max_ratio is None else max_ratio
+
+    # Everything here comes from the central directory, so nothing is decompressed yet
+    members = [info for info in archive.infolist() if not info.is_dir()]
+    if len(members) > max_members:
+        raise ArchiveLimitError(f"Archive has {len(members)} files (limit {max_members})")
+
+    total_bytes = sum(info.file_size for info in members)
+    if total_bytes > max_total_bytes:
+        raise ArchiveLimitError(f"Archive expands to {total_bytes} bytes (limit {max_total_bytes})")
+
+    for info in members:
+        # Small members cannot do much damage, however well they compress
+        if info.file_size > RATIO_CHECK_MIN_BYTES and info.file_size > info.compress_size * max_ratio:
+            raise ArchiveLimitError(f"{info.filename} is compressed more than {max_ratio}:1")
+
+    return members
+
+def member_filename(name):
+    """Flatten a member's path inside the archive into one file name, e.g. 'march/r1.pdf' -> 'march_r1.pdf'"""
+    return '_'.join(part for part in name.replace('\\', '/').split('/') if part not in ('', '.', '..'))
+
+def copy_member(archive, info, destination, chunk_size=1024 * 1024):
+    """Stream one member into a file without ever writing more than its declared size"""
+    written = 0
+    try:
+        with archive.open(info) as src, open(destination, 'wb') as dst:
+            for chunk in iter(lambda: src.read(chunk_size), b''):
+                written += len(chunk)
+                if written > info.file_size:
+                    raise ArchiveLimitError(f"{info.filename} is larger than its declared size")
+                dst.write(chunk)
+    except BaseException:
+        # Never leave a partial file behind
+        if os.path.exists(destination):
+            os.remove(destination)
+        raise
+    return written
@@ -0,0 +1,480 @@
+"""Performance benchmarks for the InvoiceExtractor backend.
+
+Run from the backend directory, e.g. ``python benchmark.py ocr-pages --pages 30``.
+"""
+import argparse
+import difflib
+import json
+import os
+import sqlite3
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageDraw, ImageFont
+
+SAMPLE_LINES = [
+    'ACME OFFICE SUPPLY',
+    '1200 Market Street Springfield',
+    'Invoice # INV-20231',
+    'Date: 03/14/2024',
+    'Printer Paper 2 x $5.99 $11.98',
+    'Ballpoint Pens 4 x $1.25 $5.00',
+    'Subtotal: $16.98',
+    'Tax: $1.27',
+    'Total: $18.25',
+    'Thank you for your business',
+]
+
+def load_font(size):
+    """Load a TrueType font for rendering fixtures, falling back to PIL's default"""
+    for name in ['DejaVuSans.ttf', 'Arial.ttf', 'LiberationSans-Regular.ttf']:
+        try:
+            return ImageFont.truetype(name, size)
+        except OSError:
+            continue
+    return ImageFont.load_default()
+
+def render_page(lines, page_number, size=(1700, 2200)):
+    """Render a page of text as a white letter-size image at 200 DPI"""
+    image = Image.new('RGB', size, 'white')
+    draw = ImageDraw.Draw(image)
+    font = load_font(36)
+    y = 120
+    for line in lines + [f'Page {page_number}']:
+        draw.text((120, y), line, fill='black', font=font)
+        y += 70
+    return image
+
+def generate_scanned_pdf(path, pages):
+    """Write a multi-page image-only PDF fixture"""
+    images = [render_page(SAMPLE_LINES, i + 1) for i in range(pages)]
+    images[0].save(path, save_all=True, append_images=images[1:], resolution=200)
+
+def timed(func, *args, **kwargs):
+    """Call func and return (result, elapsed seconds)"""
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def bench_ocr_pages(args):
+    """Compare serial and parallel OCR of a scanned multi-page PDF"""
+    import pytesseract
+    from processing import pdf_to_images, ocr_pdf_pages
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        pdf_path = os.path.join(temp_dir, 'fixture.pdf')
+        generate_scanned_pdf(pdf_path, args.pages)
+
+        def serial():
+            # The original path: rasterize everything, then OCR page by page
+            text = ""
+            for image in pdf_to_images(pdf_path):
+                text += pytesseract.image_to_string(image) + "\n"
+            return text
+
+        _, serial_time = timed(serial)
+        print(f'serial:             {serial_time:8.2f}s  {args.pages / serial_time:6.2f} pages/s')
+
+        for workers in args.workers:
+            _, parallel_time = timed(ocr_pdf_pages, pdf_path, workers=workers, max_pages=0)
+            print(f'parallel ({workers:2d} procs): {parallel_time:8.2f}s  '
+                  f'{args.pages / parallel_time:6.2f} pages/s  {serial_time / parallel_time:5.2f}x')
+
+def bench_ocr_backends(args):
+    """Compare per-page OCR latency of the OCR backends"""
+    from processing import create_ocr_backend
+    pages = [render_page(SAMPLE_LINES, i + 1).convert('L') for i in range(args.pages)]
+    for name in args.backends:
+        backend = create_ocr_backend(name)
+        if backend.name != name:
+            print(f'{name:12s} not installed')
+            continue
+        # The first page includes loading the engine, which only the persistent backend avoids afterwards
+        _, first = timed(backend.image_to_string, pages[0])
+        _, rest = timed(lambda: [backend.image_to_string(page) for page in pages[1:]])
+        per_page = rest / max(len(pages) - 1, 1)
+        print(f'{name:12s} first page {first * 1000:7.1f}ms  then {per_page * 1000:7.1f}ms/page  '
+              f'{1 / per_page if per_page else 0:6.2f} pages/s')
+
+def render_phone_photo(seed):
+    """Render the sample page as a 12MP phone photo: tilted, unevenly lit and noisy"""
+    import random
+    from PIL import ImageChops
+    rng = random.Random(seed)
+    page = render_page(SAMPLE_LINES, 1).rotate(rng.uniform(-3, 3), expand=True, fillcolor='white')
+    photo = page.resize((3024, 4032), Image.BICUBIC)
+
+    # Light falls off towards one corner, as it does under a desk lamp
+    gradient = Image.linear_gradient('L').rotate(rng.choice([0, 90, 180, 270])).resize(photo.size)
+    shade = gradient.point(lambda value: 255 - value // 3)
+    noise = Image.effect_noise(photo.size, 24).point(lambda value: 255 - abs(value - 128) // 2)
+    shaded = ImageChops.multiply(ImageChops.multiply(photo, Image.merge('RGB', [shade] * 3)), Image.merge('RGB', [noise] * 3))
+    return shaded
+
+def text_accuracy(text):
+    """Similarity between OCR output and the sample lines, from 0 to 1"""
+    expected = ' '.join(' '.join(SAMPLE_LINES).split())
+    return difflib.SequenceMatcher(None, expected, ' '.join(text.split())).ratio()
+
+def bench_ocr_preprocess(args):
+    """Compare OCR latency and accuracy with different preprocessing pipelines on phone photos"""
+    from config import Config
+    from preprocessing import preprocess_image
+
+    pipelines = {
+        'none': [],
+        'default': Config.OCR_PREPROCESS_STAGES,
+        'threshold': ['exif_transpose', 'grayscale', 'resize', 'threshold', 'deskew'],
+    }
+    photos = [render_phone_photo(args.seed + i) for i in range(args.images)]
+    for name in args.pipelines:
+        timings = {}
+        ocr_time = 0.0
+        accuracy = 0.0
+        for photo in photos:
+            image = preprocess_image(photo, stages=pipelines[name], timings=timings)
+            if not args.no_ocr:
+                import pytesseract
+                text, elapsed = timed(pytesseract.image_to_string, image)
+                ocr_time += elapsed
+                accuracy += text_accuracy(text)
+        stages = '  '.join(f'{stage} {seconds * 1000 / len(photos):6.1f}ms' for stage, seconds in timings.items())
+        preprocess_time = sum(timings.values())
+        line = f'{name:10s} preprocess {preprocess_time * 1000 / len(photos):7.1f}ms/image'
+        if not args.no_ocr:
+            line += f'  ocr {ocr_time * 1000 / len(photos):7.1f}ms/image  accuracy {accuracy / len(photos):5.1%}'
+        print(line)
+        if stages:
+            print(f'           {stages}')
+
+def sample_document_rows():
+    """Build the rows a processed sample receipt persists: extractions, details, items, issues"""
+    from processing import process_text
+    results = process_text('\n'.join(SAMPLE_LINES))
+    extractions = []
+    for field_name, data in results.items():
+        if field_name == 'document_type':
+            continue
+        value = data.get('value')
+        if isinstance(value, (list, dict)):
+            value = json.dumps(value)
+        extractions.append((field_name, value, data.get('confidence', 0.0)))
+    details = ('ACME OFFICE SUPPLY', '1200 Market Street', 'credit', None, 16.98, 1.27, 18.25, None, None, 'Office Supplies')
+    items = [('Printer Paper', 2.0, 5.99, 11.98), ('Ballpoint Pens', 4.0, 1.25, 5.00)]
+    issues = [('MATH_ERROR', 'WARNING', 'Unusual tax rate: 7.48%'), ('LOW_CONFIDENCE', 'WARNING', 'Low confidence OCR extractions: vendor (0.50)')]
+    return extractions, details, items, issues
+
+def legacy_execute(db_path, sql, params):
+    """Run one statement the way database.py originally did: connect, execute, commit, close"""
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute(sql, params)
+    row_id = cursor.lastrowid
+    conn.commit()
+    conn.close()
+    return row_id
+
+def persist_document_legacy(db_path, rows):
+    """Persist one document with a fresh connection and commit per statement"""
+    extractions, details, items, issues = rows
+    doc_id = legacy_execute(db_path, "INSERT INTO documents (filename, document_type, batch_id) VALUES (?, ?, ?)", ('bench.pdf', 'unknown', None))
+    legacy_execute(db_path, "UPDATE documents SET status = ? WHERE id = ?", ('processing', doc_id))
+    legacy_execute(db_path, "UPDATE documents SET document_type = ? WHERE id = ?", ('receipt', doc_id))
+    for field_name, value, confidence in extractions:
+        legacy_execute(db_path, "INSERT INTO extractions (document_id, field_name, field_value, confidence_score) VALUES (?, ?, ?, ?)", (doc_id, field_name, value, confidence))
+    legacy_execute(db_path, '''INSERT INTO receipt_details 
+           (document_id, merchant_name, location, payment_method, tip_amount, 
+            subtotal, tax_amount, total_amount, cashier_name, transaction_time, category) 
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', (doc_id,) + details)
+    for item in items:
+        legacy_execute(db_path, "INSERT INTO receipt_items (document_id, item_name, quantity, unit_price, total_price) VALUES (?, ?, ?, ?, ?)", (doc_id,) + item)
+    for issue in issues:
+        legacy_execute(db_path, "INSERT INTO validation_issues (document_id, issue_type, severity, description) VALUES (?, ?, ?, ?)", (doc_id,) + issue)
+    legacy_execute(db_path, "UPDATE documents SET status = ? WHERE id = ?", ('completed', doc_id))
+
+def persist_document_pooled(db_path, rows):
+    """Persist one document through database.py's per-thread connections"""
+    import database
+    extractions, details, items, issues = rows
+    doc_id = database.insert_document('bench.pdf')
+    database.update_document_status(doc_id, 'processing')
+    database.update_document_type(doc_id, 'receipt')
+    for field_name, value, confidence in extractions:
+        database.insert_extraction(doc_id, field_name, value, confidence)
+    database.insert_receipt_details(doc_id, *details)
+    for item in items:
+        database.insert_receipt_item(doc_id, *item)
+    for issue in issues:
+        database.insert_validation_issue(doc_id, *issue)
+    database.update_document_status(doc_id, 'completed')
+
+def persist_document_bulk(db_path, rows):
+    """Persist one document's results in a single transaction"""
+    import database
+    extractions, details, items, issues = rows
+    doc_id = database.insert_document('bench.pdf')
+    database.update_document_status(doc_id, 'processing')
+    database.save_document_results(
+        doc_id, 'receipt', extractions,
+        dict(zip(database.RECEIPT_DETAIL_COLUMNS, details)),
+        [dict(zip(['item_name', 'quantity', 'unit_price', 'total_price'], item)) for item in items],
+        [dict(zip(['issue_type', 'severity', 'description'], issue)) for issue in issues],
+        status='completed'
+    )
+
+DB_WRITE_MODES = {
+    'legacy': persist_document_legacy,
+    'pooled': persist_document_pooled,
+    'bulk': persist_document_bulk,
+}
+
+def bench_db_writes(args):
+    """Measure documents persisted per second for each persistence strategy"""
+    from config import Config
+    import database
+    rows = sample_document_rows()
+
+    for mode in args.modes:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            Config.DATABASE_PATH = os.path.join(temp_dir, 'bench.db')
+            database.init_db()
+            database.close_db()
+            if mode == 'legacy':
+                # The original layer used SQLite's default rollback journal
+                conn = sqlite3.connect(Config.DATABASE_PATH)
+                conn.execute("PRAGMA journal_mode = DELETE")
+                conn.close()
+
+            persist = DB_WRITE_MODES[mode]
+            errors = []
+
+            def worker(_):
+                try:
+                    persist(Config.DATABASE_PATH, rows)
+                except sqlite3.OperationalError as e:
+                    errors.append(str(e))
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.threads) as executor:
+                list(executor.map(worker, range(args.documents)))
+            elapsed = time.perf_counter() - start
+            database.close_db()
+
+            print(f'{mode:8s} {args.documents} docs, {args.threads} threads: {elapsed:7.2f}s  '
+                  f'{args.documents / elapsed:8.1f} docs/s  {len(errors)} lock errors')
+
+MERCHANTS = ['CORNER CAFE', 'SHELL STATION', 'WHOLE FOODS MARKET', 'OFFICE DEPOT', 'HILTON HOTEL', 'CITY CINEMA']
+ITEM_NAMES = ['Latte', 'Bagel', 'Regular Fuel', 'Organic Apples', 'Printer Paper', 'Room Service', 'Popcorn', 'Notebook']
+
+def synthetic_document(rng):
+    """Generate the OCR text of a random receipt, invoice or online order confirmation"""
+    kind = rng.choice(['receipt', 'invoice', 'online'])
+    merchant = rng.choice(MERCHANTS)
+    date = f'{rng.randint(1, 12):02d}/{rng.randint(1, 28):02d}/{rng.randint(2019, 2024)}'
+    items = [(rng.choice(ITEM_NAMES), rng.randint(1, 4), round(rng.uniform(1, 40), 2)) for _ in range(rng.randint(1, 12))]
+    subtotal = sum(quantity * price for _, quantity, price in items)
+    tax = round(subtotal * 0.075, 2)
+
+    if kind == 'receipt':
+        lines = [merchant, f'{rng.randint(10, 9999)} Main Street Springfield', f'Date: {date} {rng.randint(1, 12)}:{rng.randint(0, 59):02d} PM',
+                 f'Cashier: {rng.choice(["Alice", "Bob", "Carmen"])}', f'Transaction # T{rng.randint(1000, 99999)}']
+        lines += [f'{name} {quantity} x ${price:.2f} ${quantity * price:.2f}' for name, quantity, price in items]
+        lines += [f'Subtotal: ${subtotal:.2f}', f'Tax: ${tax:.2f}', f'Total: ${subtotal + tax:.2f}',
+                  rng.choice(['VISA ****1234', 'CASH', 'DEBIT CARD']), 'Thank you for shopping with us']
+    elif kind == 'invoice':
+        lines = [merchant.title(), f'Invoice # INV-{rng.randint(1000, 99999)}', f'Invoice Date: {date}', 'Bill To: Example Corp',
+                 'Terms: Net 30', f'PO Number: {rng.randint(100, 999)}']
+        lines += [f'{name} consulting services ${quantity * price:.2f}' for name, quantity, price in items]
+        lines += [f'Tax: ${tax:.2f}', f'Amount Due: ${subtotal + tax:.2f}']
+    else:
+        lines = ['Order Confirmation', f'Sold by: {merchant.title()}', f'Order Number {rng.randint(100000, 999999)}', f'Order date {date}']
+        lines += [f'{name} ${quantity * price:.2f}' for name, quantity, price in items]
+        lines += [f'Shipping Address: {rng.randint(10, 999)} Elm Street Springfield IL', f'Total ${subtotal + tax:.2f}', 'Paid with PayPal']
+    return '\n'.join(lines)
+
+def load_module_from_path(name, path):
+    """Import a module from a file path, e.g. processing.py from an earlier revision"""
+    import importlib.util
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def shared_projection(fields, baseline_fields):
+    """Keep the fields, and the keys within each, that the baseline produced
+
+    Keys added since (such as a date's normalized form) are not counted as mismatches, while a
+    field or key the baseline had and the current code lost still is.
+    """
+    projected = {}
+    for name, baseline_value in baseline_fields.items():
+        value = fields.get(name)
+        if isinstance(value, dict) and isinstance(baseline_value, dict):
+            value = {key: value.get(key) for key in baseline_value}
+        projected[name] = value
+    return projected
+
+def bench_extract(args):
+    """Measure field extraction throughput per document on a synthetic corpus"""
+    import random
+    import processing
+    rng = random.Random(args.seed)
+    corpus = [synthetic_document(rng) for _ in range(args.documents)]
+
+    def run(process_text):
+        return [process_text(text) for text in corpus]
+
+    results, elapsed = timed(run, processing.process_text)
+    print(f'current:  {elapsed:7.3f}s  {args.documents / elapsed:9.1f} docs/s')
+
+    if args.baseline:
+        # Compare against (and check output parity with) an earlier processing.py
+        baseline = load_module_from_path('baseline_processing', args.baseline)
+
+        def baseline_process_text(text):
+            doc_type, confidence = baseline.classify_document(text)
+            if doc_type == 'receipt':
+                fields = baseline.process_receipt(text)
+            else:
+                fields = baseline.process_invoice(text)
+            fields['document_type'] = {'value': doc_type, 'confidence': confidence}
+            return fields
+
+        baseline_results, baseline_elapsed = timed(run, baseline_process_text)
+        mismatches = sum(1 for a, b in zip(results, baseline_results) if shared_projection(a, b) != b)
+        print(f'baseline: {baseline_elapsed:7.3f}s  {args.documents / baseline_elapsed:9.1f} docs/s  '
+              f'speedup {baseline_elapsed / elapsed:5.2f}x  {mismatches} mismatched documents')
+
+def bench_keywords(args):
+    """Compare per-keyword substring loops with the shared automaton as keyword tables grow"""
+    import random
+    from keywords import DEFAULT_KEYWORD_TABLES, KeywordIndex, merge_keyword_tables
+    rng = random.Random(args.seed)
+    corpus = [synthetic_document(rng).lower() for _ in range(args.documents)]
+
+    for merchants in args.merchants:
+        # Pad the expense categories with synthetic merchant names that never match
+        extra = {'expense_categories': {'Other Merchants': [f'merchant {i:05d} ltd' for i in range(merchants)]}}
+        tables = merge_keyword_tables(DEFAULT_KEYWORD_TABLES, extra)
+        keywords = [keyword for groups in tables.values() for group in groups.values() for keyword in group]
+        index, build_elapsed = timed(KeywordIndex, tables)
+
+        def loops():
+            return [{keyword for keyword in keywords if keyword in text} for text in corpus]
+
+        def automaton():
+            return [index.automaton.find(text) for text in corpus]
+
+        loop_hits, loop_elapsed = timed(loops)
+        automaton_hits, automaton_elapsed = timed(automaton)
+        mismatches = sum(1 for a, b in zip(loop_hits, automaton_hits) if a != b)
+        print(f'{len(keywords):6d} keywords  loops {args.documents / loop_elapsed:9.1f} docs/s  '
+              f'automaton {args.documents / automaton_elapsed:9.1f} docs/s  '
+              f'build {build_elapsed * 1000:7.1f}ms  {mismatches} mismatched documents')
+
+def buffered_batch_csv(batch_id):
+    """The original batch CSV export: render everything into memory, then send it"""
+    import csv
+    import io
+    from database import get_batch_documents, get_document_extractions
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(['Filename', 'Field Name', 'Field Value', 'Confidence Score'])
+    for doc in get_batch_documents(batch_id):
+        for extraction in get_document_extractions(doc['id']):
+            writer.writerow([doc['filename'], extraction['field_name'], extraction['field_value'], extraction['confidence_score']])
+    mem = io.BytesIO()
+    mem.write(output.getvalue().encode('utf-8'))
+    mem.seek(0)
+    return [mem.getvalue()]
+
+def bench_export(args):
+    """Measure time to first byte, total time and peak memory of buffered vs streaming batch exports"""
+    import tracemalloc
+    from config import Config
+    import database
+    from app import create_app
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        Config.DATABASE_PATH = os.path.join(temp_dir, 'bench.db')
+        database.init_db()
+        batch_id = database.insert_batch_job(1, args.documents)
+        fields = [(f'field_{i}', f'value {i} ' * 4, 0.9) for i in range(args.fields)]
+        with database.transaction():
+            for i in range(args.documents):
+                doc_id = database.insert_document(f'document_{i:06d}.pdf', 'invoice', batch_id)
+                database.save_document_results(doc_id, 'invoice', fields, status='completed')
+        client = create_app().test_client()
+
+        def streamed(format_type):
+            response = client.post(f'/api/download-batch/{batch_id}', json={'format': format_type}, buffered=False)
+            return response.response
+
+        modes = [('buffered csv', lambda: buffered_batch_csv(batch_id)),
+                 ('stream csv', lambda: streamed('csv')),
+                 ('stream ndjson', lambda: streamed('ndjson'))]
+        for name, start_export in modes:
+            tracemalloc.start()
+            start = time.perf_counter()
+            first_byte = None
+            size = 0
+            for chunk in start_export():
+                if chunk and first_byte is None:
+                    first_byte = time.perf_counter() - start
+                size += len(chunk)
+            total = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f'{name:14s} {args.documents * args.fields} rows  TTFB {first_byte * 1000:8.1f}ms  '
+                  f'total {total:6.2f}s  peak {peak / 1024 / 1024:7.1f}MB  {size / 1024 / 1024:6.1f}MB sent')
+        database.close_db()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    ocr_pages = subparsers.add_parser('ocr-pages', help='serial vs parallel page OCR')
+    ocr_pages.add_argument('--pages', type=int, default=30)
+    ocr_pages.add_argument('--workers', type=int, nargs='+', default=[2, 4, os.cpu_count() or 4])
+    ocr_pages.set_defaults(func=bench_ocr_pages)
+
+    ocr_backends = subparsers.add_parser('ocr-backends', help='per-page latency of each OCR backend')
+    ocr_backends.add_argument('--pages', type=int, default=20)
+    ocr_backends.add_argument('--backends', nargs='+', choices=['pytesseract', 'tesserocr'], default=['pytesseract', 'tesserocr'])
+    ocr_backends.set_defaults(func=bench_ocr_backends)
+
+    ocr_preprocess = subparsers.add_parser('ocr-preprocess', help='OCR latency and accuracy by preprocessing pipeline')
+    ocr_preprocess.add_argument('--images', type=int, default=5)
+    ocr_preprocess.add_argument('--seed', type=int, default=7)
+    ocr_preprocess.add_argument('--pipelines', nargs='+', choices=['none', 'default', 'threshold'], default=['none', 'default', 'threshold'])
+    ocr_preprocess.add_argument('--no-ocr', action='store_true', help='only time preprocessing (no tesseract needed)')
+    ocr_preprocess.set_defaults(func=bench_ocr_preprocess)
+
+    db_writes = subparsers.add_parser('db-writes', help='documents persisted per second')
+    db_writes.add_argument('--documents', type=int, default=500)
+    db_writes.add_argument('--threads', type=int, default=4)
+    db_writes.add_argument('--modes', nargs='+', choices=sorted(DB_WRITE_MODES), default=['legacy', 'pooled', 'bulk'])
+    db_writes.set_defaults(func=bench_db_writes)
+
+    extract = subparsers.add_parser('extract', help='field extraction throughput')
+    extract.add_argument('--documents', type=int, default=2000)
+    extract.add_argument('--seed', type=int, default=7)
+    extract.add_argument('--baseline', help='path to an earlier processing.py to compare against')
+    extract.set_defaults(func=bench_extract)
+
+    keywords = subparsers.add_parser('keywords', help='keyword matching throughput as tables grow')
+    keywords.add_argument('--documents', type=int, default=2000)
+    keywords.add_argument('--seed', type=int, default=7)
+    keywords.add_argument('--merchants', type=int, nargs='+', default=[0, 100, 1000, 5000])
+    keywords.set_defaults(func=bench_keywords)
+
+    export = subparsers.add_parser('export', help='batch export time to first byte and memory')
+    export.add_argument('--documents', type=int, default=5000)
+    export.add_argument('--fields', type=int, default=20)
+    export.set_defaults(func=bench_export)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+import hashlib
+import json
+import os
+import threading
+from config import Config
+from database import increment_cache_counters, get_cache_counters
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def hash_file(file_path, chunk_size=1024 * 1024):
+    """Get the SHA-256 hex digest of a file's contents"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class ExtractionCache:
+    """Content-addressed on-disk cache of extracted text and processing results"""
+
+    def __init__(self, directory, max_bytes, version):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.version = version
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.total_bytes = sum(os.path.getsize(path) for path, _ in self._entries())
+
+    def key_for_file(self, file_path):
+        """Build the cache key for a file: its content hash plus the extractor version"""
+        return f"{hash_file(file_path)}-v{self.version}"
+
+    def _path(self, key):
+        # Shard by hash prefix so no single directory grows too large
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def _entries(self):
+        """List (path, mtime) for every cache entry"""
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith('.json'):
+                    path = os.path.join(root, name)
+                    try:
+                        entries.append((path, os.path.getmtime(path)))
+                    except OSError:
+                        continue
+        return entries
+
+    def get(self, key):
+        """Get a cached entry, or None on a miss"""
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                entry = json.load(file)
+            # Touch the entry so eviction treats it as recently used
+            os.utime(path)
+        except (OSError, ValueError):
+            increment_cache_counters(misses=1)
+            return None
+
+        increment_cache_counters(hits=1, seconds_saved=entry.get('elapsed', 0.0))
+        return entry
+
+    def put(self, key, entry):
+        """Store an entry, evicting least recently used entries if over the size limit"""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temp file and rename so readers never see a partial entry
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump(entry, file)
+        size = os.path.getsize(temp_path)
+        os.replace(temp_path, path)
+
+        increment_cache_counters(stores=1)
+        with self.lock:
+            self.total_bytes += size
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Delete the least recently used entries until the cache is back under 90% of its limit"""
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        sizes = {}
+        for path, _ in entries:
+            try:
+                sizes[path] = os.path.getsize(path)
+            except OSError:
+                sizes[path] = 0
+
+        # Recount from disk since other processes share the directory
+        self.total_bytes = sum(sizes.values())
+        target = self.max_bytes * 0.9
+        evicted = 0
+        for path, _ in entries:
+            if self.total_bytes <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.total_bytes -= sizes[path]
+            evicted += 1
+
+        if evicted:
+            increment_cache_counters(evictions=evicted)
+
+    def clear(self):
+        """Delete every cache entry"""
+        with self.lock:
+            for path, _ in self._entries():
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+            self.total_bytes = 0
+
+    def stats(self):
+        """Get hit/miss counters and current size"""
+        counters = get_cache_counters()
+        lookups = counters['hits'] + counters['misses']
+        counters['hit_rate'] = counters['hits'] / lookups if lookups else 0.0
+        counters['entries'] = len(self._entries())
+        counters['size_bytes'] = self.total_bytes
+        counters['max_bytes'] = self.max_bytes
+        return counters
+
+def get_extraction_cache(version):
+    """Get the shared extraction cache, creating it on first use"""
+    global _cache
+    with _cache_lock:
+        if _cache is None or _cache.version != version:
+            _cache = ExtractionCache(
+                Config.EXTRACTION_CACHE_DIR, Config.EXTRACTION_CACHE_MAX_BYTES, version
+            )
+        return _cache
@@ -0,0 +1,195 @@
+import hashlib
+import os
+import uuid
+import zipfile
+from werkzeug.utils import secure_filename
+from config import Config
+from database import (
+    insert_document, insert_batch_job, finalize_batch_total, insert_upload_session,
+    get_upload_session, advance_upload_session, close_upload_session, set_upload_session_batch,
+    expire_upload_sessions
+)
+from jobs import get_job_queue
+from archives import archive_members, member_filename, copy_member
+
+# Size of the pieces a chunk is copied to disk in, so no chunk is ever held in memory whole
+COPY_BUFFER_SIZE = 1024 * 1024
+
+class UploadError(Exception):
+    """Raised when a chunked upload request cannot be applied, carrying the HTTP status to answer with"""
+
+    def __init__(self, message, status=400, session=None):
+        super().__init__(message)
+        self.status = status
+        self.session = session
+
+def allowed_file(filename):
+    """Check if file extension is allowed"""
+    return '.' in filename and \
+           filename.rsplit('.', 1)[1].lower() in Config.ALLOWED_EXTENSIONS
+
+def part_path(upload_id):
+    """Get the path a session's chunks are assembled in"""
+    return os.path.join(Config.UPLOAD_PARTS_FOLDER, f"{upload_id}.part")
+
+def session_status(session):
+    """Describe a session for API responses"""
+    return {
+        'upload_id': session['id'],
+        'filename': session['filename'],
+        'total_size': session['total_size'],
+        'received_bytes': session['received_bytes'],
+        'status': session['status'],
+        'batch_id': session['batch_id'],
+        'chunk_size': Config.UPLOAD_CHUNK_SIZE
+    }
+
+def get_open_session(upload_id):
+    """Get a session that can still take chunks"""
+    session = get_upload_session(upload_id)
+    if session is None:
+        raise UploadError('Upload not found', 404)
+    if session['status'] != 'open':
+        raise UploadError(f"Upload is already {session['status']}", 409, session)
+    return session
+
+def remove_part(upload_id):
+    """Delete a session's part file if it is still on disk"""
+    if os.path.exists(part_path(upload_id)):
+        os.remove(part_path(upload_id))
+
+def sweep_expired_uploads():
+    """Expire sessions left idle past UPLOAD_SESSION_TTL_SECONDS and delete their part files, returning their ids"""
+    upload_ids = expire_upload_sessions(Config.UPLOAD_SESSION_TTL_SECONDS)
+    for upload_id in upload_ids:
+        remove_part(upload_id)
+    return upload_ids
+
+def begin_upload(filename, total_size=None, sha256=None):
+    """Open a chunked upload session and its empty part file"""
+    if not filename or not allowed_file(filename):
+        raise UploadError('File type not allowed')
+    if total_size is not None and (total_size < 0 or total_size > Config.UPLOAD_MAX_BYTES):
+        raise UploadError(f'Uploads are limited to {Config.UPLOAD_MAX_BYTES} bytes', 413)
+
+    # Clients that give up mid-upload never abort, so their sessions are cleared here
+    sweep_expired_uploads()
+
+    upload_id = uuid.uuid4().hex
+    os.makedirs(Config.UPLOAD_PARTS_FOLDER, exist_ok=True)
+    open(part_path(upload_id), 'wb').close()
+    insert_upload_session(upload_id, filename, total_size, sha256.lower() if sha256 else None)
+    return get_upload_session(upload_id)
+
+def append_chunk(upload_id, offset, stream):
+    """Write one chunk from a request stream at offset, which must be where the upload left off"""
+    session = get_open_session(upload_id)
+    if offset != session['received_bytes']:
+        # Tells a client resuming after a dropped connection where to continue from
+        raise UploadError(f"Expected offset {session['received_bytes']}", 409, session)
+
+    limit = Config.UPLOAD_MAX_BYTES if session['total_size'] is None else session['total_size']
+    position = offset
+    with open(part_path(upload_id), 'r+b') as part:
+        # A retried chunk overwrites whatever a failed attempt left past the offset
+        part.seek(offset)
+        for chunk in iter(lambda: stream.read(COPY_BUFFER_SIZE), b''):
+            position += len(chunk)
+            if position > limit:
+                part.truncate(offset)
+                raise UploadError(f'Upload is larger than {limit} bytes', 413, session)
+            part.write(chunk)
+        part.truncate()
+
+    if not advance_upload_session(upload_id, offset, position):
+        raise UploadError('Another chunk was written at this offset', 409, get_upload_session(upload_id))
+    return get_upload_session(upload_id)
+
+def file_sha256(path):
+    """Hash a file without reading it into memory"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(COPY_BUFFER_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def queue_document(queue, file_path, filename, batch_id):
+    """Record a saved file as a batch document and queue it for processing"""
+    doc_id = insert_document(filename, batch_id=batch_id)
+    queue.submit('process_batch_document', file_path=file_path,
+                 filename=filename, doc_id=doc_id, batch_id=batch_id)
+    return doc_id
+
+def queue_archive(archive, batch_id, queue):
+    """Stream each document in a ZIP archive into the upload folder and queue it, returning (queued, failed, document_ids)"""
+    queued_count = 0
+    failed_count = 0
+    document_ids = []
+    for info in archive_members(archive):
+        member_name = member_filename(info.filename)
+
+        # Check if file type is allowed
+        if not allowed_file(member_name) or member_name.lower().endswith('.zip'):
+            failed_count += 1
+            continue
+
+        try:
+            # Generate a unique filename to avoid conflicts
+            unique_filename = f"{batch_id}_{secure_filename(member_name)}"
+            final_path = os.path.join(Config.UPLOAD_FOLDER, unique_filename)
+            copy_member(archive, info, final_path)
+
+            # Queue the member right away so workers start before the archive is fully read
+            document_ids.append(queue_document(queue, final_path, unique_filename, batch_id))
+            queued_count += 1
+        except Exception as e:
+            failed_count += 1
+            continue
+    return queued_count, failed_count, document_ids
+
+def commit_upload(upload_id, user_id=1):
+    """Check an assembled upload and hand it to the batch pipeline, returning (batch_id, queued, failed, document_ids)"""
+    session = get_open_session(upload_id)
+    path = part_path(upload_id)
+    if session['total_size'] is not None and session['received_bytes'] != session['total_size']:
+        raise UploadError(f"Received {session['received_bytes']} of {session['total_size']} bytes", 409, session)
+    if session['sha256'] and file_sha256(path) != session['sha256']:
+        raise UploadError('Checksum does not match the uploaded data', 422, session)
+
+    # Only one commit can claim the session, even if a client retries it
+    if not close_upload_session(upload_id, 'committed'):
+        raise UploadError('Upload is already closed', 409, get_upload_session(upload_id))
+
+    batch_id = insert_batch_job(user_id, 1)
+    queue = get_job_queue()
+    filename = session['filename']
+    try:
+        if filename.lower().endswith('.zip'):
+            with zipfile.ZipFile(path) as archive:
+                queued_count, failed_count, document_ids = queue_archive(archive, batch_id, queue)
+            os.remove(path)
+        else:
+            # The part file already sits on the upload volume, so it is moved rather than copied
+            unique_filename = f"{batch_id}_{secure_filename(filename)}"
+            final_path = os.path.join(Config.UPLOAD_FOLDER, unique_filename)
+            os.replace(path, final_path)
+            queued_count, failed_count = 1, 0
+            document_ids = [queue_document(queue, final_path, unique_filename, batch_id)]
+    except Exception as e:
+        if os.path.exists(path):
+            os.remove(path)
+        finalize_batch_total(batch_id, 1, 1)
+        set_upload_session_batch(upload_id, batch_id)
+        raise Exception(f"Failed to queue upload: {str(e)}")
+
+    # All files are queued, so the batch can now complete as workers finish
+    finalize_batch_total(batch_id, queued_count + failed_count, failed_count)
+    set_upload_session_batch(upload_id, batch_id)
+    return batch_id, queued_count, failed_count, document_ids
+
+def abort_upload(upload_id):
+    """Discard an open upload and its part file"""
+    get_open_session(upload_id)
+    if not close_upload_session(upload_id, 'aborted'):
+        raise UploadError('Upload is already closed', 409, get_upload_session(upload_id))
+    remove_part(upload_id)
@@ -3,12 +3,93 @@ import os
 class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'dev-secret-key-for-invoice-extractor'
     DATABASE_PATH = os.path.join(os.path.dirname(__file__), 'invoice_extractor.db')
+    DB_BUSY_TIMEOUT = 30000  # Milliseconds to wait for a locked database before failing
+    DB_SYNCHRONOUS = 'NORMAL'  # With WAL this never corrupts the database, but a power loss can drop the latest commits; FULL makes every commit durable
+    DB_CACHE_SIZE_KB = 16384  # Page cache per connection
+    DB_CACHED_STATEMENTS = 256  # Prepared statements kept per connection
     UPLOAD_FOLDER = os.path.join(os.path.dirname(__file__), 'uploads')
     MAX_CONTENT_LENGTH = 50 * 1024 * 1024  # 50MB max file size (for batch uploads)
     ALLOWED_EXTENSIONS = {'pdf', 'png', 'jpg', 'jpeg', 'zip'}
     BATCH_MAX_FILES = 20  # Maximum files per batch
     BATCH_MAX_SIZE = 50 * 1024 * 1024  # 50MB total size limit for batch
     
+    # Limits applied to every ZIP archive before any member is extracted
+    ZIP_MAX_MEMBERS = int(os.environ.get('ZIP_MAX_MEMBERS', 10000))
+    ZIP_MAX_TOTAL_BYTES = int(os.environ.get('ZIP_MAX_TOTAL_BYTES', 2 * 1024 * 1024 * 1024))  # 2GB uncompressed
+    ZIP_MAX_RATIO = 100  # Members compressed more than this are treated as zip bombs
+    
+    # Chunked uploads (/api/uploads) are assembled on disk, so only each chunk counts against MAX_CONTENT_LENGTH
+    UPLOAD_PARTS_FOLDER = os.path.join(UPLOAD_FOLDER, 'parts')  # Kept on the upload volume so commits are a rename
+    UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # Chunk size suggested to clients
+    UPLOAD_MAX_BYTES = int(os.environ.get('UPLOAD_MAX_BYTES', 10 * 1024 * 1024 * 1024))  # 10GB per upload
+    UPLOAD_SESSION_TTL_SECONDS = int(os.environ.get('UPLOAD_SESSION_TTL_SECONDS', 24 * 60 * 60))  # Open sessions idle this long expire
+    
+    # Background job queue for batch processing: thread, process, sqlite or inline
+    JOB_QUEUE_BACKEND = os.environ.get('JOB_QUEUE_BACKEND', 'thread')
+    JOB_QUEUE_WORKERS = int(os.environ.get('JOB_QUEUE_WORKERS', os.cpu_count() or 4))
+    JOB_QUEUE_POLL_INTERVAL = 1.0  # Seconds an idle sqlite queue worker waits before polling again
+    JOB_QUEUE_LEASE_SECONDS = 60  # A running sqlite queue job is taken over if its worker stops renewing it this long
+    JOB_QUEUE_MAX_ATTEMPTS = 3  # A job whose worker died this many times is failed instead of taken over again
+    
+    # Page-level OCR for scanned PDFs
+    OCR_WORKERS = int(os.environ.get('OCR_WORKERS', os.cpu_count() or 4))  # Processes OCR'ing pages in parallel
+    OCR_MAX_PAGES = int(os.environ.get('OCR_MAX_PAGES', 100))  # Per-document page budget (0 for no limit)
+    PDF_MIN_PAGE_TEXT_CHARS = 25  # Pages with less text-layer text than this are OCR'd
+    PDF_MIN_PAGE_ALNUM_RATIO = 0.5  # Text layers that are mostly symbols are treated as unusable
+    PDF_RASTER_DPI = int(os.environ.get('PDF_RASTER_DPI', 200))  # Resolution scanned pages are rendered at
+    PDF_RASTER_GRAYSCALE = True  # Render pages as 8-bit grayscale (a third of the memory of RGB)
+    
+    # OCR engine: tesserocr keeps Tesseract loaded in each worker, pytesseract runs the tesseract
+    # command per image; auto uses tesserocr when it is installed
+    OCR_BACKEND = os.environ.get('OCR_BACKEND', 'auto')
+    OCR_LANGUAGE = os.environ.get('OCR_LANGUAGE', 'eng')
+    
+    # Image cleanup before OCR, run in order: any of exif_transpose, grayscale, resize, threshold, deskew
+    OCR_PREPROCESS_STAGES = [
+        stage.strip() for stage in os.environ.get('OCR_PREPROCESS_STAGES', 'exif_transpose,grayscale,resize,deskew').split(',')
+        if stage.strip()
+    ]
+    OCR_TARGET_DPI = int(os.environ.get('OCR_TARGET_DPI', 300))  # Larger images are downscaled to this resolution
+    OCR_ASSUMED_PAGE_INCHES = 11  # Long side of a photo without a real DPI, used to estimate its resolution
+    OCR_THRESHOLD_WINDOW = 31  # Pixels around each pixel the adaptive threshold compares against
+    OCR_THRESHOLD_OFFSET = 20  # How much darker than its surroundings a pixel must be to count as ink
+    OCR_DESKEW_MAX_ANGLE = 5  # Degrees of skew deskew searches either way
+    
+    # Region-of-interest OCR: recognize the header and footer bands first and OCR whole pages only
+    # when a required field is missing or weak (line items in the middle of the page are then skipped)
+    OCR_ROI_ENABLED = os.environ.get('OCR_ROI_ENABLED', '0') == '1'
+    OCR_ROI_HEADER_FRACTION = 0.25  # Top of the page holding the merchant, invoice number and date
+    OCR_ROI_FOOTER_FRACTION = 0.3  # Bottom of the page holding the totals and tax
+    OCR_ROI_MIN_CONFIDENCE = 0.6
+    OCR_ROI_REQUIRED_FIELDS = {
+        'invoice': ['invoice_number', 'date', 'vendor', 'total'],
+        'receipt': ['merchant_name', 'date', 'total'],
+    }
+    
+    # Duplicate detection: documents sharing vendor, invoice number, amount and date, or whose
+    # texts share at least this fraction of their word shingles (estimated by MinHash)
+    DUPLICATE_TEXT_MIN_SIMILARITY = 0.85
+    DUPLICATE_CANDIDATE_LIMIT = 50  # Matches fetched per indexed lookup
+    
+    # Content-addressed cache of extraction results for re-uploaded documents
+    EXTRACTION_CACHE_ENABLED = os.environ.get('EXTRACTION_CACHE_ENABLED', '1') == '1'
+    EXTRACTION_CACHE_DIR = os.path.join(os.path.dirname(__file__), 'cache')
+    EXTRACTION_CACHE_MAX_BYTES = int(os.environ.get('EXTRACTION_CACHE_MAX_BYTES', 512 * 1024 * 1024))  # 512MB
+    
+    # Command-line bulk ingester (ingest.py)
+    INGEST_WORKERS = int(os.environ.get('INGEST_WORKERS', os.cpu_count() or 4))  # Processes running OCR and extraction
+    INGEST_COMMIT_EVERY = 50  # Documents stored per transaction
+    
+    # Bulk revalidation (revalidate.py and POST /api/revalidate)
+    REVALIDATE_WORKERS = int(os.environ.get('REVALIDATE_WORKERS', os.cpu_count() or 4))  # Processes running the rules
+    REVALIDATE_CHUNK_SIZE = 200  # Documents read and written per transaction
+    
+    # Streaming exports fetch this many rows per round trip, so memory stays flat for any batch size
+    EXPORT_FETCH_SIZE = 500
+    
+    # JSON file of extra keywords ({table: {group: [keywords]}}) merged into the built-in tables
+    KEYWORD_TABLES_PATH = os.environ.get('KEYWORD_TABLES_PATH', os.path.join(os.path.dirname(__file__), 'keywords.json'))
+    
     # Create upload folder if it doesn't exist
     if not os.path.exists(UPLOAD_FOLDER):
         os.makedirs(UPLOAD_FOLDER)
\ No newline at end of file
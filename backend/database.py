@@ -1,192 +1,473 @@
 import sqlite3
 import os
+import json
+import itertools
+import threading
+from contextlib import contextmanager
 from config import Config
 
-def get_db():
-    """Get database connection"""
-    conn = sqlite3.connect(Config.DATABASE_PATH)
+# Each thread keeps one open connection instead of reconnecting for every statement
+_local = threading.local()
+
+def connect_db(path=None):
+    """Open a new database connection tuned for concurrent access"""
+    conn = sqlite3.connect(
+        path or Config.DATABASE_PATH,
+        timeout=Config.DB_BUSY_TIMEOUT / 1000,
+        cached_statements=Config.DB_CACHED_STATEMENTS
+    )
     conn.row_factory = sqlite3.Row
+    
+    # WAL lets readers run alongside a writer, and NORMAL sync only fsyncs at checkpoints
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute(f"PRAGMA synchronous = {Config.DB_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA busy_timeout = {Config.DB_BUSY_TIMEOUT}")
+    conn.execute(f"PRAGMA cache_size = -{Config.DB_CACHE_SIZE_KB}")
+    conn.execute("PRAGMA temp_store = MEMORY")
     return conn
 
+def get_db():
+    """Get the database connection for the current thread"""
+    # Connections are not shared across a fork or reused after the database path changes
+    key = (os.getpid(), Config.DATABASE_PATH)
+    if getattr(_local, 'key', None) != key:
+        _local.conn = connect_db()
+        _local.key = key
+        _local.depth = 0
+    return _local.conn
+
+def close_db():
+    """Close the current thread's database connection"""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.key[0] == os.getpid():
+        conn.close()
+    _local.conn = None
+    _local.key = None
+    _local.depth = 0
+
+@contextmanager
+def transaction():
+    """Run several statements as one write transaction on the thread's connection"""
+    conn = get_db()
+    depth = _local.depth
+    if depth == 0:
+        # Take the write lock immediately so the transaction cannot fail to upgrade later
+        conn.execute("BEGIN IMMEDIATE")
+    else:
+        # Nested blocks get a savepoint, so a failing inner block is undone on its own
+        conn.execute(f"SAVEPOINT nested_{depth}")
+    _local.depth += 1
+    try:
+        yield conn.cursor()
+        if depth == 0:
+            conn.commit()
+        else:
+            conn.execute(f"RELEASE nested_{depth}")
+    except BaseException:
+        if depth == 0:
+            conn.rollback()
+        else:
+            conn.execute(f"ROLLBACK TO nested_{depth}")
+            conn.execute(f"RELEASE nested_{depth}")
+        raise
+    finally:
+        _local.depth -= 1
+
 def init_db():
     """Initialize the database with required tables"""
-    conn = get_db()
-    cursor = conn.cursor()
+    # The write lock serializes processes starting up together, so each sees what the others created
+    with transaction() as cursor:
+        # Create documents table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS documents (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                filename TEXT NOT NULL,
+                upload_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                status TEXT DEFAULT 'uploaded',
+                document_type TEXT DEFAULT 'unknown',  -- 'invoice' or 'receipt'
+                batch_id INTEGER DEFAULT NULL,  -- Link to batch_jobs table
+                FOREIGN KEY (batch_id) REFERENCES batch_jobs (id)
+            )
+        ''')
     
-    # Create documents table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS documents (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            filename TEXT NOT NULL,
-            upload_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            status TEXT DEFAULT 'uploaded',
-            document_type TEXT DEFAULT 'unknown',  -- 'invoice' or 'receipt'
-            batch_id INTEGER DEFAULT NULL,  -- Link to batch_jobs table
-            FOREIGN KEY (batch_id) REFERENCES batch_jobs (id)
-        )
-    ''')
+        # Create extractions table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS extractions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                document_id INTEGER NOT NULL,
+                field_name TEXT NOT NULL,
+                field_value TEXT,
+                confidence_score REAL,
+                FOREIGN KEY (document_id) REFERENCES documents (id)
+            )
+        ''')
     
-    # Create extractions table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS extractions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            document_id INTEGER NOT NULL,
-            field_name TEXT NOT NULL,
-            field_value TEXT,
-            confidence_score REAL,
-            FOREIGN KEY (document_id) REFERENCES documents (id)
-        )
-    ''')
+        # Create corrections table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS corrections (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                extraction_id INTEGER NOT NULL,
+                original_value TEXT,
+                corrected_value TEXT,
+                correction_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (extraction_id) REFERENCES extractions (id)
+            )
+        ''')
     
-    # Create corrections table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS corrections (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            extraction_id INTEGER NOT NULL,
-            original_value TEXT,
-            corrected_value TEXT,
-            correction_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (extraction_id) REFERENCES extractions (id)
-        )
-    ''')
+        # Create users table for simple authentication
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT UNIQUE NOT NULL,
+                password_hash TEXT NOT NULL
+            )
+        ''')
     
-    # Create users table for simple authentication
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL
-        )
-    ''')
+        # Create receipt_items table for receipt-specific line items
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS receipt_items (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                document_id INTEGER NOT NULL,
+                item_name TEXT,
+                quantity REAL,
+                unit_price REAL,
+                total_price REAL,
+                FOREIGN KEY (document_id) REFERENCES documents (id)
+            )
+        ''')
     
-    # Create receipt_items table for receipt-specific line items
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS receipt_items (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            document_id INTEGER NOT NULL,
-            item_name TEXT,
-            quantity REAL,
-            unit_price REAL,
-            total_price REAL,
-            FOREIGN KEY (document_id) REFERENCES documents (id)
-        )
-    ''')
+        # Create receipt_details table for receipt-specific details
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS receipt_details (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                document_id INTEGER NOT NULL,
+                merchant_name TEXT,
+                location TEXT,
+                payment_method TEXT,
+                tip_amount REAL,
+                subtotal REAL,
+                tax_amount REAL,
+                total_amount REAL,
+                cashier_name TEXT,
+                transaction_time TEXT,
+                category TEXT,
+                FOREIGN KEY (document_id) REFERENCES documents (id)
+            )
+        ''')
     
-    # Create receipt_details table for receipt-specific details
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS receipt_details (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            document_id INTEGER NOT NULL,
-            merchant_name TEXT,
-            location TEXT,
-            payment_method TEXT,
-            tip_amount REAL,
-            subtotal REAL,
-            tax_amount REAL,
-            total_amount REAL,
-            cashier_name TEXT,
-            transaction_time TEXT,
-            category TEXT,
-            FOREIGN KEY (document_id) REFERENCES documents (id)
-        )
-    ''')
+        # Create batch_jobs table for batch processing
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS batch_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                status TEXT DEFAULT 'pending',  -- pending, processing, completed, failed
+                total_files INTEGER DEFAULT 0,
+                processed_files INTEGER DEFAULT 0,
+                failed_files INTEGER DEFAULT 0,
+                created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                completed_date TIMESTAMP NULL,
+                FOREIGN KEY (user_id) REFERENCES users (id)
+            )
+        ''')
     
-    # Create batch_jobs table for batch processing
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS batch_jobs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            status TEXT DEFAULT 'pending',  -- pending, processing, completed, failed
-            total_files INTEGER DEFAULT 0,
-            processed_files INTEGER DEFAULT 0,
-            failed_files INTEGER DEFAULT 0,
-            created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            completed_date TIMESTAMP NULL,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
+        # Create validation_issues table for validation results
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS validation_issues (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                document_id INTEGER NOT NULL,
+                issue_type TEXT NOT NULL,  -- MATH_ERROR, DUPLICATE, SUSPICIOUS_AMOUNT, MISSING_DATA, LOW_CONFIDENCE
+                severity TEXT NOT NULL,    -- ERROR, WARNING, INFO
+                description TEXT NOT NULL,
+                acknowledged BOOLEAN DEFAULT FALSE,
+                created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (document_id) REFERENCES documents (id)
+            )
+        ''')
     
-    # Create validation_issues table for validation results
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS validation_issues (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            document_id INTEGER NOT NULL,
-            issue_type TEXT NOT NULL,  -- MATH_ERROR, DUPLICATE, SUSPICIOUS_AMOUNT, MISSING_DATA, LOW_CONFIDENCE
-            severity TEXT NOT NULL,    -- ERROR, WARNING, INFO
-            description TEXT NOT NULL,
-            acknowledged BOOLEAN DEFAULT FALSE,
+        # Create job_queue table for the durable background job queue
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS job_queue (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                task TEXT NOT NULL,
+                payload TEXT NOT NULL,  -- JSON encoded keyword arguments
+                status TEXT DEFAULT 'queued',  -- queued, running, completed, failed
+                attempts INTEGER DEFAULT 0,
+                error TEXT,
+                created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                started_date TIMESTAMP NULL,
+                finished_date TIMESTAMP NULL
+            )
+        ''')
+    
+        # Create extraction_cache_stats table for extraction cache counters shared by all workers
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS extraction_cache_stats (
+                name TEXT PRIMARY KEY,  -- hits, misses, stores, evictions, seconds_saved
+                value REAL DEFAULT 0
+            )
+        ''')
+    
+        # Create a default admin user if none exists
+        cursor.execute("SELECT COUNT(*) FROM users")
+        if cursor.fetchone()[0] == 0:
+            # Default user: admin / password
+            import hashlib
+            password_hash = hashlib.sha256('password'.encode()).hexdigest()
+            cursor.execute(
+                "INSERT INTO users (username, password_hash) VALUES (?, ?)",
+                ('admin', password_hash)
+            )
+    
+    # Bring existing databases up to the current schema
+    migrate_db()
+
+def _backfill_fingerprints(cursor):
+    """Give documents processed before fingerprinting their exact keys (their text was not kept)"""
+    from duplicates import exact_key
+    cursor.execute(
+        '''SELECT e.document_id, e.field_name, e.field_value FROM extractions e
+           JOIN documents d ON d.id = e.document_id
+           WHERE d.status = 'completed' ORDER BY e.document_id'''
+    )
+    fingerprints = []
+    for document_id, rows in itertools.groupby(cursor.fetchall(), key=lambda row: row[0]):
+        key, _ = exact_key({field_name: {'value': field_value} for _, field_name, field_value in rows})
+        fingerprints.append((document_id, key))
+    cursor.executemany(
+        "INSERT OR IGNORE INTO document_fingerprints (document_id, exact_key) VALUES (?, ?)",
+        fingerprints
+    )
+
+def _collapse_repeated_issues(cursor):
+    """Fingerprint existing issues by rule and merge the copies earlier validation runs appended
+    
+    Each document keeps its first row for an issue, with the latest copy's severity and
+    description, acknowledged if any copy was and open if any copy is.
+    """
+    from validation import stored_issue_fingerprint
+    cursor.execute(
+        """SELECT id, document_id, issue_type, severity, description, acknowledged, resolved_date, created_date
+           FROM validation_issues ORDER BY id"""
+    )
+    kept = {}
+    repeats = []
+    # Issues one run stored share a created date, so two worded alike came from different rules
+    stored_in_run = set()
+    for row in cursor.fetchall():
+        fingerprint = stored_issue_fingerprint(row['issue_type'], row['description'])
+        run_key = (row['document_id'], row['created_date'], fingerprint)
+        if run_key in stored_in_run:
+            fingerprint = stored_issue_fingerprint(row['issue_type'], row['description'], repeated_in_run=True)
+        stored_in_run.add(run_key)
+        key = (row['document_id'], fingerprint)
+        if key in kept:
+            repeats.append(row['id'])
+            issue = kept[key]
+            issue.update(severity=row['severity'], description=row['description'],
+                         acknowledged=issue['acknowledged'] or bool(row['acknowledged']),
+                         resolved_date=row['resolved_date'] if issue['resolved_date'] else None)
+        else:
+            kept[key] = dict(row, fingerprint=fingerprint, acknowledged=bool(row['acknowledged']))
+    cursor.executemany(
+        "UPDATE validation_issues SET fingerprint = ?, severity = ?, description = ?, acknowledged = ?, resolved_date = ? WHERE id = ?",
+        [(issue['fingerprint'], issue['severity'], issue['description'], issue['acknowledged'], issue['resolved_date'], issue['id'])
+         for issue in kept.values()]
+    )
+    cursor.executemany("DELETE FROM validation_issues WHERE id = ?", [(issue_id,) for issue_id in repeats])
+
+def _backfill_normalized_dates(cursor):
+    """Store the ISO form of dates extracted before it was kept alongside the raw value"""
+    from dates import normalize_date
+    cursor.execute("SELECT id, field_value FROM extractions WHERE field_name = 'date' AND field_value IS NOT NULL")
+    cursor.executemany(
+        "UPDATE extractions SET normalized_value = ? WHERE id = ?",
+        [(normalize_date(field_value), extraction_id) for extraction_id, field_value in cursor.fetchall()]
+    )
+
+# Schema migrations, applied in order by init_db. PRAGMA user_version records the
+# last one applied, so each runs exactly once per database. Steps are SQL strings
+# or functions taking a cursor.
+MIGRATIONS = [
+    (1, 'Index per-document and per-batch lookups', [
+        # Covers SELECT * FROM extractions WHERE document_id = ? without touching the table
+        "CREATE INDEX IF NOT EXISTS idx_extractions_document ON extractions (document_id, field_name, field_value, confidence_score)",
+        "CREATE INDEX IF NOT EXISTS idx_receipt_items_document ON receipt_items (document_id)",
+        "CREATE INDEX IF NOT EXISTS idx_receipt_details_document ON receipt_details (document_id)",
+        "CREATE INDEX IF NOT EXISTS idx_validation_issues_document ON validation_issues (document_id, severity, created_date)",
+        "CREATE INDEX IF NOT EXISTS idx_documents_batch ON documents (batch_id)",
+        "CREATE INDEX IF NOT EXISTS idx_documents_upload_date ON documents (upload_date)",
+        "CREATE INDEX IF NOT EXISTS idx_batch_jobs_user ON batch_jobs (user_id, created_date)",
+        "CREATE INDEX IF NOT EXISTS idx_job_queue_status ON job_queue (status, id)",
+    ]),
+    (2, 'Track files loaded by the bulk ingester', [
+        # One row per source file (or zip member), written in the same transaction as
+        # the document's results so an interrupted ingest resumes where it stopped
+        '''CREATE TABLE IF NOT EXISTS ingest_files (
+            source TEXT PRIMARY KEY,
+            document_id INTEGER,
+            status TEXT NOT NULL,
+            error TEXT,
+            elapsed REAL,
+            updated_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (document_id) REFERENCES documents (id)
+        )''',
+    ]),
+    (3, 'Track chunked upload sessions', [
+        '''CREATE TABLE IF NOT EXISTS upload_sessions (
+            id TEXT PRIMARY KEY,
+            filename TEXT NOT NULL,
+            total_size INTEGER,  -- Declared by the client, checked on commit
+            sha256 TEXT,  -- Optional checksum of the whole file, checked on commit
+            received_bytes INTEGER DEFAULT 0,
+            status TEXT DEFAULT 'open',  -- open, committed, aborted, expired
+            batch_id INTEGER DEFAULT NULL,
             created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (batch_id) REFERENCES batch_jobs (id)
+        )''',
+    ]),
+    (4, 'Add performance counters shared by all workers', [
+        '''CREATE TABLE IF NOT EXISTS performance_counters (
+            name TEXT PRIMARY KEY,  -- e.g. ocr_images, ocr_seconds, preprocess_deskew_seconds
+            value REAL DEFAULT 0
+        )''',
+    ]),
+    (5, 'Fingerprint documents for duplicate detection', [
+        '''CREATE TABLE IF NOT EXISTS document_fingerprints (
+            document_id INTEGER PRIMARY KEY,
+            exact_key TEXT,  -- Normalized vendor|invoice number|cents|date, NULL if any is missing
+            minhash TEXT,  -- MinHash signature of the document text in hex, NULL for short texts
             FOREIGN KEY (document_id) REFERENCES documents (id)
-        )
-    ''')
-    
-    # Create a default admin user if none exists
-    cursor.execute("SELECT COUNT(*) FROM users")
-    if cursor.fetchone()[0] == 0:
-        # Default user: admin / password
-        import hashlib
-        password_hash = hashlib.sha256('password'.encode()).hexdigest()
-        cursor.execute(
-            "INSERT INTO users (username, password_hash) VALUES (?, ?)",
-            ('admin', password_hash)
-        )
+        )''',
+        "CREATE INDEX IF NOT EXISTS idx_fingerprints_exact_key ON document_fingerprints (exact_key) WHERE exact_key IS NOT NULL",
+        # One row per band of each signature; documents sharing a band key are near-duplicate candidates
+        '''CREATE TABLE IF NOT EXISTS document_text_bands (
+            band_key INTEGER NOT NULL,
+            document_id INTEGER NOT NULL,
+            PRIMARY KEY (band_key, document_id)
+        ) WITHOUT ROWID''',
+        "CREATE INDEX IF NOT EXISTS idx_text_bands_document ON document_text_bands (document_id)",
+        _backfill_fingerprints,
+    ]),
+    (6, 'Revalidate documents by diffing their issues', [
+        # An issue's fingerprint identifies it across runs, so a rerun inserts only new issues,
+        # marks ones no longer found resolved, and leaves acknowledgements alone
+        "ALTER TABLE validation_issues ADD COLUMN fingerprint TEXT",
+        "ALTER TABLE validation_issues ADD COLUMN resolved_date TIMESTAMP DEFAULT NULL",
+        # The rule set and inputs a document's issues were computed from; unchanged documents skip the rules
+        "ALTER TABLE documents ADD COLUMN validation_ruleset TEXT",
+        "ALTER TABLE documents ADD COLUMN validation_input_hash TEXT",
+        _collapse_repeated_issues,
+        "CREATE INDEX IF NOT EXISTS idx_validation_issues_fingerprint ON validation_issues (document_id, fingerprint)",
+    ]),
+    (7, 'Track bulk revalidation jobs', [
+        '''CREATE TABLE IF NOT EXISTS revalidation_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            status TEXT DEFAULT 'queued',  -- queued, running, completed, failed
+            filters TEXT,  -- JSON: batch_id, date_from, date_to, vendor
+            force BOOLEAN DEFAULT FALSE,
+            total_documents INTEGER DEFAULT 0,
+            processed_documents INTEGER DEFAULT 0,
+            skipped_documents INTEGER DEFAULT 0,  -- Unchanged since validated under the current rules
+            changed_documents INTEGER DEFAULT 0,  -- Documents that gained or lost issues
+            failed_documents INTEGER DEFAULT 0,
+            issues_added INTEGER DEFAULT 0,
+            issues_resolved INTEGER DEFAULT 0,
+            docs_per_second REAL DEFAULT 0,
+            error TEXT,
+            created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_date TIMESTAMP,
+            completed_date TIMESTAMP
+        )''',
+    ]),
+    (8, 'Store extracted dates in ISO form alongside the raw value', [
+        "ALTER TABLE extractions ADD COLUMN normalized_value TEXT",
+        # Rebuilt after the backfill so SELECT * FROM extractions stays covered by the index
+        "DROP INDEX IF EXISTS idx_extractions_document",
+        _backfill_normalized_dates,
+        "CREATE INDEX IF NOT EXISTS idx_extractions_document ON extractions (document_id, field_name, field_value, confidence_score, normalized_value)",
+    ]),
+    (9, 'Fingerprint validation issues by the rule that raised them', [
+        # Descriptions mention today's date and matching documents, so fingerprinting them
+        # split one issue into a new row (losing its acknowledgement) whenever those changed
+        _collapse_repeated_issues,
+    ]),
+    (10, 'Lease queued jobs to the worker running them', [
+        # Workers renew their leases while running; only jobs whose lease lapsed are taken over
+        "ALTER TABLE job_queue ADD COLUMN owner TEXT",
+        "ALTER TABLE job_queue ADD COLUMN lease_expires TIMESTAMP",
+    ]),
+    (11, 'Tell apart the vendor and industry restaurant tip issues', [
+        # Both rules fingerprinted their issue as one rule, so a document holding both had two
+        # rows under one fingerprint and revalidation only ever resolved one of them
+        _collapse_repeated_issues,
+    ]),
+]
+
+def get_schema_version(cursor):
+    """Get the last migration applied to the database"""
+    cursor.execute("PRAGMA user_version")
+    return cursor.fetchone()[0]
+
+def migrate_db():
+    """Apply any schema migrations the database has not seen yet
     
-    conn.commit()
-    conn.close()
+    Each migration runs in its own write transaction together with its user_version bump,
+    so a crash can never leave the schema and the version out of step.
+    """
+    for version, description, steps in MIGRATIONS:
+        with transaction() as cursor:
+            # Read under the write lock, so a migration another process just applied is skipped
+            if version <= get_schema_version(cursor):
+                continue
+            for step in steps:
+                if callable(step):
+                    step(cursor)
+                else:
+                    cursor.execute(step)
+            cursor.execute(f"PRAGMA user_version = {int(version)}")
 
 def insert_document(filename, document_type='unknown', batch_id=None):
     """Insert a new document record"""
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT INTO documents (filename, document_type, batch_id) VALUES (?, ?, ?)",
-        (filename, document_type, batch_id)
-    )
-    doc_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    with transaction() as cursor:
+        cursor.execute(
+            "INSERT INTO documents (filename, document_type, batch_id) VALUES (?, ?, ?)",
+            (filename, document_type, batch_id)
+        )
+        doc_id = cursor.lastrowid
     return doc_id
 
 def update_document_status(doc_id, status):
     """Update document status"""
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute(
-        "UPDATE documents SET status = ? WHERE id = ?",
-        (status, doc_id)
-    )
-    conn.commit()
-    conn.close()
+    with transaction() as cursor:
+        cursor.execute(
+            "UPDATE documents SET status = ? WHERE id = ?",
+            (status, doc_id)
+        )
 
-def insert_extraction(document_id, field_name, field_value, confidence_score):
+def insert_extraction(document_id, field_name, field_value, confidence_score, normalized_value=None):
     """Insert an extraction result"""
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT INTO extractions (document_id, field_name, field_value, confidence_score) VALUES (?, ?, ?, ?)",
-        (document_id, field_name, field_value, confidence_score)
-    )
-    extraction_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    with transaction() as cursor:
+        cursor.execute(
+            "INSERT INTO extractions (document_id, field_name, field_value, confidence_score, normalized_value) VALUES (?, ?, ?, ?, ?)",
+            (document_id, field_name, field_value, confidence_score, normalized_value)
+        )
+        extraction_id = cursor.lastrowid
     return extraction_id
 
 def get_document_extractions(document_id):
     """Get all extractions for a document"""
-    conn = get_db()
-    cursor = conn.cursor()
+    cursor = get_db().cursor()
     cursor.execute(
         "SELECT * FROM extractions WHERE document_id = ?",
         (document_id,)
     )
     results = cursor.fetchall()
-    conn.close()
     return [dict(row) for row in results]
 
 def get_document_history():
     """Get processing history"""
-    conn = get_db()
-    cursor = conn.cursor()
+    cursor = get_db().cursor()
     cursor.execute('''
         SELECT d.id, d.filename, d.upload_date, d.status, 
                COUNT(e.id) as extraction_count
@@ -196,20 +477,16 @@ def get_document_history():
         ORDER BY d.upload_date DESC
     ''')
     results = cursor.fetchall()
-    conn.close()
     return [dict(row) for row in results]
 
 def insert_correction(extraction_id, original_value, corrected_value):
     """Insert a correction"""
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT INTO corrections (extraction_id, original_value, corrected_value) VALUES (?, ?, ?)",
-        (extraction_id, original_value, corrected_value)
-    )
-    correction_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    with transaction() as cursor:
+        cursor.execute(
+            "INSERT INTO corrections (extraction_id, original_value, corrected_value) VALUES (?, ?, ?)",
+            (extraction_id, original_value, corrected_value)
+        )
+        correction_id = cursor.lastrowid
     return correction_id
 
 def authenticate_user(username, password):
@@ -217,219 +494,468 @@ def authenticate_user(username, password):
     import hashlib
     password_hash = hashlib.sha256(password.encode()).hexdigest()
     
-    conn = get_db()
-    cursor = conn.cursor()
+    cursor = get_db().cursor()
     cursor.execute(
         "SELECT * FROM users WHERE username = ? AND password_hash = ?",
         (username, password_hash)
     )
     user = cursor.fetchone()
-    conn.close()
     return dict(user) if user else None
 
 def insert_receipt_item(document_id, item_name, quantity, unit_price, total_price):
     """Insert a receipt item"""
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT INTO receipt_items (document_id, item_name, quantity, unit_price, total_price) VALUES (?, ?, ?, ?, ?)",
-        (document_id, item_name, quantity, unit_price, total_price)
-    )
-    item_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    with transaction() as cursor:
+        cursor.execute(
+            "INSERT INTO receipt_items (document_id, item_name, quantity, unit_price, total_price) VALUES (?, ?, ?, ?, ?)",
+            (document_id, item_name, quantity, unit_price, total_price)
+        )
+        item_id = cursor.lastrowid
     return item_id
 
 def get_receipt_items(document_id):
     """Get all receipt items for a document"""
-    conn = get_db()
-    cursor = conn.cursor()
+    cursor = get_db().cursor()
     cursor.execute(
         "SELECT * FROM receipt_items WHERE document_id = ?",
         (document_id,)
     )
     results = cursor.fetchall()
-    conn.close()
     return [dict(row) for row in results]
 
+RECEIPT_DETAIL_COLUMNS = [
+    'merchant_name', 'location', 'payment_method', 'tip_amount', 'subtotal',
+    'tax_amount', 'total_amount', 'cashier_name', 'transaction_time', 'category'
+]
+
 def insert_receipt_details(document_id, merchant_name=None, location=None, payment_method=None, 
                           tip_amount=None, subtotal=None, tax_amount=None, total_amount=None, 
                           cashier_name=None, transaction_time=None, category=None):
     """Insert receipt details"""
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute(
-        '''INSERT INTO receipt_details 
-           (document_id, merchant_name, location, payment_method, tip_amount, 
-            subtotal, tax_amount, total_amount, cashier_name, transaction_time, category) 
-           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-        (document_id, merchant_name, location, payment_method, tip_amount, 
-         subtotal, tax_amount, total_amount, cashier_name, transaction_time, category)
-    )
-    details_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    with transaction() as cursor:
+        cursor.execute(
+            '''INSERT INTO receipt_details 
+               (document_id, merchant_name, location, payment_method, tip_amount, 
+                subtotal, tax_amount, total_amount, cashier_name, transaction_time, category) 
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+            (document_id, merchant_name, location, payment_method, tip_amount, 
+             subtotal, tax_amount, total_amount, cashier_name, transaction_time, category)
+        )
+        details_id = cursor.lastrowid
     return details_id
 
 def get_receipt_details(document_id):
     """Get receipt details for a document"""
-    conn = get_db()
-    cursor = conn.cursor()
+    cursor = get_db().cursor()
     cursor.execute(
         "SELECT * FROM receipt_details WHERE document_id = ?",
         (document_id,)
     )
     result = cursor.fetchone()
-    conn.close()
     return dict(result) if result else None
 
 def update_document_type(doc_id, document_type):
     """Update document type"""
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute(
-        "UPDATE documents SET document_type = ? WHERE id = ?",
-        (document_type, doc_id)
-    )
-    conn.commit()
-    conn.close()
+    with transaction() as cursor:
+        cursor.execute(
+            "UPDATE documents SET document_type = ? WHERE id = ?",
+            (document_type, doc_id)
+        )
 
 def get_document_type(doc_id):
     """Get document type"""
-    conn = get_db()
-    cursor = conn.cursor()
+    cursor = get_db().cursor()
     cursor.execute(
         "SELECT document_type FROM documents WHERE id = ?",
         (doc_id,)
     )
     result = cursor.fetchone()
-    conn.close()
     return result[0] if result else 'unknown'
 
 def insert_batch_job(user_id, total_files):
     """Insert a new batch job record"""
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT INTO batch_jobs (user_id, total_files) VALUES (?, ?)",
-        (user_id, total_files)
-    )
-    batch_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    with transaction() as cursor:
+        cursor.execute(
+            "INSERT INTO batch_jobs (user_id, total_files) VALUES (?, ?)",
+            (user_id, total_files)
+        )
+        batch_id = cursor.lastrowid
     return batch_id
 
 def update_batch_status(batch_id, status, processed_files=None, failed_files=None):
     """Update batch job status"""
-    conn = get_db()
-    cursor = conn.cursor()
+    with transaction() as cursor:
     
-    if status == 'completed':
-        cursor.execute(
-            "UPDATE batch_jobs SET status = ?, processed_files = ?, failed_files = ?, completed_date = CURRENT_TIMESTAMP WHERE id = ?",
-            (status, processed_files, failed_files, batch_id)
-        )
-    else:
-        if processed_files is not None and failed_files is not None:
+        if status == 'completed':
             cursor.execute(
-                "UPDATE batch_jobs SET status = ?, processed_files = ?, failed_files = ? WHERE id = ?",
+                "UPDATE batch_jobs SET status = ?, processed_files = ?, failed_files = ?, completed_date = CURRENT_TIMESTAMP WHERE id = ?",
                 (status, processed_files, failed_files, batch_id)
             )
-        elif processed_files is not None:
-            cursor.execute(
-                "UPDATE batch_jobs SET status = ?, processed_files = ? WHERE id = ?",
-                (status, processed_files, batch_id)
-            )
-        elif failed_files is not None:
-            cursor.execute(
-                "UPDATE batch_jobs SET status = ?, failed_files = ? WHERE id = ?",
-                (status, failed_files, batch_id)
-            )
         else:
-            cursor.execute(
-                "UPDATE batch_jobs SET status = ? WHERE id = ?",
-                (status, batch_id)
-            )
+            if processed_files is not None and failed_files is not None:
+                cursor.execute(
+                    "UPDATE batch_jobs SET status = ?, processed_files = ?, failed_files = ? WHERE id = ?",
+                    (status, processed_files, failed_files, batch_id)
+                )
+            elif processed_files is not None:
+                cursor.execute(
+                    "UPDATE batch_jobs SET status = ?, processed_files = ? WHERE id = ?",
+                    (status, processed_files, batch_id)
+                )
+            elif failed_files is not None:
+                cursor.execute(
+                    "UPDATE batch_jobs SET status = ?, failed_files = ? WHERE id = ?",
+                    (status, failed_files, batch_id)
+                )
+            else:
+                cursor.execute(
+                    "UPDATE batch_jobs SET status = ? WHERE id = ?",
+                    (status, batch_id)
+                )
+
+def finalize_batch_total(batch_id, total_files, failed_files):
+    """Set the final file count of a batch once all of its documents are queued"""
+    with transaction() as cursor:
+        cursor.execute(
+            "UPDATE batch_jobs SET status = 'processing', total_files = ?, failed_files = failed_files + ? WHERE id = ?",
+            (total_files, failed_files, batch_id)
+        )
+        _complete_batch_if_done(cursor, batch_id)
+
+def record_batch_result(batch_id, success):
+    """Count a finished document against its batch"""
+    column = 'processed_files' if success else 'failed_files'
+    with transaction() as cursor:
+        cursor.execute(
+            f"UPDATE batch_jobs SET {column} = {column} + 1 WHERE id = ?",
+            (batch_id,)
+        )
+        _complete_batch_if_done(cursor, batch_id)
+
+def start_document_processing(document_id):
+    """Mark a document processing, returning False if it has already finished"""
+    with transaction() as cursor:
+        cursor.execute(
+            "UPDATE documents SET status = 'processing' WHERE id = ? AND status NOT IN ('completed', 'failed')",
+            (document_id,)
+        )
+        started = cursor.rowcount == 1
+    return started
+
+def finish_document(document_id, status, batch_id=None):
+    """Give a document its final status and count it against its batch, unless it has already finished
     
-    conn.commit()
-    conn.close()
+    Returns False when an earlier run of the same job got there first, so a job that runs
+    twice never counts a document twice.
+    """
+    with transaction() as cursor:
+        cursor.execute(
+            "UPDATE documents SET status = ? WHERE id = ? AND status NOT IN ('completed', 'failed')",
+            (status, document_id)
+        )
+        if cursor.rowcount == 0:
+            return False
+        if batch_id is not None:
+            record_batch_result(batch_id, status == 'completed')
+    return True
+
+def _complete_batch_if_done(cursor, batch_id):
+    """Mark a batch completed when every file has been accounted for"""
+    # Batches stay 'pending' while files are still being queued, so they
+    # cannot complete before their final total is known
+    cursor.execute(
+        """UPDATE batch_jobs SET status = 'completed', completed_date = CURRENT_TIMESTAMP
+           WHERE id = ? AND status = 'processing' AND processed_files + failed_files >= total_files""",
+        (batch_id,)
+    )
 
 def get_batch_job(batch_id):
     """Get batch job details"""
-    conn = get_db()
-    cursor = conn.cursor()
+    cursor = get_db().cursor()
     cursor.execute(
         "SELECT * FROM batch_jobs WHERE id = ?",
         (batch_id,)
     )
     result = cursor.fetchone()
-    conn.close()
     return dict(result) if result else None
 
 def get_batch_documents(batch_id):
     """Get all documents in a batch"""
-    conn = get_db()
-    cursor = conn.cursor()
+    cursor = get_db().cursor()
     cursor.execute(
         "SELECT * FROM documents WHERE batch_id = ?",
         (batch_id,)
     )
     results = cursor.fetchall()
-    conn.close()
     return [dict(row) for row in results]
 
+def _group_by_document(rows):
+    """Group rows into {document_id: [row dicts]}"""
+    grouped = {}
+    for row in rows:
+        grouped.setdefault(row['document_id'], []).append(dict(row))
+    return grouped
+
+def get_batch_extractions(batch_id):
+    """Get the extractions of every document in a batch, keyed by document id"""
+    cursor = get_db().cursor()
+    cursor.execute(
+        "SELECT * FROM extractions WHERE document_id IN (SELECT id FROM documents WHERE batch_id = ?)",
+        (batch_id,)
+    )
+    return _group_by_document(cursor.fetchall())
+
+def get_batch_receipt_details(batch_id):
+    """Get the receipt details of every document in a batch, keyed by document id"""
+    cursor = get_db().cursor()
+    cursor.execute(
+        "SELECT * FROM receipt_details WHERE document_id IN (SELECT id FROM documents WHERE batch_id = ?)",
+        (batch_id,)
+    )
+    return {document_id: rows[0] for document_id, rows in _group_by_document(cursor.fetchall()).items()}
+
+def get_batch_receipt_items(batch_id):
+    """Get the receipt items of every document in a batch, keyed by document id"""
+    cursor = get_db().cursor()
+    cursor.execute(
+        "SELECT * FROM receipt_items WHERE document_id IN (SELECT id FROM documents WHERE batch_id = ?)",
+        (batch_id,)
+    )
+    return _group_by_document(cursor.fetchall())
+
+def iter_rows(sql, params=(), chunk_size=None):
+    """Stream a query's rows in chunks on a dedicated connection, for exports of any size"""
+    # A separate connection keeps the long-running read off the thread's shared
+    # connection, so the export never holds it mid-transaction
+    conn = connect_db()
+    try:
+        cursor = conn.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(chunk_size or Config.EXPORT_FETCH_SIZE)
+            if not rows:
+                break
+            yield rows
+    finally:
+        conn.close()
+
+def iter_batch_extraction_rows(batch_id, chunk_size=None):
+    """Stream a batch's extraction rows in document order (documents without any get one NULL row)"""
+    return iter_rows('''
+        SELECT d.id AS document_id, d.filename, e.field_name, e.field_value, e.confidence_score
+        FROM documents d
+        LEFT JOIN extractions e ON e.document_id = d.id
+        WHERE d.batch_id = ?
+        ORDER BY d.id
+    ''', (batch_id,), chunk_size)
+
+def iter_document_extraction_rows(document_id, chunk_size=None):
+    """Stream a document's extraction rows"""
+    return iter_rows(
+        "SELECT field_name, field_value, confidence_score FROM extractions WHERE document_id = ?",
+        (document_id,), chunk_size
+    )
+
+def iter_batch_pivot_rows(batch_id, fields, numeric_fields=(), chunk_size=None):
+    """Stream one row per batch document with each field's value and confidence as columns"""
+    columns = []
+    params = []
+    for field in fields:
+        if field in numeric_fields:
+            # Only plain decimal strings become numbers; anything else is NULL rather than 0
+            columns.append(
+                "MAX(CASE WHEN e.field_name = ? AND e.field_value GLOB '*[0-9]*' "
+                "AND e.field_value NOT GLOB '*[^0-9.]*' THEN CAST(e.field_value AS REAL) END)"
+            )
+        else:
+            columns.append("MAX(CASE WHEN e.field_name = ? THEN e.field_value END)")
+        columns.append("MAX(CASE WHEN e.field_name = ? THEN e.confidence_score END)")
+        params.extend([field, field])
+    
+    return iter_rows(f'''
+        SELECT d.id, d.filename, d.document_type, d.status, d.upload_date, {', '.join(columns)}
+        FROM documents d
+        LEFT JOIN extractions e ON e.document_id = d.id
+        WHERE d.batch_id = ?
+        GROUP BY d.id
+        ORDER BY d.id
+    ''', params + [batch_id], chunk_size)
+
+def iter_batch_item_rows(batch_id, chunk_size=None):
+    """Stream the receipt items of every document in a batch"""
+    return iter_rows('''
+        SELECT i.document_id, d.filename, i.item_name, i.quantity, i.unit_price, i.total_price
+        FROM documents d
+        JOIN receipt_items i ON i.document_id = d.id
+        WHERE d.batch_id = ?
+        ORDER BY d.id
+    ''', (batch_id,), chunk_size)
+
 def insert_validation_issue(document_id, issue_type, severity, description):
     """Insert a validation issue"""
-    conn = get_db()
-    cursor = conn.cursor()
+    with transaction() as cursor:
+        cursor.execute(
+            "INSERT INTO validation_issues (document_id, issue_type, severity, description) VALUES (?, ?, ?, ?)",
+            (document_id, issue_type, severity, description)
+        )
+        issue_id = cursor.lastrowid
+    return issue_id
+
+def insert_validation_issues(document_id, issues):
+    """Insert several validation issues in one statement"""
+    with transaction() as cursor:
+        cursor.executemany(
+            "INSERT INTO validation_issues (document_id, issue_type, severity, description, fingerprint) VALUES (?, ?, ?, ?, ?)",
+            [(document_id, issue['issue_type'], issue['severity'], issue['description'], issue.get('fingerprint'))
+             for issue in issues]
+        )
+
+def apply_validation_issues(document_id, issues):
+    """Bring a document's stored issues in line with a validation run, returning (inserted, resolved, reopened)
+
+    Issues are matched by fingerprint: new ones are inserted, open ones the run did not find are
+    marked resolved, and resolved ones found again are reopened. Rows found again keep their
+    acknowledgement and created date; only their severity and description are brought up to date.
+    Extra rows stored under one fingerprint are merged into its first, as the migrations do.
+    """
+    with transaction() as cursor:
+        cursor.execute(
+            "SELECT id, fingerprint, severity, description, acknowledged, resolved_date FROM validation_issues WHERE document_id = ? ORDER BY id",
+            (document_id,)
+        )
+        existing = {}
+        for row in cursor.fetchall():
+            existing.setdefault(row['fingerprint'], []).append(row)
+        found = {issue['fingerprint']: issue for issue in issues}
+
+        new_issues = [issue for fingerprint, issue in found.items() if fingerprint not in existing]
+        reopened = []
+        resolved = []
+        reworded = []
+        acknowledged = []
+        repeats = []
+        for fingerprint, rows in existing.items():
+            if fingerprint not in found:
+                resolved.extend((row['id'],) for row in rows if row['resolved_date'] is None)
+                continue
+            first, issue = rows[0], found[fingerprint]
+            if first['resolved_date'] is not None:
+                reopened.append((first['id'],))
+            if (issue['severity'], issue['description']) != (first['severity'], first['description']):
+                reworded.append((issue['severity'], issue['description'], first['id']))
+            if not first['acknowledged'] and any(row['acknowledged'] for row in rows[1:]):
+                acknowledged.append((first['id'],))
+            repeats.extend((row['id'],) for row in rows[1:])
+
+        insert_validation_issues(document_id, new_issues)
+        cursor.executemany("UPDATE validation_issues SET severity = ?, description = ? WHERE id = ?", reworded)
+        cursor.executemany("UPDATE validation_issues SET acknowledged = TRUE WHERE id = ?", acknowledged)
+        cursor.executemany("UPDATE validation_issues SET resolved_date = NULL WHERE id = ?", reopened)
+        cursor.executemany("UPDATE validation_issues SET resolved_date = CURRENT_TIMESTAMP WHERE id = ?", resolved)
+        cursor.executemany("DELETE FROM validation_issues WHERE id = ?", repeats)
+    return len(new_issues), len(resolved), len(reopened)
+
+def get_validation_state(document_id):
+    """Get the rule set version and input hash a document's issues were last computed from"""
+    cursor = get_db().cursor()
     cursor.execute(
-        "INSERT INTO validation_issues (document_id, issue_type, severity, description) VALUES (?, ?, ?, ?)",
-        (document_id, issue_type, severity, description)
+        "SELECT validation_ruleset, validation_input_hash FROM documents WHERE id = ?",
+        (document_id,)
     )
-    issue_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
-    return issue_id
+    result = cursor.fetchone()
+    return (result['validation_ruleset'], result['validation_input_hash']) if result else (None, None)
 
-def get_validation_issues(document_id):
-    """Get all validation issues for a document"""
-    conn = get_db()
-    cursor = conn.cursor()
+def set_validation_state(document_id, ruleset_version, input_hash):
+    """Record the rule set version and input hash a document's issues were computed from"""
+    with transaction() as cursor:
+        cursor.execute(
+            "UPDATE documents SET validation_ruleset = ?, validation_input_hash = ? WHERE id = ?",
+            (ruleset_version, input_hash, document_id)
+        )
+
+def _to_db_value(value):
+    """Convert an extracted value to something SQLite can store"""
+    # Structured values such as line items are stored as JSON text
+    if isinstance(value, (list, dict)):
+        return json.dumps(value)
+    return value
+
+def save_document_results(document_id, document_type, extractions, receipt_details=None,
+                          receipt_items=None, validation_issues=None, status=None, validation_state=None):
+    """Persist all of a document's extraction results in one transaction
+    
+    extractions is a list of (field_name, field_value, confidence_score) tuples, optionally
+    followed by the value's normalized form (an ISO date for dates), receipt_details a dict keyed by receipt_details column, and receipt_items and
+    validation_issues lists of dicts keyed by their table's columns. validation_state
+    is the (ruleset_version, input_hash) the issues were computed from.
+    """
+    with transaction() as cursor:
+        cursor.execute(
+            "UPDATE documents SET document_type = ? WHERE id = ?",
+            (document_type, document_id)
+        )
+        
+        cursor.executemany(
+            "INSERT INTO extractions (document_id, field_name, field_value, confidence_score, normalized_value) VALUES (?, ?, ?, ?, ?)",
+            [(document_id, field_name, _to_db_value(field_value), confidence_score, normalized[0] if normalized else None)
+             for field_name, field_value, confidence_score, *normalized in extractions]
+        )
+        
+        if receipt_details is not None:
+            cursor.execute(
+                '''INSERT INTO receipt_details 
+                   (document_id, merchant_name, location, payment_method, tip_amount, 
+                    subtotal, tax_amount, total_amount, cashier_name, transaction_time, category) 
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                (document_id,) + tuple(receipt_details.get(column) for column in RECEIPT_DETAIL_COLUMNS)
+            )
+        
+        if receipt_items:
+            cursor.executemany(
+                "INSERT INTO receipt_items (document_id, item_name, quantity, unit_price, total_price) VALUES (?, ?, ?, ?, ?)",
+                [(document_id, item.get('item_name'), item.get('quantity'), item.get('unit_price'), item.get('total_price'))
+                 for item in receipt_items]
+            )
+        
+        if validation_issues:
+            insert_validation_issues(document_id, validation_issues)
+        
+        if validation_state is not None:
+            set_validation_state(document_id, *validation_state)
+        
+        if status is not None:
+            update_document_status(document_id, status)
+
+def get_validation_issues(document_id, include_resolved=False):
+    """Get a document's open validation issues, or all of them including resolved ones"""
+    cursor = get_db().cursor()
     cursor.execute(
-        "SELECT * FROM validation_issues WHERE document_id = ? ORDER BY severity, created_date",
+        f"""SELECT * FROM validation_issues WHERE document_id = ?
+            {'' if include_resolved else 'AND resolved_date IS NULL'} ORDER BY severity, created_date""",
         (document_id,)
     )
     results = cursor.fetchall()
-    conn.close()
     return [dict(row) for row in results]
 
 def acknowledge_validation_issue(issue_id):
     """Mark a validation issue as acknowledged"""
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute(
-        "UPDATE validation_issues SET acknowledged = TRUE WHERE id = ?",
-        (issue_id,)
-    )
-    conn.commit()
-    conn.close()
+    with transaction() as cursor:
+        cursor.execute(
+            "UPDATE validation_issues SET acknowledged = TRUE WHERE id = ?",
+            (issue_id,)
+        )
 
 def get_unacknowledged_issues_count(document_id):
     """Get count of unacknowledged validation issues for a document"""
-    conn = get_db()
-    cursor = conn.cursor()
+    cursor = get_db().cursor()
     cursor.execute(
-        "SELECT COUNT(*) as count FROM validation_issues WHERE document_id = ? AND acknowledged = FALSE",
+        "SELECT COUNT(*) as count FROM validation_issues WHERE document_id = ? AND acknowledged = FALSE AND resolved_date IS NULL",
         (document_id,)
     )
     result = cursor.fetchone()
-    conn.close()
     return result[0] if result else 0
 
 def get_batch_history(user_id):
     """Get batch processing history for a user"""
-    conn = get_db()
-    cursor = conn.cursor()
+    cursor = get_db().cursor()
     cursor.execute('''
         SELECT bj.*, u.username
         FROM batch_jobs bj
@@ -438,5 +964,354 @@ def get_batch_history(user_id):
         ORDER BY bj.created_date DESC
     ''', (user_id,))
     results = cursor.fetchall()
-    conn.close()
     return [dict(row) for row in results]
+
+def enqueue_job(task, payload):
+    """Add a job to the durable job queue"""
+    with transaction() as cursor:
+        cursor.execute(
+            "INSERT INTO job_queue (task, payload) VALUES (?, ?)",
+            (task, payload)
+        )
+        job_id = cursor.lastrowid
+    return job_id
+
+def claim_next_job(owner, lease_seconds, max_attempts):
+    """Claim the oldest job whose worker stopped renewing its lease, else the oldest queued job
+    
+    The claim is leased to owner for lease_seconds; returns None if there is nothing to run.
+    Jobs already started max_attempts times are left for fail_abandoned_jobs.
+    """
+    lease = f"+{int(lease_seconds)} seconds"
+    # Transactions take the write lock up front, so two workers cannot claim the same job
+    with transaction() as cursor:
+        # Jobs left running by a crashed worker have a lapsed lease (or none, from before leases)
+        cursor.execute(
+            """SELECT * FROM job_queue WHERE status = 'running' AND attempts < ?
+               AND (lease_expires IS NULL OR lease_expires < CURRENT_TIMESTAMP) ORDER BY id LIMIT 1""",
+            (max_attempts,)
+        )
+        job = cursor.fetchone()
+        if job is None:
+            cursor.execute(
+                "SELECT * FROM job_queue WHERE status = 'queued' ORDER BY id LIMIT 1"
+            )
+            job = cursor.fetchone()
+        if job:
+            cursor.execute(
+                """UPDATE job_queue SET status = 'running', attempts = attempts + 1, started_date = CURRENT_TIMESTAMP,
+                   owner = ?, lease_expires = datetime('now', ?) WHERE id = ?""",
+                (owner, lease, job['id'])
+            )
+    return dict(job) if job else None
+
+def fail_abandoned_jobs(max_attempts):
+    """Fail lapsed jobs already started max_attempts times, returning them
+
+    A job that keeps killing its worker (a crash in OCR, running out of memory) would otherwise
+    be taken over forever, ahead of every queued job.
+    """
+    with transaction() as cursor:
+        cursor.execute(
+            """SELECT * FROM job_queue WHERE status = 'running' AND attempts >= ?
+               AND (lease_expires IS NULL OR lease_expires < CURRENT_TIMESTAMP) ORDER BY id""",
+            (max_attempts,)
+        )
+        jobs = [dict(job) for job in cursor.fetchall()]
+        for job in jobs:
+            job['error'] = f"Worker stopped during each of {job['attempts']} attempts"
+        cursor.executemany(
+            "UPDATE job_queue SET status = 'failed', error = ?, finished_date = CURRENT_TIMESTAMP WHERE id = ?",
+            [(job['error'], job['id']) for job in jobs]
+        )
+    return jobs
+
+def renew_job_leases(owner, lease_seconds):
+    """Extend the leases on every job owner is still running"""
+    with transaction() as cursor:
+        cursor.execute(
+            "UPDATE job_queue SET lease_expires = datetime('now', ?) WHERE owner = ? AND status = 'running'",
+            (f"+{int(lease_seconds)} seconds", owner)
+        )
+
+def finish_job(job_id, owner, status, error=None):
+    """Record the outcome of a job, unless its lease lapsed and another worker took it over"""
+    with transaction() as cursor:
+        cursor.execute(
+            "UPDATE job_queue SET status = ?, error = ?, finished_date = CURRENT_TIMESTAMP WHERE id = ? AND owner = ?",
+            (status, error, job_id, owner)
+        )
+
+CACHE_COUNTERS = ['hits', 'misses', 'stores', 'evictions', 'seconds_saved']
+
+def get_ingest_statuses(sources):
+    """Get the recorded ingest status of each source that has one"""
+    cursor = get_db().cursor()
+    placeholders = ', '.join('?' for _ in sources)
+    cursor.execute(
+        f"SELECT source, status FROM ingest_files WHERE source IN ({placeholders})",
+        list(sources)
+    )
+    return {row['source']: row['status'] for row in cursor.fetchall()}
+
+def record_ingest_file(source, document_id, status, error=None, elapsed=None):
+    """Record the outcome of ingesting one source file"""
+    with transaction() as cursor:
+        cursor.execute(
+            '''INSERT INTO ingest_files (source, document_id, status, error, elapsed) VALUES (?, ?, ?, ?, ?)
+               ON CONFLICT (source) DO UPDATE SET document_id = excluded.document_id, status = excluded.status,
+               error = excluded.error, elapsed = excluded.elapsed, updated_date = CURRENT_TIMESTAMP''',
+            (source, document_id, status, error, elapsed)
+        )
+
+def insert_upload_session(upload_id, filename, total_size=None, sha256=None):
+    """Insert a new chunked upload session"""
+    with transaction() as cursor:
+        cursor.execute(
+            "INSERT INTO upload_sessions (id, filename, total_size, sha256) VALUES (?, ?, ?, ?)",
+            (upload_id, filename, total_size, sha256)
+        )
+
+def get_upload_session(upload_id):
+    """Get a chunked upload session"""
+    cursor = get_db().cursor()
+    cursor.execute(
+        "SELECT * FROM upload_sessions WHERE id = ?",
+        (upload_id,)
+    )
+    result = cursor.fetchone()
+    return dict(result) if result else None
+
+def advance_upload_session(upload_id, offset, received_bytes):
+    """Move an open session from offset to received_bytes, returning False if another chunk got there first"""
+    with transaction() as cursor:
+        cursor.execute(
+            """UPDATE upload_sessions SET received_bytes = ?, updated_date = CURRENT_TIMESTAMP
+               WHERE id = ? AND status = 'open' AND received_bytes = ?""",
+            (received_bytes, upload_id, offset)
+        )
+        return cursor.rowcount == 1
+
+def close_upload_session(upload_id, status):
+    """Move an open session to committed or aborted, returning False if it was already closed"""
+    with transaction() as cursor:
+        cursor.execute(
+            "UPDATE upload_sessions SET status = ?, updated_date = CURRENT_TIMESTAMP WHERE id = ? AND status = 'open'",
+            (status, upload_id)
+        )
+        return cursor.rowcount == 1
+
+def expire_upload_sessions(ttl_seconds):
+    """Close open sessions that have not received a chunk for ttl_seconds, returning their ids"""
+    with transaction() as cursor:
+        cursor.execute(
+            "SELECT id FROM upload_sessions WHERE status = 'open' AND updated_date < datetime('now', ?)",
+            (f'-{int(ttl_seconds)} seconds',)
+        )
+        upload_ids = [row['id'] for row in cursor.fetchall()]
+        cursor.executemany(
+            "UPDATE upload_sessions SET status = 'expired', updated_date = CURRENT_TIMESTAMP WHERE id = ?",
+            [(upload_id,) for upload_id in upload_ids]
+        )
+        return upload_ids
+
+def set_upload_session_batch(upload_id, batch_id):
+    """Link a committed session to the batch processing its file"""
+    with transaction() as cursor:
+        cursor.execute(
+            "UPDATE upload_sessions SET batch_id = ? WHERE id = ?",
+            (batch_id, upload_id)
+        )
+
+def increment_cache_counters(**counts):
+    """Add to the extraction cache counters"""
+    with transaction() as cursor:
+        cursor.executemany(
+            """INSERT INTO extraction_cache_stats (name, value) VALUES (?, ?)
+               ON CONFLICT(name) DO UPDATE SET value = value + excluded.value""",
+            list(counts.items())
+        )
+
+def get_cache_counters():
+    """Get the extraction cache counters"""
+    cursor = get_db().cursor()
+    cursor.execute("SELECT name, value FROM extraction_cache_stats")
+    values = {row['name']: row['value'] for row in cursor.fetchall()}
+    counters = {name: int(values.get(name, 0)) for name in CACHE_COUNTERS}
+    counters['seconds_saved'] = round(values.get('seconds_saved', 0.0), 3)
+    return counters
+
+def increment_performance_counters(counts):
+    """Add to named performance counters"""
+    with transaction() as cursor:
+        cursor.executemany(
+            """INSERT INTO performance_counters (name, value) VALUES (?, ?)
+               ON CONFLICT(name) DO UPDATE SET value = value + excluded.value""",
+            list(counts.items())
+        )
+
+def get_performance_counters(prefix=''):
+    """Get the performance counters whose names start with prefix"""
+    cursor = get_db().cursor()
+    cursor.execute(
+        "SELECT name, value FROM performance_counters WHERE substr(name, 1, ?) = ? ORDER BY name",
+        (len(prefix), prefix)
+    )
+    return {row['name']: row['value'] for row in cursor.fetchall()}
+
+def upsert_document_fingerprint(document_id, exact_key, minhash, band_keys):
+    """Store or replace a document's duplicate-detection fingerprint and text band keys"""
+    with transaction() as cursor:
+        cursor.execute(
+            "INSERT OR REPLACE INTO document_fingerprints (document_id, exact_key, minhash) VALUES (?, ?, ?)",
+            (document_id, exact_key, minhash)
+        )
+        cursor.execute("DELETE FROM document_text_bands WHERE document_id = ?", (document_id,))
+        cursor.executemany(
+            "INSERT OR IGNORE INTO document_text_bands (band_key, document_id) VALUES (?, ?)",
+            [(band_key, document_id) for band_key in band_keys]
+        )
+
+def get_document_fingerprint(document_id):
+    """Get a document's duplicate-detection fingerprint"""
+    cursor = get_db().cursor()
+    cursor.execute("SELECT * FROM document_fingerprints WHERE document_id = ?", (document_id,))
+    result = cursor.fetchone()
+    return dict(result) if result else None
+
+def find_fingerprints_by_key(exact_key, before_document_id, limit):
+    """Get the ids of documents stored before a document with an exact duplicate key, oldest first"""
+    cursor = get_db().cursor()
+    cursor.execute(
+        "SELECT document_id FROM document_fingerprints WHERE exact_key = ? AND document_id < ? ORDER BY document_id LIMIT ?",
+        (exact_key, before_document_id, limit)
+    )
+    return [row['document_id'] for row in cursor.fetchall()]
+
+def find_fingerprints_by_bands(band_keys, before_document_id, limit):
+    """Get the fingerprints of documents stored before a document sharing any text band key, as document_id and minhash rows"""
+    cursor = get_db().cursor()
+    placeholders = ', '.join('?' for _ in band_keys)
+    cursor.execute(
+        f"""SELECT f.document_id, f.minhash FROM document_fingerprints f
+            WHERE f.document_id IN (
+                SELECT document_id FROM document_text_bands WHERE band_key IN ({placeholders}) AND document_id < ?
+            ) LIMIT ?""",
+        (*band_keys, before_document_id, limit)
+    )
+    return [dict(row) for row in cursor.fetchall()]
+
+def _document_filter_sql(filters):
+    """Build the WHERE clause selecting the completed documents a revalidation targets"""
+    clauses = ["d.status = 'completed'"]
+    params = []
+    if filters.get('batch_id') is not None:
+        clauses.append("d.batch_id = ?")
+        params.append(filters['batch_id'])
+    if filters.get('date_from'):
+        clauses.append("d.upload_date >= ?")
+        params.append(filters['date_from'])
+    if filters.get('date_to'):
+        # The end date is inclusive, whatever the time of day
+        clauses.append("d.upload_date < date(?, '+1 day')")
+        params.append(filters['date_to'])
+    if filters.get('vendor'):
+        clauses.append('''EXISTS (SELECT 1 FROM extractions e WHERE e.document_id = d.id
+                          AND e.field_name IN ('vendor', 'merchant_name') AND e.field_value LIKE ? ESCAPE '\\')''')
+        # The vendor is plain text, so % and _ in it are matched literally rather than as wildcards
+        vendor = filters['vendor'].replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        params.append(f"%{vendor}%")
+    return ' AND '.join(clauses), params
+
+def count_filtered_documents(filters):
+    """Count the completed documents matching revalidation filters"""
+    where, params = _document_filter_sql(filters)
+    cursor = get_db().cursor()
+    cursor.execute(f"SELECT COUNT(*) FROM documents d WHERE {where}", params)
+    return cursor.fetchone()[0]
+
+def iter_filtered_document_ids(filters, chunk_size=None):
+    """Stream the ids of completed documents matching revalidation filters, in chunks"""
+    where, params = _document_filter_sql(filters)
+    for rows in iter_rows(f"SELECT d.id FROM documents d WHERE {where} ORDER BY d.id", params, chunk_size):
+        yield [row['id'] for row in rows]
+
+def get_validation_inputs(document_ids):
+    """Get what validation reads for several documents in one query per table, keyed by document id
+
+    Each value is a dict of extractions, receipt_items, receipt_details, minhash and validation_state.
+    """
+    placeholders = ', '.join('?' for _ in document_ids)
+    cursor = get_db().cursor()
+    inputs = {
+        document_id: {'extractions': [], 'receipt_items': [], 'receipt_details': None, 'minhash': None, 'validation_state': (None, None)}
+        for document_id in document_ids
+    }
+    cursor.execute(f"SELECT * FROM extractions WHERE document_id IN ({placeholders})", document_ids)
+    for document_id, rows in _group_by_document(cursor.fetchall()).items():
+        inputs[document_id]['extractions'] = rows
+    cursor.execute(f"SELECT * FROM receipt_items WHERE document_id IN ({placeholders})", document_ids)
+    for document_id, rows in _group_by_document(cursor.fetchall()).items():
+        inputs[document_id]['receipt_items'] = rows
+    cursor.execute(f"SELECT * FROM receipt_details WHERE document_id IN ({placeholders})", document_ids)
+    for document_id, rows in _group_by_document(cursor.fetchall()).items():
+        inputs[document_id]['receipt_details'] = rows[0]
+    cursor.execute(f"SELECT document_id, minhash FROM document_fingerprints WHERE document_id IN ({placeholders})", document_ids)
+    for row in cursor.fetchall():
+        inputs[row['document_id']]['minhash'] = row['minhash']
+    cursor.execute(
+        f"SELECT id, validation_ruleset, validation_input_hash FROM documents WHERE id IN ({placeholders})",
+        document_ids
+    )
+    for row in cursor.fetchall():
+        inputs[row['id']]['validation_state'] = (row['validation_ruleset'], row['validation_input_hash'])
+    return inputs
+
+def insert_revalidation_job(filters, force=False):
+    """Record a queued bulk revalidation job"""
+    with transaction() as cursor:
+        cursor.execute(
+            "INSERT INTO revalidation_jobs (filters, force) VALUES (?, ?)",
+            (json.dumps(filters), force)
+        )
+        job_id = cursor.lastrowid
+    return job_id
+
+def get_revalidation_job(job_id):
+    """Get a bulk revalidation job"""
+    cursor = get_db().cursor()
+    cursor.execute("SELECT * FROM revalidation_jobs WHERE id = ?", (job_id,))
+    result = cursor.fetchone()
+    if result is None:
+        return None
+    job = dict(result)
+    job['filters'] = json.loads(job['filters'] or '{}')
+    return job
+
+def start_revalidation_job(job_id, total_documents):
+    """Mark a revalidation job running over a known number of documents"""
+    with transaction() as cursor:
+        cursor.execute(
+            "UPDATE revalidation_jobs SET status = 'running', total_documents = ?, started_date = CURRENT_TIMESTAMP WHERE id = ?",
+            (total_documents, job_id)
+        )
+
+def record_revalidation_progress(job_id, processed, skipped, changed, failed, issues_added, issues_resolved, docs_per_second):
+    """Add a committed chunk's counts to a revalidation job"""
+    with transaction() as cursor:
+        cursor.execute(
+            '''UPDATE revalidation_jobs SET processed_documents = processed_documents + ?,
+                   skipped_documents = skipped_documents + ?, changed_documents = changed_documents + ?,
+                   failed_documents = failed_documents + ?, issues_added = issues_added + ?,
+                   issues_resolved = issues_resolved + ?, docs_per_second = ?
+               WHERE id = ?''',
+            (processed, skipped, changed, failed, issues_added, issues_resolved, docs_per_second, job_id)
+        )
+
+def finish_revalidation_job(job_id, status, error=None):
+    """Mark a revalidation job completed or failed"""
+    with transaction() as cursor:
+        cursor.execute(
+            "UPDATE revalidation_jobs SET status = ?, error = ?, completed_date = CURRENT_TIMESTAMP WHERE id = ?",
+            (status, error, job_id)
+        )
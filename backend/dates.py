@@ -0,0 +1,55 @@
+import calendar
+import re
+from datetime import date
+from functools import lru_cache
+
+# Distinct date strings kept parsed; a corpus repeats the same few hundred days
+DATE_CACHE_SIZE = 4096
+
+def _calendar_date(year, month, day):
+    """Build a date, or None if the parts are not a real calendar day"""
+    if year < 1 or not 1 <= month <= 12 or not 1 <= day <= calendar.monthrange(year, month)[1]:
+        return None
+    return date(year, month, day)
+
+def _full_year(year):
+    """Expand a two-digit year the way strptime's %y does: 69-99 are 1900s, 00-68 2000s"""
+    if len(year) == 2:
+        return int(year) + (1900 if int(year) >= 69 else 2000)
+    return int(year)
+
+def _year_first(match):
+    # 2024-03-14 or 2024/03/14
+    return _calendar_date(int(match.group(1)), int(match.group(3)), int(match.group(4)))
+
+def _day_or_month_first(match):
+    # 03/14/2024 is read month first; 14/03/2024 only parses day first
+    first, second = int(match.group(1)), int(match.group(3))
+    year = _full_year(match.group(4))
+    return _calendar_date(year, first, second) or _calendar_date(year, second, first)
+
+# The shapes find_date extracts, each with the function reading its parts. Both separators
+# of a date must match, as they had to under the strptime formats these replace.
+DATE_SHAPES = [
+    (re.compile(r'(\d{4})([/-])(\d{1,2})\2(\d{1,2})'), _year_first),
+    (re.compile(r'(\d{1,2})([/-])(\d{1,2})\2(\d{4}|\d{2})'), _day_or_month_first),
+]
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def _parse_date_text(text):
+    for shape, read in DATE_SHAPES:
+        match = shape.fullmatch(text)
+        if match:
+            return read(match)
+    return None
+
+def parse_date(value):
+    """Parse an extracted date string, or return None if it matches no known layout"""
+    if value in (None, ''):
+        return None
+    return _parse_date_text(str(value).strip())
+
+def normalize_date(value):
+    """Convert a date in any supported layout to YYYY-MM-DD, or None if it cannot be parsed"""
+    parsed = parse_date(value)
+    return parsed.isoformat() if parsed else None
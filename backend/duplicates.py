@@ -0,0 +1,158 @@
+import hashlib
+import random
+import re
+from config import Config
+from dates import normalize_date
+from database import (
+    upsert_document_fingerprint, get_document_fingerprint, find_fingerprints_by_key, find_fingerprints_by_bands
+)
+
+# A text's MinHash signature has MINHASH_PERMUTATIONS values, split into bands of
+# BAND_ROWS values that are each indexed; near-identical texts share at least one whole band
+MINHASH_PERMUTATIONS = 32
+BAND_ROWS = 4
+# Texts with fewer words than this are too short for their signatures to mean anything
+MINHASH_MIN_WORDS = 8
+# Words in each shingle the text is hashed as
+SHINGLE_WORDS = 3
+# Each permutation is (a * hash + b) mod a Mersenne prime, with fixed coefficients so
+# signatures stay comparable across processes and releases
+MERSENNE_PRIME = (1 << 61) - 1
+_coefficients = random.Random(20240314)
+PERMUTATIONS = [
+    (_coefficients.randrange(1, MERSENNE_PRIME), _coefficients.randrange(MERSENNE_PRIME))
+    for _ in range(MINHASH_PERMUTATIONS)
+]
+
+# Words that vary between how a vendor's name is printed but not which vendor it is
+VENDOR_STOP_WORDS = {'the', 'inc', 'llc', 'ltd', 'co', 'corp', 'corporation', 'company', 'limited', 'plc', 'gmbh'}
+
+def field_value(fields, name):
+    """Get a field's value from extraction results or stored extractions keyed by field name"""
+    value = (fields.get(name) or {}).get('value')
+    return value if value not in ('', None) else None
+
+def normalize_vendor(vendor):
+    """Reduce a vendor name to its lowercase words, without punctuation or legal suffixes"""
+    words = re.findall(r'[a-z0-9]+', str(vendor).lower())
+    return ' '.join(word for word in words if word not in VENDOR_STOP_WORDS)
+
+def normalize_invoice_number(number):
+    """Reduce an invoice number to its letters and digits, so INV-0042 and INV 0042 match"""
+    return re.sub(r'[^A-Z0-9]', '', str(number).upper())
+
+def normalize_amount(amount):
+    """Convert an amount to whole cents, or None if it is not a number"""
+    try:
+        return round(float(str(amount).replace('$', '').replace(',', '')) * 100)
+    except ValueError:
+        return None
+
+def exact_key(fields):
+    """Build the key two copies of the same invoice share: vendor, invoice number, amount and date
+
+    Returns (key, has_invoice_number), or (None, False) when the document lacks the fields to tell it apart.
+    """
+    vendor = field_value(fields, 'vendor') or field_value(fields, 'merchant_name')
+    number = field_value(fields, 'invoice_number') or field_value(fields, 'receipt_number')
+    total = field_value(fields, 'total')
+    # Results and stored rows carry the date's ISO form; rows extracted before it was kept are parsed
+    date_value = (fields.get('date') or {}).get('normalized') or field_value(fields, 'date')
+
+    vendor = normalize_vendor(vendor) if vendor is not None else ''
+    number = normalize_invoice_number(number) if number is not None else ''
+    cents = normalize_amount(total) if total is not None else None
+    date_value = normalize_date(date_value) if date_value is not None else None
+    if cents is None or date_value is None or not (vendor or number):
+        return None, False
+    return f"{vendor}|{number}|{cents}|{date_value}", bool(number)
+
+def text_minhash(text):
+    """Sign a document's text so texts sharing most of their word shingles share most signature values
+
+    Returns the signature as hex, or None for texts too short to compare.
+    """
+    words = re.findall(r'[a-z0-9]+', text.lower())
+    if len(words) < MINHASH_MIN_WORDS:
+        return None
+
+    shingles = {
+        int.from_bytes(hashlib.blake2b(' '.join(words[start:start + SHINGLE_WORDS]).encode('utf-8'), digest_size=8).digest(), 'big')
+        for start in range(len(words) - SHINGLE_WORDS + 1)
+    }
+    signature = [
+        min((a * shingle + b) % MERSENNE_PRIME for shingle in shingles) & 0xffffffff
+        for a, b in PERMUTATIONS
+    ]
+    return ''.join(f"{value:08x}" for value in signature)
+
+def signature_values(minhash):
+    """Split a hex MinHash signature into its values"""
+    return [minhash[start:start + 8] for start in range(0, len(minhash), 8)]
+
+def minhash_bands(minhash):
+    """Get the index keys of a signature's bands, each a 63-bit hash of the band's number and values"""
+    values = signature_values(minhash)
+    keys = []
+    for band, start in enumerate(range(0, len(values), BAND_ROWS)):
+        band_text = f"{band}:{''.join(values[start:start + BAND_ROWS])}"
+        keys.append(int.from_bytes(hashlib.blake2b(band_text.encode('utf-8'), digest_size=8).digest(), 'big') >> 1)
+    return keys
+
+def minhash_similarity(first, second):
+    """Estimate the Jaccard similarity of two texts' shingles from their signatures"""
+    first_values = signature_values(first)
+    second_values = signature_values(second)
+    return sum(1 for a, b in zip(first_values, second_values) if a == b) / len(first_values)
+
+def record_fingerprint(document_id, results):
+    """Store a processed document's duplicate keys so later documents can be checked against it"""
+    key, _ = exact_key(results)
+    minhash = field_value(results, 'text_minhash')
+    upsert_document_fingerprint(document_id, key, minhash, minhash_bands(minhash) if minhash else [])
+
+def find_duplicates(document_id, fields, minhash=None):
+    """Find earlier documents matching a document exactly or by nearly identical text
+
+    Only documents stored before this one count, so the later copy is the one flagged and
+    revalidating the original never reports its copies. Returns (exact, near, has_invoice_number): lists of document ids, nearest first for near.
+    """
+    key, has_invoice_number = exact_key(fields)
+    exact = find_fingerprints_by_key(key, document_id, Config.DUPLICATE_CANDIDATE_LIMIT) if key else []
+
+    near = {}
+    if minhash:
+        # Band matches are only candidates; the whole signature decides how similar they are
+        for row in find_fingerprints_by_bands(minhash_bands(minhash), document_id, Config.DUPLICATE_CANDIDATE_LIMIT):
+            if row['document_id'] in exact:
+                continue
+            similarity = minhash_similarity(minhash, row['minhash'])
+            if similarity >= Config.DUPLICATE_TEXT_MIN_SIMILARITY:
+                near[row['document_id']] = similarity
+    return exact, sorted(near, key=near.get, reverse=True), has_invoice_number
+
+def stored_minhash(document_id):
+    """Get the text signature recorded for a stored document, if it has one"""
+    fingerprint = get_document_fingerprint(document_id)
+    return fingerprint['minhash'] if fingerprint else None
+
+def duplicate_issues(exact, near, has_invoice_number):
+    """Describe the matches find_duplicates returned as validation issues"""
+    issues = []
+    if exact:
+        matched = 'vendor, invoice number, amount and date' if has_invoice_number else 'vendor, amount and date'
+        issues.append({
+            'issue_type': 'DUPLICATE',
+            # Without an invoice number, two same-day purchases of the same amount can be genuine
+            'severity': 'ERROR' if has_invoice_number else 'WARNING',
+            'rule': 'duplicate',
+            'description': f'Possible duplicate of document {", ".join(str(other) for other in exact)} (same {matched})'
+        })
+    if near:
+        issues.append({
+            'issue_type': 'DUPLICATE',
+            'severity': 'WARNING',
+            'rule': 'near_duplicate',
+            'description': f'Text nearly identical to document {", ".join(str(other) for other in near)}'
+        })
+    return issues
@@ -0,0 +1,145 @@
+import csv
+import json
+import os
+from datetime import datetime
+from itertools import groupby
+from database import iter_batch_pivot_rows, iter_batch_item_rows
+from dates import parse_date
+
+class _EchoBuffer:
+    """File-like object whose write returns the text, so csv.writer can format single rows"""
+
+    def write(self, value):
+        return value
+
+def stream_csv(header, row_chunks):
+    """Yield CSV text chunk by chunk: the header, then one chunk per fetched batch of rows"""
+    writer = csv.writer(_EchoBuffer())
+    yield writer.writerow(header)
+    for rows in row_chunks:
+        yield ''.join(writer.writerow(row) for row in rows)
+
+def stream_ndjson(row_chunks):
+    """Yield newline-delimited JSON, one object per row"""
+    for rows in row_chunks:
+        yield ''.join(json.dumps(dict(row)) + '\n' for row in rows)
+
+def stream_ndjson_documents(row_chunks):
+    """Yield newline-delimited JSON, one object per document with its fields collected"""
+    current = None
+    for rows in row_chunks:
+        lines = []
+        for document_id, document_rows in groupby(rows, key=lambda row: row['document_id']):
+            document_rows = list(document_rows)
+            # A document's rows can straddle two fetched chunks
+            if current is not None and current['document_id'] == document_id:
+                record = current
+            else:
+                if current is not None:
+                    lines.append(json.dumps(current) + '\n')
+                record = current = {
+                    'document_id': document_id,
+                    'filename': document_rows[0]['filename'],
+                    'results': {}
+                }
+            for row in document_rows:
+                if row['field_name'] is not None:
+                    record['results'][row['field_name']] = {
+                        'value': row['field_value'],
+                        'confidence': row['confidence_score']
+                    }
+        if lines:
+            yield ''.join(lines)
+    if current is not None:
+        yield json.dumps(current) + '\n'
+
+# Wide columnar export: one column per field (plus its confidence), typed for analytics
+COLUMNAR_FIELDS = [
+    ('invoice_number', 'string'), ('receipt_number', 'string'), ('vendor', 'string'),
+    ('merchant_name', 'string'), ('location', 'string'), ('date', 'date'), ('time', 'string'),
+    ('subtotal', 'amount'), ('tax', 'amount'), ('tip', 'amount'), ('total', 'amount'),
+    ('payment_method', 'string'), ('category', 'string'), ('cashier_name', 'string')
+]
+
+COLUMNAR_FORMATS = {'parquet': '.parquet', 'arrow': '.arrow'}
+
+def _import_pyarrow():
+    """Import pyarrow, which is only needed for columnar exports"""
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise Exception("Columnar export requires pyarrow (pip install pyarrow)")
+    return pyarrow
+
+def parse_timestamp(value):
+    """Parse a SQLite CURRENT_TIMESTAMP string"""
+    return datetime.fromisoformat(value) if value else None
+
+def document_schema(pa):
+    """Arrow schema of the wide per-document table"""
+    types = {'string': pa.string(), 'date': pa.date32(), 'amount': pa.float64()}
+    fields = [
+        pa.field('document_id', pa.int64()), pa.field('filename', pa.string()),
+        pa.field('document_type', pa.string()), pa.field('status', pa.string()),
+        pa.field('upload_date', pa.timestamp('s'))
+    ]
+    for name, kind in COLUMNAR_FIELDS:
+        fields.append(pa.field(name, types[kind]))
+        fields.append(pa.field(f'{name}_confidence', pa.float64()))
+    return pa.schema(fields)
+
+def item_schema(pa):
+    """Arrow schema of the receipt items table"""
+    return pa.schema([
+        pa.field('document_id', pa.int64()), pa.field('filename', pa.string()),
+        pa.field('item_name', pa.string()), pa.field('quantity', pa.float64()),
+        pa.field('unit_price', pa.float64()), pa.field('total_price', pa.float64())
+    ])
+
+def _record_batch(pa, schema, rows, converters):
+    """Turn a chunk of SQLite rows into an Arrow record batch, column by column"""
+    columns = list(zip(*rows))
+    arrays = []
+    for field, column in zip(schema, columns):
+        converter = converters.get(field.name)
+        if converter is not None:
+            column = [converter(value) for value in column]
+        arrays.append(pa.array(column, type=field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+def _write_table(pa, path, format_type, schema, row_chunks, converters):
+    """Write streamed rows to a Parquet or Arrow IPC file one chunk at a time"""
+    if format_type == 'parquet':
+        writer = pa.parquet.ParquetWriter(path, schema)
+        write = lambda batch: writer.write_table(pa.Table.from_batches([batch]))
+    else:
+        writer = pa.ipc.new_file(path, schema)
+        write = writer.write_batch
+    try:
+        for rows in row_chunks:
+            write(_record_batch(pa, schema, rows, converters))
+    finally:
+        writer.close()
+
+def write_columnar_batch(batch_id, directory, format_type='parquet'):
+    """Write a batch's documents and receipt items as typed columnar files, returning their paths"""
+    if format_type not in COLUMNAR_FORMATS:
+        raise Exception(f"Unsupported columnar format: {format_type}")
+    pa = _import_pyarrow()
+    extension = COLUMNAR_FORMATS[format_type]
+    
+    fields = [name for name, _ in COLUMNAR_FIELDS]
+    amount_fields = {name for name, kind in COLUMNAR_FIELDS if kind == 'amount'}
+    date_converters = {name: parse_date for name, kind in COLUMNAR_FIELDS if kind == 'date'}
+    date_converters['upload_date'] = parse_timestamp
+    
+    documents_path = os.path.join(directory, f'documents{extension}')
+    _write_table(pa, documents_path, format_type, document_schema(pa),
+                 iter_batch_pivot_rows(batch_id, fields, amount_fields), date_converters)
+    
+    items_path = os.path.join(directory, f'receipt_items{extension}')
+    _write_table(pa, items_path, format_type, item_schema(pa), iter_batch_item_rows(batch_id), {})
+    
+    return [documents_path, items_path]
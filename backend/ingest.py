@@ -0,0 +1,224 @@
+"""Bulk-ingest documents from directory trees and zip archives.
+
+Run from the backend directory, e.g. ``python ingest.py /data/receipts-2023 --workers 8``.
+Re-running the same command after an interruption skips files that were already ingested.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from config import Config
+from database import (
+    init_db, transaction, insert_document, update_document_status, insert_batch_job,
+    get_batch_job, finalize_batch_total, record_batch_result, get_ingest_statuses,
+    record_ingest_file
+)
+from pipeline import store_document_results
+from archives import ArchiveLimitError, archive_members, member_filename, copy_member
+from processing import process_document
+
+# Documents ingest can process (zip archives are expanded, not processed)
+DOCUMENT_EXTENSIONS = {'.pdf', '.png', '.jpg', '.jpeg'}
+
+# The archive a worker process is reading members from, so its central directory is parsed once
+_open_archive = {}
+
+def is_document(name):
+    """Check whether a file name has a processable document extension"""
+    return os.path.splitext(name)[1].lower() in DOCUMENT_EXTENSIONS
+
+def iter_sources(paths):
+    """Yield (source, path, member) for every document under the given files and directories, member being a zip entry's ZipInfo"""
+    for path in paths:
+        path = os.path.abspath(path)
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    yield from iter_file_sources(os.path.join(root, name))
+        else:
+            yield from iter_file_sources(path)
+
+def iter_file_sources(path):
+    """Yield the documents in one file: the file itself, or the members of a zip"""
+    if path.lower().endswith('.zip'):
+        try:
+            with zipfile.ZipFile(path) as archive:
+                members = archive_members(archive)
+        except (zipfile.BadZipFile, ArchiveLimitError) as e:
+            print(f"Skipping archive {path}: {str(e)}", file=sys.stderr)
+            return
+        for info in members:
+            if is_document(info.filename):
+                yield f"{path}!{info.filename}", path, info
+    elif is_document(path):
+        yield path, path, None
+
+def init_worker():
+    """Set up an ingest worker process"""
+    # Files are already processed in parallel, so each worker OCRs its pages serially
+    Config.OCR_WORKERS = 1
+
+def open_archive(path):
+    """Get this worker's handle on a zip archive, opening it only when the worker moves on to a new one"""
+    if _open_archive.get('path') != path:
+        # Sources are listed archive by archive, so the previous one is finished with
+        if _open_archive:
+            _open_archive['archive'].close()
+            _open_archive.clear()
+        _open_archive['archive'] = zipfile.ZipFile(path)
+        _open_archive['path'] = path
+    return _open_archive['archive']
+
+def ingest_one(source, path, member):
+    """Process one document in a worker, returning (source, results, error, elapsed)"""
+    start = time.perf_counter()
+    try:
+        if member is None:
+            results = process_document(path)
+        else:
+            # Stream the member out so the document keeps its name and extension
+            with tempfile.TemporaryDirectory() as temp_dir:
+                target = os.path.join(temp_dir, member_filename(member.filename))
+                copy_member(open_archive(path), member, target)
+                results = process_document(target)
+        return source, results, None, time.perf_counter() - start
+    except Exception as e:
+        return source, None, str(e), time.perf_counter() - start
+
+def commit_results(batch_id, finished):
+    """Store a group of finished documents in one transaction, returning how many succeeded"""
+    succeeded = 0
+    with transaction():
+        for source, filename, results, error, elapsed in finished:
+            doc_id = insert_document(filename, 'unknown', batch_id)
+            if error is None:
+                try:
+                    # Runs in a savepoint, so a failure only undoes this document
+                    store_document_results(doc_id, results)
+                except Exception as e:
+                    error = str(e)
+            if error is None:
+                succeeded += 1
+            else:
+                update_document_status(doc_id, 'failed')
+            record_ingest_file(source, doc_id, 'completed' if error is None else 'failed', error, elapsed)
+            record_batch_result(batch_id, error is None)
+    return succeeded
+
+class IngestReport:
+    """Running counts and throughput of an ingest run"""
+
+    def __init__(self, batch_id, interval):
+        self.batch_id = batch_id
+        self.interval = interval
+        self.start = time.perf_counter()
+        self.last_report = self.start
+        self.completed = 0
+        self.failed = 0
+        self.skipped = 0
+
+    def add(self, total, succeeded):
+        self.completed += succeeded
+        self.failed += total - succeeded
+        now = time.perf_counter()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            print(self.summary(), flush=True)
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start
+        done = self.completed + self.failed
+        rate = done / elapsed if elapsed else 0.0
+        return (f"{done} files in {elapsed:.1f}s ({rate:.1f} files/s): "
+                f"{self.completed} completed, {self.failed} failed, {self.skipped} already ingested")
+
+def pending_sources(sources, retry_failed, report, lookup_size=500):
+    """Filter out sources a previous run already ingested"""
+    chunk = []
+
+    def unfinished(chunk):
+        statuses = get_ingest_statuses([source for source, _, _ in chunk])
+        for item in chunk:
+            status = statuses.get(item[0])
+            if status == 'completed' or (status == 'failed' and not retry_failed):
+                report.skipped += 1
+            else:
+                yield item
+
+    for item in sources:
+        chunk.append(item)
+        if len(chunk) >= lookup_size:
+            yield from unfinished(chunk)
+            chunk = []
+    if chunk:
+        yield from unfinished(chunk)
+
+def ingest(paths, workers=None, commit_every=None, batch_id=None, user_id=1, retry_failed=False, report_interval=5.0):
+    """Ingest every document under paths into the database, returning the run's report"""
+    workers = workers or Config.INGEST_WORKERS
+    commit_every = commit_every or Config.INGEST_COMMIT_EVERY
+    init_db()
+    if batch_id is not None and get_batch_job(batch_id) is None:
+        raise Exception(f"Batch job not found: {batch_id}")
+
+    report = IngestReport(batch_id, report_interval)
+    filenames = {}
+    finished = []
+
+    def flush():
+        # The batch is created with the first commit, so a run with nothing new leaves no empty batch
+        if report.batch_id is None:
+            report.batch_id = insert_batch_job(user_id, 0)
+        report.add(len(finished), commit_results(report.batch_id, finished))
+        finished.clear()
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+        in_flight = set()
+
+        def collect(futures):
+            for future in futures:
+                source, results, error, elapsed = future.result()
+                finished.append((source, filenames.pop(source), results, error, elapsed))
+            if len(finished) >= commit_every:
+                flush()
+
+        for source, path, member in pending_sources(iter_sources(paths), retry_failed, report):
+            filenames[source] = member_filename(member.filename) if member else os.path.basename(path)
+            in_flight.add(executor.submit(ingest_one, source, path, member))
+            # Keep a bounded number of files queued so memory stays flat for any tree size
+            if len(in_flight) >= workers * 4:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+        collect(in_flight)
+
+    if finished:
+        flush()
+
+    if report.batch_id is not None:
+        # Every file of the batch is accounted for, so its total is what it has processed
+        batch_job = get_batch_job(report.batch_id)
+        finalize_batch_total(report.batch_id, batch_job['processed_files'] + batch_job['failed_files'], 0)
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('paths', nargs='+', help='files, directories or zip archives to ingest')
+    parser.add_argument('--workers', type=int, default=Config.INGEST_WORKERS, help='processes running OCR and extraction')
+    parser.add_argument('--commit-every', type=int, default=Config.INGEST_COMMIT_EVERY, help='documents stored per transaction')
+    parser.add_argument('--batch-id', type=int, help='add documents to an existing batch instead of creating one')
+    parser.add_argument('--user-id', type=int, default=1, help='owner of the new batch')
+    parser.add_argument('--retry-failed', action='store_true', help='retry files that failed in a previous run')
+    args = parser.parse_args()
+
+    report = ingest(args.paths, args.workers, args.commit_every, args.batch_id, args.user_id, args.retry_failed)
+    if report.batch_id is None:
+        print(f"Nothing new to ingest: {report.summary()}")
+    else:
+        print(f"Batch {report.batch_id}: {report.summary()}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+import json
+import os
+import socket
+import sys
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from config import Config
+from database import (
+    enqueue_job, claim_next_job, fail_abandoned_jobs, renew_job_leases, finish_job
+)
+
+# Registry of task functions that can be queued by name, and what to do when one raises
+_tasks = {}
+_failure_handlers = {}
+
+_queue = None
+_queue_lock = threading.Lock()
+
+def task(name, on_failure=None):
+    """Register a function as a queueable task
+    
+    on_failure(error, **kwargs) is called with the job's arguments when the task raises, so
+    whatever it was working on is marked failed rather than left in progress.
+    """
+    def decorator(func):
+        _tasks[name] = func
+        if on_failure is not None:
+            _failure_handlers[name] = on_failure
+        return func
+    return decorator
+
+def handle_failure(name, kwargs, error):
+    """Log a job that raised and run its task's failure handler"""
+    print(f"Job {name} failed: {str(error)}", file=sys.stderr)
+    handler = _failure_handlers.get(name)
+    if handler is None:
+        return
+    try:
+        handler(str(error), **kwargs)
+    except Exception as e:
+        print(f"Failure handler for job {name} failed: {str(e)}", file=sys.stderr)
+
+def _on_done(name, kwargs):
+    """Build a future callback passing a job's exception to handle_failure"""
+    def callback(future):
+        if not future.cancelled() and future.exception() is not None:
+            handle_failure(name, kwargs, future.exception())
+    return callback
+
+def get_task(name):
+    """Look up a registered task function"""
+    if name not in _tasks:
+        raise Exception(f"Unknown task: {name}")
+    return _tasks[name]
+
+class JobQueue:
+    """Base class for local job queues"""
+
+    def submit(self, name, **kwargs):
+        """Queue a registered task for execution"""
+        raise NotImplementedError
+
+    def shutdown(self, wait=True):
+        """Stop accepting jobs and release the workers"""
+        pass
+
+class InlineJobQueue(JobQueue):
+    """Run jobs immediately in the calling thread (useful for tests and debugging)"""
+
+    def submit(self, name, **kwargs):
+        get_task(name)(**kwargs)
+
+class ThreadJobQueue(JobQueue):
+    """Run jobs on an in-process thread pool"""
+
+    def __init__(self, workers):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job-worker')
+
+    def submit(self, name, **kwargs):
+        future = self.executor.submit(get_task(name), **kwargs)
+        future.add_done_callback(_on_done(name, kwargs))
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+class ProcessJobQueue(JobQueue):
+    """Run jobs on a process pool so CPU-bound OCR uses every core"""
+
+    def __init__(self, workers):
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+
+    def submit(self, name, **kwargs):
+        # Task functions are module-level, so they pickle by reference
+        future = self.executor.submit(get_task(name), **kwargs)
+        # Runs in this process, so a worker that died mid-job is reported too
+        future.add_done_callback(_on_done(name, kwargs))
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+class SQLiteJobQueue(JobQueue):
+    """Durable queue backed by the job_queue table and drained by worker threads"""
+
+    def __init__(self, workers, poll_interval, lease_seconds=None, max_attempts=None):
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds or Config.JOB_QUEUE_LEASE_SECONDS
+        self.max_attempts = max_attempts or Config.JOB_QUEUE_MAX_ATTEMPTS
+        # Names this queue's claims; other processes only take over jobs whose lease has lapsed,
+        # which is how jobs left running by a process that died are retried
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._worker, name=f'job-worker-{i}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        self.heartbeat = threading.Thread(target=self._renew_leases, name='job-heartbeat', daemon=True)
+        self.heartbeat.start()
+
+    def submit(self, name, **kwargs):
+        get_task(name)  # Fail fast on unknown tasks
+        enqueue_job(name, json.dumps(kwargs))
+        self.wakeup.set()
+
+    def _worker(self):
+        while not self.stopping.is_set():
+            try:
+                # Jobs that keep killing their worker are failed rather than run again
+                for abandoned in fail_abandoned_jobs(self.max_attempts):
+                    handle_failure(abandoned['task'], json.loads(abandoned['payload']), abandoned['error'])
+                job = claim_next_job(self.owner, self.lease_seconds, self.max_attempts)
+            except Exception as e:
+                # A locked or unavailable database should not kill the worker
+                print(f"Could not claim a job: {str(e)}", file=sys.stderr)
+                job = None
+            if job is None:
+                self.wakeup.wait(self.poll_interval)
+                self.wakeup.clear()
+                continue
+
+            kwargs = json.loads(job['payload'])
+            try:
+                get_task(job['task'])(**kwargs)
+                finish_job(job['id'], self.owner, 'completed')
+            except Exception as e:
+                finish_job(job['id'], self.owner, 'failed', str(e))
+                handle_failure(job['task'], kwargs, e)
+
+    def _renew_leases(self):
+        # Renewing at a third of the lease leaves room for a slow or locked write
+        while not self.stopping.wait(self.lease_seconds / 3):
+            try:
+                renew_job_leases(self.owner, self.lease_seconds)
+            except Exception as e:
+                print(f"Could not renew job leases: {str(e)}", file=sys.stderr)
+
+    def shutdown(self, wait=True):
+        self.stopping.set()
+        self.wakeup.set()
+        if wait:
+            for thread in self.threads + [self.heartbeat]:
+                thread.join()
+
+def create_job_queue(backend=None, workers=None):
+    """Create a job queue for the given backend name"""
+    backend = backend or Config.JOB_QUEUE_BACKEND
+    workers = workers or Config.JOB_QUEUE_WORKERS
+
+    if backend == 'inline':
+        return InlineJobQueue()
+    elif backend == 'thread':
+        return ThreadJobQueue(workers)
+    elif backend == 'process':
+        return ProcessJobQueue(workers)
+    elif backend == 'sqlite':
+        return SQLiteJobQueue(workers, Config.JOB_QUEUE_POLL_INTERVAL)
+    else:
+        raise Exception(f"Unsupported job queue backend: {backend}")
+
+def get_job_queue():
+    """Get the shared job queue, creating it on first use"""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = create_job_queue()
+        return _queue
+
+def set_job_queue(queue):
+    """Replace the shared job queue, shutting down the previous one"""
+    global _queue
+    with _queue_lock:
+        previous, _queue = _queue, queue
+    if previous is not None and previous is not queue:
+        previous.shutdown(wait=False)
@@ -0,0 +1,176 @@
+import json
+import os
+import threading
+from collections import deque
+from config import Config
+
+# Keyword tables: table name -> {group name -> keywords}. Group order matters where
+# callers take the first group that matches (payment methods, expense categories).
+DEFAULT_KEYWORD_TABLES = {
+    'document_indicators': {
+        'receipt': [
+            'thank you', 'cash', 'credit', 'debit', 'total', 'subtotal', 'tax',
+            'change', 'balance', 'paid', 'tender', 'transaction', 'store',
+            'grocery', 'gas', 'restaurant', 'tip', 'gratuity', 'order confirmation',
+            'order number', 'shipment', 'delivery', 'tracking', 'confirmation #'
+        ],
+        'invoice': [
+            'invoice', 'bill to', 'due date', 'terms', 'invoice #', 'inv-',
+            'amount due', 'balance due', 'payment due', 'remittance', 'po number',
+            'purchase order', 'bill for', 'invoice date'
+        ]
+    },
+    'payment_methods': {
+        'cash': ['cash', 'cashier'],
+        'credit': ['credit', 'visa', 'mastercard', 'amex', 'discover', 'credit card'],
+        'debit': ['debit', 'debit card'],
+        'check': ['check', 'cheque'],
+        'paypal': ['paypal'],
+        'digital wallet': ['apple pay', 'google pay', 'samsung pay']
+    },
+    'expense_categories': {
+        'Food & Dining': ['restaurant', 'cafe', 'coffee', 'food', 'dining', 'meal', 'burger', 'pizza', 'steak', 'mcdonalds', 'starbucks', 'subway'],
+        'Grocery': ['grocery', 'market', 'supermarket', 'food store', 'whole foods', 'kroger', 'walmart', 'costco', 'aldi', 'target'],
+        'Transportation': ['gas', 'fuel', 'station', 'parking', 'uber', 'taxi', 'bus', 'train', 'airline', 'shell', 'bp', 'exxon'],
+        'Office Supplies': ['office', 'staples', 'office depot', 'paper', 'pen', 'printer', 'staples', 'best buy'],
+        'Travel': ['hotel', 'motel', 'airbnb', 'flight', 'airline', 'travel', 'booking', 'marriott', 'hilton'],
+        'Entertainment': ['movie', 'cinema', 'theater', 'concert', 'event', 'ticket', 'amusement', 'netflix', 'spotify'],
+        'Online Services': ['amazon', 'ebay', 'paypal', 'subscription', 'monthly fee', 'service charge']
+    },
+    'vendor_types': {
+        'restaurant': ['restaurant', 'cafe', 'coffee', 'diner', 'bar', 'grill'],
+        'gas': ['gas', 'fuel', 'shell', 'bp', 'exxon', 'chevron'],
+        'grocery': ['grocery', 'market', 'supermarket', 'walmart', 'costco', 'aldi', 'kroger']
+    }
+}
+
+_index = None
+_index_lock = threading.Lock()
+
+class KeywordAutomaton:
+    """Aho-Corasick automaton that finds every keyword occurring in a text in one pass"""
+
+    def __init__(self, keywords):
+        self.keywords = list(dict.fromkeys(keyword for keyword in keywords if keyword))
+
+        # Build the keyword trie
+        transitions = [{}]
+        outputs = [set()]
+        for keyword in self.keywords:
+            state = 0
+            for char in keyword:
+                if char not in transitions[state]:
+                    transitions.append({})
+                    outputs.append(set())
+                    transitions[state][char] = len(transitions) - 1
+                state = transitions[state][char]
+            outputs[state].add(keyword)
+
+        # Breadth-first pass adding failure links, folding each state's fallback
+        # transitions and outputs into it so scanning never has to follow a link
+        failure = [0] * len(transitions)
+        queue = deque(transitions[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in list(transitions[state].items()):
+                queue.append(next_state)
+                fallback = failure[state]
+                while fallback and char not in transitions[fallback]:
+                    fallback = failure[fallback]
+                target = transitions[fallback].get(char, 0)
+                failure[next_state] = target if target != next_state else 0
+                outputs[next_state] |= outputs[failure[next_state]]
+            for char, next_state in transitions[failure[state]].items():
+                transitions[state].setdefault(char, next_state)
+
+        self.transitions = transitions
+        self.outputs = [frozenset(output) if output else None for output in outputs]
+
+    def find(self, text):
+        """Return the set of keywords that occur anywhere in text"""
+        transitions = self.transitions
+        outputs = self.outputs
+        found = set()
+        state = 0
+        for char in text:
+            # Every state carries its fallback transitions, so a miss always means the root
+            state = transitions[state].get(char, 0)
+            if outputs[state] is not None:
+                found |= outputs[state]
+        return found
+
+class KeywordIndex:
+    """One automaton over every keyword table, reporting hits per table and group"""
+
+    def __init__(self, tables):
+        self.tables = tables
+
+        # Where each keyword lives, since one keyword can appear in several tables
+        self.locations = {}
+        for table, groups in tables.items():
+            for group, keywords in groups.items():
+                for keyword in keywords:
+                    self.locations.setdefault(keyword, []).append((table, group))
+        self.automaton = KeywordAutomaton(self.locations)
+        self.group_sizes = {
+            (table, group): len(set(keywords))
+            for table, groups in tables.items()
+            for group, keywords in groups.items()
+        }
+
+    def scan(self, text_lower):
+        """Scan lowercased text once and return {table: {group: set of keywords found}}"""
+        hits = {table: {} for table in self.tables}
+        for keyword in self.automaton.find(text_lower):
+            for table, group in self.locations[keyword]:
+                hits[table].setdefault(group, set()).add(keyword)
+        return hits
+
+    def first_group(self, hits, table):
+        """Get the first group of a table, in table order, that has any hits"""
+        table_hits = hits[table]
+        if table_hits:
+            for group in self.tables[table]:
+                if group in table_hits:
+                    return group
+        return None
+
+    def group_size(self, table, group):
+        """Get the number of distinct keywords in a group"""
+        return self.group_sizes[(table, group)]
+
+def merge_keyword_tables(base, extra):
+    """Extend keyword tables with extra keywords and groups, keeping group order"""
+    merged = {table: {group: list(keywords) for group, keywords in groups.items()} for table, groups in base.items()}
+    for table, groups in extra.items():
+        merged_groups = merged.setdefault(table, {})
+        for group, keywords in groups.items():
+            merged_keywords = merged_groups.setdefault(group, [])
+            merged_keywords.extend(keyword.lower() for keyword in keywords if keyword.lower() not in merged_keywords)
+    return merged
+
+def load_keyword_tables(path=None):
+    """Get the default keyword tables extended with any configured keyword file"""
+    path = path or Config.KEYWORD_TABLES_PATH
+    if not path or not os.path.exists(path):
+        return DEFAULT_KEYWORD_TABLES
+    try:
+        with open(path, 'r', encoding='utf-8') as file:
+            return merge_keyword_tables(DEFAULT_KEYWORD_TABLES, json.load(file))
+    except (OSError, ValueError) as e:
+        raise Exception(f"Failed to load keyword tables from {path}: {str(e)}")
+
+def get_keyword_index():
+    """Get the shared keyword index, building it on first use"""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = KeywordIndex(load_keyword_tables())
+        return _index
+
+def reload_keyword_index():
+    """Rebuild the shared keyword index after the keyword file changes"""
+    global _index
+    with _index_lock:
+        _index = KeywordIndex(load_keyword_tables())
+        return _index
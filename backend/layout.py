@@ -0,0 +1,161 @@
+import re
+from array import array
+
+# A price column entry, e.g. "$11.98", "11.98" or "1,299.00"
+PRICE_TOKEN = re.compile(r'^\$?(\d{1,3}(?:,\d{3})*|\d+)\.(\d{2})$')
+# A quantity, e.g. "2", "2x", "x2" or "2.5"
+QUANTITY_TOKEN = re.compile(r'^(?:[xX])?(\d+(?:\.\d+)?)(?:[xX@])?$')
+# Rows naming these are summary lines rather than items
+SUMMARY_WORDS = {
+    'total', 'subtotal', 'sub-total', 'tax', 'vat', 'gst', 'tip', 'gratuity', 'change', 'balance',
+    'due', 'cash', 'credit', 'debit', 'visa', 'mastercard', 'amex', 'tender', 'paid', 'shipping', 'discount'
+}
+
+class WordBoxes:
+    """Words from OCR with their bounding boxes, stored column-wise in flat arrays"""
+
+    def __init__(self):
+        self.words = []
+        self.left = array('i')
+        self.top = array('i')
+        self.width = array('i')
+        self.height = array('i')
+        self.confidence = array('f')
+        # Tesseract's line of each word, numbered in reading order, and the lines that start a paragraph
+        self.line = array('i')
+        self.paragraph_starts = set()
+        self.line_count = 0
+        self.page_height = 0
+
+    def __len__(self):
+        return len(self.words)
+
+    @classmethod
+    def from_tsv(cls, tsv, page_height=0):
+        """Build word boxes from Tesseract's TSV output (image_to_data)"""
+        boxes = cls()
+        boxes.page_height = page_height
+        last_line = None
+        last_paragraph = None
+        for row in tsv.splitlines():
+            fields = row.split('\t')
+            # Only level 5 rows are words; the header and page/block/line rows are skipped
+            if len(fields) < 12 or fields[0] != '5' or not fields[11].strip():
+                continue
+            paragraph = (fields[1], fields[2], fields[3])
+            line = paragraph + (fields[4],)
+            if line != last_line:
+                if paragraph != last_paragraph:
+                    boxes.paragraph_starts.add(boxes.line_count)
+                boxes.line_count += 1
+                last_line = line
+                last_paragraph = paragraph
+            boxes.words.append(fields[11].strip())
+            boxes.left.append(int(fields[6]))
+            boxes.top.append(int(fields[7]))
+            boxes.width.append(int(fields[8]))
+            boxes.height.append(int(fields[9]))
+            boxes.confidence.append(float(fields[10]))
+            boxes.line.append(boxes.line_count - 1)
+        return boxes
+
+    def extend(self, other, y_offset=0):
+        """Append another set of boxes, shifted down by y_offset (a region's top, or the pages above)"""
+        self.words.extend(other.words)
+        self.left.extend(other.left)
+        self.top.extend(array('i', (top + y_offset for top in other.top)))
+        self.width.extend(other.width)
+        self.height.extend(other.height)
+        self.confidence.extend(other.confidence)
+        self.line.extend(array('i', (line + self.line_count for line in other.line)))
+        # Each appended region or page starts a new paragraph
+        self.paragraph_starts.add(self.line_count)
+        self.paragraph_starts.update(line + self.line_count for line in other.paragraph_starts)
+        self.line_count += other.line_count
+        self.page_height = max(self.page_height, y_offset + other.page_height)
+
+    def text(self):
+        """Rebuild plain text in Tesseract's reading order: one line per line, a blank line between paragraphs"""
+        lines = [[] for _ in range(self.line_count)]
+        for word, line in zip(self.words, self.line):
+            lines[line].append(word)
+        output = []
+        for number, words in enumerate(lines):
+            if number in self.paragraph_starts and output:
+                output.append('')
+            output.append(' '.join(words))
+        return '\n'.join(output)
+
+    def rows(self):
+        """Group words into visual rows by their vertical position, each row ordered left to right"""
+        centers = [top + height / 2 for top, height in zip(self.top, self.height)]
+        rows = []
+        row = []
+        row_center = row_height = 0.0
+        for index in sorted(range(len(self.words)), key=centers.__getitem__):
+            # A word belongs to the current row while its center sits within half a line of the row's
+            if row and abs(centers[index] - row_center) <= row_height / 2:
+                row.append(index)
+                row_center += (centers[index] - row_center) / len(row)
+                row_height = max(row_height, self.height[index])
+            else:
+                if row:
+                    rows.append(sorted(row, key=self.left.__getitem__))
+                row = [index]
+                row_center = centers[index]
+                row_height = self.height[index]
+        if row:
+            rows.append(sorted(row, key=self.left.__getitem__))
+        return [[self.words[index] for index in row] for row in rows]
+
+def parse_price(token):
+    """Parse a price token, or None if it is not one"""
+    match = PRICE_TOKEN.match(token)
+    if not match:
+        return None
+    return float(f"{match.group(1).replace(',', '')}.{match.group(2)}")
+
+def layout_line_items(boxes):
+    """Read line items from rows of word boxes: a name on the left, then an optional quantity and prices"""
+    items = []
+    for words in boxes.rows():
+        prices = [parse_price(word) for word in words]
+        if prices[-1] is None:
+            continue
+
+        # The name runs up to the first number on the row
+        name_words = []
+        for word in words:
+            if QUANTITY_TOKEN.match(word) or parse_price(word) is not None:
+                break
+            name_words.append(word)
+        if not any(char.isalpha() for word in name_words for char in word):
+            continue
+        if any(word.lower().strip(':') in SUMMARY_WORDS for word in name_words):
+            continue
+
+        quantity = 1.0
+        for word in words[len(name_words):]:
+            match = QUANTITY_TOKEN.match(word)
+            if match and parse_price(word) is None:
+                # A zero is a misread or a placeholder, not a quantity to divide the price by
+                if float(match.group(1)) > 0:
+                    quantity = float(match.group(1))
+                break
+
+        row_prices = [price for price in prices if price is not None]
+        total_price = row_prices[-1]
+        if len(row_prices) > 1:
+            unit_price = row_prices[-2]
+            # "Coffee 2.50 5.00" has no quantity column, but the prices imply one
+            if quantity == 1.0 and unit_price and abs(total_price / unit_price - round(total_price / unit_price)) < 0.01:
+                quantity = float(round(total_price / unit_price))
+        else:
+            unit_price = round(total_price / quantity, 2)
+        items.append({
+            'item_name': ' '.join(name_words),
+            'quantity': quantity,
+            'unit_price': unit_price,
+            'total_price': total_price
+        })
+    return items
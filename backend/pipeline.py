@@ -0,0 +1,68 @@
+from database import transaction, save_document_results, finish_document
+from validation import validate_results
+from duplicates import record_fingerprint
+
+# Results that describe the document rather than an extracted field, so are not stored as extractions
+DOCUMENT_FIELDS = ('document_type', 'text_minhash')
+
+def results_to_records(results):
+    """Split process_document results into (document_type, extractions, receipt_details, receipt_items)"""
+    doc_type = results.get('document_type', {}).get('value', 'unknown')
+    
+    # Collect extraction results (document_type and the text fingerprint are stored separately)
+    extractions = [
+        (field_name, data.get('value'), data.get('confidence', 0.0), data.get('normalized'))
+        for field_name, data in results.items()
+        if field_name not in DOCUMENT_FIELDS
+    ]
+    
+    # Collect receipt-specific data if it's a receipt
+    receipt_details = None
+    receipt_items = []
+    if doc_type == 'receipt':
+        receipt_details = {
+            'merchant_name': results.get('merchant_name', {}).get('value'),
+            'location': results.get('location', {}).get('value'),
+            'payment_method': results.get('payment_method', {}).get('value'),
+            'tip_amount': results.get('tip', {}).get('value'),
+            'subtotal': results.get('subtotal', {}).get('value'),
+            'tax_amount': results.get('tax', {}).get('value'),
+            'total_amount': results.get('total', {}).get('value'),
+            'cashier_name': results.get('cashier_name', {}).get('value'),
+            'transaction_time': results.get('time', {}).get('value'),
+            'category': results.get('category', {}).get('value')
+        }
+        
+        line_items = results.get('line_items', {}).get('value') or []
+        receipt_items = [
+            {
+                'item_name': item.get('item_name', ''),
+                'quantity': item.get('quantity', 1.0),
+                'unit_price': item.get('unit_price', 0.0),
+                'total_price': item.get('total_price', 0.0)
+            }
+            for item in line_items if isinstance(item, dict)
+        ]
+    
+    return doc_type, extractions, receipt_details, receipt_items
+
+def store_document_results(doc_id, results, batch_id=None):
+    """Validate a processed document's results and save them with their issues, marking it completed
+    
+    The document is counted against batch_id in the same transaction. Returns False, writing
+    nothing, when the document had already finished, so a job that runs twice stores it once.
+    """
+    doc_type, extractions, receipt_details, receipt_items = results_to_records(results)
+    minhash = results.get('text_minhash', {}).get('value')
+    
+    # Write everything in one transaction so a document's results appear atomically
+    with transaction():
+        if not finish_document(doc_id, 'completed', batch_id):
+            return False
+        # Validation works on the results in memory; the transaction is opened first so
+        # duplicate lookups and this document's fingerprint are serialized with other writers
+        validation_issues, validation_state = validate_results(doc_id, extractions, receipt_details, receipt_items, minhash)
+        save_document_results(doc_id, doc_type, extractions, receipt_details, receipt_items,
+                              validation_issues, validation_state=validation_state)
+        record_fingerprint(doc_id, results)
+    return True
@@ -0,0 +1,90 @@
+import time
+from PIL import Image, ImageChops, ImageFilter, ImageOps
+from config import Config
+
+# Width deskew angles are searched at; the projection profile is clear long before full resolution
+DESKEW_SEARCH_WIDTH = 800
+
+def exif_transpose(image, source_dpi=None):
+    """Rotate a photo upright according to its EXIF orientation tag"""
+    return ImageOps.exif_transpose(image)
+
+def to_grayscale(image, source_dpi=None):
+    """Drop color, which Tesseract does not use, to a third of the pixels"""
+    return image if image.mode == 'L' else image.convert('L')
+
+def image_dpi(image, source_dpi=None):
+    """Get an image's resolution from the caller, its metadata or the assumed page size"""
+    if source_dpi:
+        return source_dpi
+    # 72 and 96 DPI are placeholders cameras and editors write, not a real scan resolution
+    dpi = image.info.get('dpi')
+    if dpi and dpi[0] > 96:
+        return float(dpi[0])
+    # Phone photos carry no real DPI, so assume the long side spans a page
+    return max(image.size) / Config.OCR_ASSUMED_PAGE_INCHES
+
+def resize_to_dpi(image, source_dpi=None):
+    """Downscale an image to the OCR target DPI (never upscales)"""
+    scale = Config.OCR_TARGET_DPI / image_dpi(image, source_dpi)
+    if scale >= 0.95:
+        return image
+    size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    return image.resize(size, Image.LANCZOS, reducing_gap=2.0)
+
+def adaptive_threshold(image, source_dpi=None):
+    """Binarize against the local mean, so shadows and uneven lighting do not swallow text"""
+    gray = to_grayscale(image)
+    local_mean = gray.filter(ImageFilter.BoxBlur(Config.OCR_THRESHOLD_WINDOW // 2))
+
+    # Pixels darker than their neighbourhood by more than the offset are ink
+    darker_by = ImageChops.subtract(local_mean, gray)
+    offset = Config.OCR_THRESHOLD_OFFSET
+    return darker_by.point([255 if value <= offset else 0 for value in range(256)])
+
+def estimate_skew(image, max_angle=None):
+    """Estimate the rotation, in degrees, that makes text lines horizontal"""
+    max_angle = Config.OCR_DESKEW_MAX_ANGLE if max_angle is None else max_angle
+    sample = to_grayscale(image).copy()
+    sample.thumbnail((DESKEW_SEARCH_WIDTH, DESKEW_SEARCH_WIDTH))
+    ink = sample.point([255 if value < 128 else 0 for value in range(256)])
+
+    def score(angle):
+        # Level text lines give sharp steps between ink rows and the gaps between them
+        rotated = ink.rotate(angle, resample=Image.NEAREST, fillcolor=0)
+        rows = list(rotated.convert('F').resize((1, rotated.height), Image.BOX).getdata())
+        return sum((rows[i] - rows[i - 1]) ** 2 for i in range(1, len(rows)))
+
+    # Coarse search in whole degrees, then refine around the best one
+    best = max(range(-int(max_angle), int(max_angle) + 1), key=score)
+    return max((best + step / 10 for step in range(-9, 10)), key=score)
+
+def deskew(image, source_dpi=None):
+    """Rotate a page so its text lines are horizontal"""
+    angle = estimate_skew(image)
+    if abs(angle) < 0.2:
+        return image
+    fill = 255 if image.mode == 'L' else 'white'
+    return image.rotate(angle, resample=Image.BILINEAR, expand=True, fillcolor=fill)
+
+# Stage name -> function, for the names listed in OCR_PREPROCESS_STAGES
+PREPROCESS_STAGES = {
+    'exif_transpose': exif_transpose,
+    'grayscale': to_grayscale,
+    'resize': resize_to_dpi,
+    'threshold': adaptive_threshold,
+    'deskew': deskew,
+}
+
+def preprocess_image(image, stages=None, source_dpi=None, timings=None):
+    """Run the configured cleanup stages on an image before OCR, adding each stage's seconds to timings"""
+    stages = Config.OCR_PREPROCESS_STAGES if stages is None else stages
+    for name in stages:
+        stage = PREPROCESS_STAGES.get(name)
+        if stage is None:
+            raise Exception(f"Unknown OCR preprocessing stage: {name}")
+        start = time.perf_counter()
+        image = stage(image, source_dpi)
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+    return image
@@ -1,252 +1,535 @@
 import os
 import re
+import json
+import hashlib
 import PyPDF2
 import pytesseract
 from PIL import Image
 import io
 import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from config import Config
+from cache import get_extraction_cache
+from keywords import get_keyword_index
+from preprocessing import preprocess_image
+from layout import WordBoxes, layout_line_items
+from duplicates import text_minhash
+from dates import normalize_date
+from database import increment_performance_counters, get_performance_counters
 
-def extract_text_from_pdf(pdf_path):
-    """Extract text from PDF file"""
-    text = ""
+# Bump whenever extraction output changes so cached results are not reused
+EXTRACTOR_VERSION = '3'
+
+# Settings that change what OCR and extraction produce for the same file; they are part of
+# the extraction cache key, so changing one never serves results extracted the old way
+EXTRACTION_SETTINGS = [
+    'OCR_MAX_PAGES', 'PDF_MIN_PAGE_TEXT_CHARS', 'PDF_MIN_PAGE_ALNUM_RATIO', 'PDF_RASTER_DPI',
+    'PDF_RASTER_GRAYSCALE', 'OCR_LANGUAGE', 'OCR_PREPROCESS_STAGES', 'OCR_TARGET_DPI',
+    'OCR_ASSUMED_PAGE_INCHES', 'OCR_THRESHOLD_WINDOW', 'OCR_THRESHOLD_OFFSET', 'OCR_DESKEW_MAX_ANGLE',
+    'OCR_ROI_ENABLED', 'OCR_ROI_HEADER_FRACTION', 'OCR_ROI_FOOTER_FRACTION', 'OCR_ROI_MIN_CONFIDENCE',
+    'OCR_ROI_REQUIRED_FIELDS',
+]
+
+# Shared process pool for page-level OCR, created on first use
+_ocr_executor = None
+_ocr_executor_lock = threading.Lock()
+
+# OCR backend of this process, created on first use (worker processes build their own)
+_ocr_backend = None
+_ocr_backend_pid = None
+_ocr_backend_lock = threading.Lock()
+
+def extract_pdf_page_texts(pdf_path):
+    """Extract the text layer of each PDF page"""
     try:
         with open(pdf_path, 'rb') as file:
             pdf_reader = PyPDF2.PdfReader(file)
-            for page in pdf_reader.pages:
-                text += page.extract_text() + "\n"
+            return [page.extract_text() or "" for page in pdf_reader.pages]
     except Exception as e:
         raise Exception(f"Failed to extract text from PDF: {str(e)}")
+
+def extract_text_from_pdf(pdf_path):
+    """Extract text from PDF file"""
+    return "".join(page_text + "\n" for page_text in extract_pdf_page_texts(pdf_path))
+
+def has_usable_text_layer(page_text):
+    """Check whether a page's text layer is good enough to skip OCR"""
+    stripped = "".join(page_text.split())
+    if len(stripped) < Config.PDF_MIN_PAGE_TEXT_CHARS:
+        return False
+    
+    # Scanned pages sometimes carry a junk layer of symbols; real text is mostly letters and digits
+    alnum_count = sum(1 for char in stripped if char.isalnum())
+    return alnum_count / len(stripped) >= Config.PDF_MIN_PAGE_ALNUM_RATIO
+
+class PytesseractBackend:
+    """OCR through the tesseract command line, which starts a process and reloads language data per image"""
+    name = 'pytesseract'
+
+    def image_to_string(self, image):
+        return pytesseract.image_to_string(image, lang=Config.OCR_LANGUAGE)
+
+    def image_to_data(self, image):
+        """Recognize an image, returning Tesseract's TSV of words and their boxes"""
+        return pytesseract.image_to_data(image, lang=Config.OCR_LANGUAGE)
+
+class TesserocrBackend:
+    """OCR through the Tesseract C API, keeping one initialized engine per thread for the life of the process"""
+    name = 'tesserocr'
+
+    def __init__(self):
+        import tesserocr
+        self.tesserocr = tesserocr
+        self.local = threading.local()
+
+    def engine(self):
+        """Get this thread's engine, loading the language data the first time"""
+        api = getattr(self.local, 'api', None)
+        if api is None:
+            api = self.tesserocr.PyTessBaseAPI(lang=Config.OCR_LANGUAGE)
+            self.local.api = api
+        return api
+
+    def image_to_string(self, image):
+        api = self.engine()
+        api.SetImage(image)
+        return api.GetUTF8Text()
+
+    def image_to_data(self, image):
+        """Recognize an image, returning Tesseract's TSV of words and their boxes"""
+        api = self.engine()
+        api.SetImage(image)
+        return api.GetTSVText(0)
+
+OCR_BACKENDS = {
+    'tesserocr': TesserocrBackend,
+    'pytesseract': PytesseractBackend,
+}
+
+def create_ocr_backend(name=None):
+    """Create the configured OCR backend, falling back to pytesseract when tesserocr is not installed"""
+    name = name or Config.OCR_BACKEND
+    if name == 'auto':
+        name = 'tesserocr'
+    if name not in OCR_BACKENDS:
+        raise Exception(f"Unknown OCR backend: {name}")
+    try:
+        return OCR_BACKENDS[name]()
+    except ImportError:
+        return PytesseractBackend()
+
+def get_ocr_backend():
+    """Get this process's OCR backend"""
+    global _ocr_backend, _ocr_backend_pid
+    with _ocr_backend_lock:
+        # Engines are not shared across fork, so a worker process builds its own
+        if _ocr_backend is None or _ocr_backend_pid != os.getpid():
+            _ocr_backend = create_ocr_backend()
+            _ocr_backend_pid = os.getpid()
+        return _ocr_backend
+
+def init_ocr_worker():
+    """Start an OCR worker process with its engine already loaded"""
+    backend = get_ocr_backend()
+    if isinstance(backend, TesserocrBackend):
+        backend.engine()
+
+def ocr_image(image, source_dpi=None, timings=None, regions=None, layouts=None):
+    """Clean up an image and OCR it, or only its (top, bottom) regions, adding to timings and layouts"""
+    image = preprocess_image(image, source_dpi=source_dpi, timings=timings)
+    start = time.perf_counter()
+    backend = get_ocr_backend()
+    width, height = image.size
+    boxes = WordBoxes()
+    boxes.page_height = height
+    # Each band is recognized on its own, so nothing between them is ever OCR'd
+    for top, bottom in regions or [(0.0, 1.0)]:
+        band_top, band_bottom = int(top * height), int(bottom * height)
+        band = image if (band_top, band_bottom) == (0, height) else image.crop((0, band_top, width, band_bottom))
+        boxes.extend(WordBoxes.from_tsv(backend.image_to_data(band), band.height), band_top)
+    text = boxes.text()
+    if layouts is not None:
+        layouts.append(boxes)
+    if timings is not None:
+        timings['recognize'] = timings.get('recognize', 0.0) + time.perf_counter() - start
+        timings['images'] = timings.get('images', 0) + 1
     return text
 
-def extract_text_from_image(image_path):
+def merge_timings(timings, extra):
+    """Add one set of OCR timings into another"""
+    for name, value in extra.items():
+        timings[name] = timings.get(name, 0) + value
+
+def extract_text_from_image(image_path, timings=None, regions=None, layouts=None):
     """Extract text from image using OCR"""
     try:
-        text = pytesseract.image_to_string(Image.open(image_path))
-        return text
+        with Image.open(image_path) as image:
+            return ocr_image(image, timings=timings, regions=regions, layouts=layouts)
     except Exception as e:
         raise Exception(f"Failed to extract text from image: {str(e)}")
 
-def pdf_to_images(pdf_path):
-    """Convert PDF pages to images"""
+def rasterize_pdf_page(pdf_path, page_number, dpi=None, grayscale=None):
+    """Render a single PDF page (1-based page number) to an image"""
+    from pdf2image import convert_from_path
+    dpi = Config.PDF_RASTER_DPI if dpi is None else dpi
+    grayscale = Config.PDF_RASTER_GRAYSCALE if grayscale is None else grayscale
+    images = convert_from_path(
+        pdf_path, dpi=dpi, grayscale=grayscale,
+        first_page=page_number, last_page=page_number
+    )
+    return images[0] if images else None
+
+def iter_pdf_pages(pdf_path, dpi=None, grayscale=None, first_page=None, last_page=None):
+    """Rasterize PDF pages one at a time, yielding (page_number, image)"""
     try:
-        from pdf2image import convert_from_path
-        images = convert_from_path(pdf_path)
-        return images
+        first_page = first_page or 1
+        page_count = get_pdf_page_count(pdf_path)
+        last_page = min(last_page or page_count, page_count)
+        
+        # Only the page being yielded is held in memory, however long the document is
+        for page_number in range(first_page, last_page + 1):
+            image = rasterize_pdf_page(pdf_path, page_number, dpi, grayscale)
+            if image is not None:
+                yield page_number, image
     except Exception as e:
         raise Exception(f"Failed to convert PDF to images: {str(e)}")
 
-def extract_text_from_file(file_path):
-    """Extract text from file (PDF or image)"""
+def pdf_to_images(pdf_path, dpi=None, grayscale=None, first_page=None, last_page=None):
+    """Convert PDF pages to a list of images (holds every page in memory; prefer iter_pdf_pages)"""
+    return [image for _, image in iter_pdf_pages(pdf_path, dpi, grayscale, first_page, last_page)]
+
+def get_pdf_page_count(pdf_path):
+    """Get the number of pages in a PDF file"""
+    try:
+        with open(pdf_path, 'rb') as file:
+            return len(PyPDF2.PdfReader(file).pages)
+    except Exception as e:
+        raise Exception(f"Failed to read PDF page count: {str(e)}")
+
+def ocr_pdf_page(pdf_path, page_number, timings=None, regions=None, layouts=None):
+    """Rasterize and OCR a single PDF page (1-based page number)"""
+    image = rasterize_pdf_page(pdf_path, page_number)
+    if image is None:
+        return ""
+    # The raster's resolution is known, so resizing does not have to guess it
+    return ocr_image(image, Config.PDF_RASTER_DPI, timings, regions, layouts)
+
+def ocr_pdf_page_timed(pdf_path, page_number, regions=None):
+    """OCR a single PDF page in a worker process, returning (text, timings, word boxes)"""
+    timings = {}
+    layouts = []
+    text = ocr_pdf_page(pdf_path, page_number, timings, regions, layouts)
+    return text, timings, layouts[0] if layouts else None
+
+def _get_ocr_executor():
+    """Get the shared OCR process pool"""
+    global _ocr_executor
+    if _ocr_executor is None:
+        with _ocr_executor_lock:
+            # Job queue threads can get here together; only the first one starts a pool
+            if _ocr_executor is None:
+                # Workers live as long as the app, so each loads the OCR language data once
+                _ocr_executor = ProcessPoolExecutor(max_workers=Config.OCR_WORKERS, initializer=init_ocr_worker)
+    return _ocr_executor
+
+def ocr_pdf_pages(pdf_path, page_numbers=None, workers=None, max_pages=None, timings=None, regions=None, layouts=None):
+    """OCR PDF pages across a process pool, returning page texts in page order"""
+    workers = Config.OCR_WORKERS if workers is None else workers
+    max_pages = Config.OCR_MAX_PAGES if max_pages is None else max_pages
+    
+    if page_numbers is None:
+        page_numbers = range(1, get_pdf_page_count(pdf_path) + 1)
+    page_numbers = list(page_numbers)
+    
+    # Pages past the per-document budget are not OCR'd
+    if max_pages:
+        page_numbers = page_numbers[:max_pages]
+    
+    try:
+        if workers <= 1 or len(page_numbers) <= 1:
+            return [ocr_pdf_page(pdf_path, page_number, timings=timings, regions=regions, layouts=layouts)
+                    for page_number in page_numbers]
+        
+        # Workers rasterize their own pages, so only the path crosses the process boundary
+        # and map() hands results back in submission order
+        if workers == Config.OCR_WORKERS:
+            pages = list(_get_ocr_executor().map(
+                ocr_pdf_page_timed, [pdf_path] * len(page_numbers), page_numbers, [regions] * len(page_numbers)
+            ))
+        else:
+            with ProcessPoolExecutor(max_workers=workers, initializer=init_ocr_worker) as executor:
+                pages = list(executor.map(
+                    ocr_pdf_page_timed, [pdf_path] * len(page_numbers), page_numbers, [regions] * len(page_numbers)
+                ))
+        
+        for _, page_timings, page_boxes in pages:
+            if timings is not None:
+                merge_timings(timings, page_timings)
+            if layouts is not None and page_boxes is not None:
+                layouts.append(page_boxes)
+        return [text for text, _, _ in pages]
+    except Exception as e:
+        raise Exception(f"Failed to OCR PDF pages: {str(e)}")
+
+def extract_text_from_file(file_path, timings=None, regions=None, layouts=None):
+    """Extract text from file (PDF or image), OCR'ing only the given page regions if any"""
     _, ext = os.path.splitext(file_path)
     ext = ext.lower()
     
     if ext == '.pdf':
-        # Try to extract text directly first
-        text = extract_text_from_pdf(file_path)
-        # If text extraction failed or text is minimal, use OCR
-        if len(text.strip()) < 50:
-            # Convert PDF to images and run OCR
-            images = pdf_to_images(file_path)
-            ocr_text = ""
-            for image in images:
-                ocr_text += pytesseract.image_to_string(image) + "\n"
-            text = ocr_text
-        return text
+        # Try the text layer of each page first
+        page_texts = extract_pdf_page_texts(file_path)
+        
+        # Only pages without a usable text layer are rasterized and OCR'd
+        ocr_page_numbers = [
+            page_number for page_number, page_text in enumerate(page_texts, start=1)
+            if not has_usable_text_layer(page_text)
+        ]
+        if ocr_page_numbers:
+            # Geometry only helps when it covers the whole document, not just its scanned pages
+            if len(ocr_page_numbers) < len(page_texts):
+                layouts = None
+            ocr_texts = ocr_pdf_pages(file_path, ocr_page_numbers, timings=timings, regions=regions, layouts=layouts)
+            for page_number, ocr_text in zip(ocr_page_numbers, ocr_texts):
+                page_texts[page_number - 1] = ocr_text
+        
+        return "".join(page_text + "\n" for page_text in page_texts)
     elif ext in ['.png', '.jpg', '.jpeg']:
-        return extract_text_from_image(file_path)
+        return extract_text_from_image(file_path, timings, regions, layouts)
     else:
         raise Exception(f"Unsupported file format: {ext}")
 
+# Field patterns, compiled once at import
+INVOICE_NUMBER_PATTERNS = [re.compile(pattern, re.IGNORECASE) for pattern in [
+    r'invoice\s*[#:]?\s*([A-Z0-9\-]+)',
+    r'inv[-\s]*([0-9]+)',
+    r'invoice\s*number\s*[:\-]?\s*([A-Z0-9\-]+)',
+    r'(?:invoice|inv)[\s.#]*([A-Z0-9]{1,20})'
+]]
+
+DATE_PATTERNS = [re.compile(pattern) for pattern in [
+    r'\b(\d{1,2}[/-]\d{1,2}[/-]\d{2,4})\b',
+    r'\b(\d{4}[/-]\d{1,2}[/-]\d{1,2})\b'
+]]
+
+TIME_PATTERNS = [re.compile(pattern, re.IGNORECASE) for pattern in [
+    r'\b(\d{1,2}:\d{2}\s*(?:am|pm)?)\b',
+    r'\b(\d{1,2}:\d{2}:\d{2})\b'
+]]
+
+TOTAL_PATTERNS = [re.compile(pattern, re.IGNORECASE) for pattern in [
+    r'(?:total|amount)[\s:]*\$?([0-9,]+\.?[0-9]*)',
+    r'\$([0-9,]+\.?[0-9]*)',
+    r'([0-9,]+\.?[0-9]*)\s*(?:usd|dollars)'
+]]
+
+SUBTOTAL_PATTERNS = [re.compile(pattern, re.IGNORECASE) for pattern in [
+    r'(?:subtotal|sub total)[\s:]*\$?([0-9,]+\.?[0-9]*)',
+    r'\$([0-9,]+\.?[0-9]*)\s*(?:subtotal|sub total)'
+]]
+
+TIP_PATTERNS = [re.compile(pattern, re.IGNORECASE) for pattern in [
+    r'(?:tip|gratuity)[\s:]*\$?([0-9,]+\.?[0-9]*)',
+    r'\$([0-9,]+\.?[0-9]*)\s*(?:tip|gratuity)'
+]]
+
+TAX_PATTERNS = [re.compile(pattern, re.IGNORECASE) for pattern in [
+    r'(?:tax|gst|hst)[\s:]*\$?([0-9,]+\.?[0-9]*)',
+    r'\btax\b.*?\$([0-9,]+\.?[0-9]*)'
+]]
+
+MERCHANT_PATTERNS = [re.compile(pattern, re.IGNORECASE) for pattern in [
+    r'from[:\s]+([a-zA-Z\s]+)',
+    r'sold\s+by[:\s]+([a-zA-Z\s]+)',
+    r'merchant[:\s]+([a-zA-Z\s]+)'
+]]
+
+ADDRESS_PATTERN = re.compile(
+    r'\d+\s+[a-zA-Z0-9\s]+(?:st|street|ave|avenue|rd|road|blvd|boulevard|dr|drive|ln|lane|ct|court|pl|place|way|pkwy|parkway|cir|circle)\.?\s*[a-zA-Z]{2,}',
+    re.IGNORECASE
+)
+
+SHIPPING_PATTERNS = [re.compile(pattern, re.IGNORECASE | re.DOTALL) for pattern in [
+    r'shipping\s+address[:\s]+(.+?)(?:\n|$)',
+    r'deliver\s+to[:\s]+(.+?)(?:\n|$)',
+    r'ship\s+to[:\s]+(.+?)(?:\n|$)'
+]]
+
+CASHIER_PATTERNS = [re.compile(pattern, re.IGNORECASE) for pattern in [
+    r'(?:cashier|server)[\s:]*([a-zA-Z\s]+)',
+    r'([a-zA-Z\s]+)\s*(?:cashier|server)'
+]]
+
+RECEIPT_NUMBER_PATTERNS = [re.compile(pattern, re.IGNORECASE) for pattern in [
+    r'(?:receipt|transaction)[\s#:]*(?:no\.?)?[\s:]*([A-Z0-9\-]+)',
+    r'([A-Z0-9]{4,20})\s*(?:receipt|transaction)'
+]]
+
+# Line item patterns, e.g. "2 x $5.99 = $11.98" or "2 @ $5.99 $11.98"
+DETAILED_ITEM_PATTERNS = [re.compile(pattern) for pattern in [
+    r'(\d+(?:\.\d+)?)\s*[x@]\s*\$?([0-9,]+\.?[0-9]*)\s*(?:=\s*)?\$?([0-9,]+\.?[0-9]*)',
+    r'([a-zA-Z\s]+?)\s+(\d+(?:\.\d+)?)\s*[x@]\s*\$?([0-9,]+\.?[0-9]*)\s*\$?([0-9,]+\.?[0-9]*)'
+]]
+ITEM_NAME_PATTERN = re.compile(r'^(.*?)\s*\d')
+ONLINE_ITEM_PATTERN = re.compile(r'([a-zA-Z\s]{3,}?)\s*\$([0-9,]+\.?[0-9]*)')
+PRICE_PATTERN = re.compile(r'\$([0-9,]+\.?[0-9]*)')
+PRICED_LINE_PATTERN = re.compile(r'^(.*?)(\$[0-9,]+\.?[0-9]*)$')
+DIGIT_PATTERN = re.compile(r'\d')
+WORD_PATTERN = re.compile(r'[a-zA-Z]{2,}')
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+class TextView:
+    """Pre-processed view of a document's text shared by every field extractor"""
+
+    def __init__(self, text, layout=None):
+        self.text = text
+        self.layout = layout  # Word boxes when the whole document was OCR'd
+        self.lower = text.lower()
+        self.lines = text.split('\n')
+        self._keyword_hits = None
+
+    @property
+    def keyword_hits(self):
+        """Hits for every keyword table, from a single scan of the lowercased text"""
+        if self._keyword_hits is None:
+            self._keyword_hits = get_keyword_index().scan(self.lower)
+        return self._keyword_hits
+
+def as_text_view(text):
+    """Wrap raw text in a TextView, passing existing views through"""
+    return text if isinstance(text, TextView) else TextView(text)
+
+def search_patterns(patterns, text):
+    """Return the first match of any pattern, trying them in order"""
+    for pattern in patterns:
+        match = pattern.search(text)
+        if match:
+            return match
+    return None
+
+def find_amount(patterns, text, confidence):
+    """Find the first amount matched by the patterns that parses as a number"""
+    for pattern in patterns:
+        match = pattern.search(text)
+        if match:
+            # Clean the amount
+            amount = match.group(1).replace(',', '')
+            try:
+                float(amount)
+                return amount, confidence
+            except ValueError:
+                continue
+    
+    return None, 0.0
+
 def classify_document(text):
     """Classify document as invoice or receipt based on keywords"""
-    # Convert to lowercase for matching
-    text_lower = text.lower()
-    
-    # Receipt indicators
-    receipt_indicators = [
-        'thank you', 'cash', 'credit', 'debit', 'total', 'subtotal', 'tax',
-        'change', 'balance', 'paid', 'tender', 'transaction', 'store',
-        'grocery', 'gas', 'restaurant', 'tip', 'gratuity', 'order confirmation',
-        'order number', 'shipment', 'delivery', 'tracking', 'confirmation #'
-    ]
-    
-    # Invoice indicators
-    invoice_indicators = [
-        'invoice', 'bill to', 'due date', 'terms', 'invoice #', 'inv-',
-        'amount due', 'balance due', 'payment due', 'remittance', 'po number',
-        'purchase order', 'bill for', 'invoice date'
-    ]
+    index = get_keyword_index()
+    indicators = as_text_view(text).keyword_hits['document_indicators']
     
     # Count matches
-    receipt_matches = sum(1 for indicator in receipt_indicators if indicator in text_lower)
-    invoice_matches = sum(1 for indicator in invoice_indicators if indicator in text_lower)
+    receipt_matches = len(indicators.get('receipt', ()))
+    invoice_matches = len(indicators.get('invoice', ()))
     
     # Determine document type based on higher match count
     if receipt_matches > invoice_matches:
-        return 'receipt', max(receipt_matches / len(receipt_indicators), 0.5)
+        return 'receipt', max(receipt_matches / index.group_size('document_indicators', 'receipt'), 0.5)
     elif invoice_matches > receipt_matches:
-        return 'invoice', max(invoice_matches / len(invoice_indicators), 0.5)
+        return 'invoice', max(invoice_matches / index.group_size('document_indicators', 'invoice'), 0.5)
     else:
         # Default to invoice if no clear indicator
         return 'invoice', 0.5
 
 def find_invoice_number(text):
     """Find invoice number in text"""
-    patterns = [
-        r'invoice\s*[#:]?\s*([A-Z0-9\-]+)',
-        r'inv[-\s]*([0-9]+)',
-        r'invoice\s*number\s*[:\-]?\s*([A-Z0-9\-]+)',
-        r'(?:invoice|inv)[\s.#]*([A-Z0-9]{1,20})'
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, text, re.IGNORECASE)
-        if match:
-            return match.group(1).strip(), 0.9
+    match = search_patterns(INVOICE_NUMBER_PATTERNS, as_text_view(text).text)
+    if match:
+        return match.group(1).strip(), 0.9
     
     return None, 0.0
 
 def find_date(text):
     """Find date in text"""
-    patterns = [
-        r'\b(\d{1,2}[/-]\d{1,2}[/-]\d{2,4})\b',
-        r'\b(\d{4}[/-]\d{1,2}[/-]\d{1,2})\b'
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, text)
-        if match:
-            return match.group(1), 0.8
+    match = search_patterns(DATE_PATTERNS, as_text_view(text).text)
+    if match:
+        return match.group(1), 0.8
     
     return None, 0.0
 
 def find_time(text):
     """Find time in text (for receipts)"""
-    patterns = [
-        r'\b(\d{1,2}:\d{2}\s*(?:am|pm)?)\b',
-        r'\b(\d{1,2}:\d{2}:\d{2})\b'
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, text, re.IGNORECASE)
-        if match:
-            return match.group(1), 0.8
+    match = search_patterns(TIME_PATTERNS, as_text_view(text).text)
+    if match:
+        return match.group(1), 0.8
     
     return None, 0.0
 
 def find_total_amount(text):
     """Find total amount in text"""
-    # Look for patterns like Total, Amount, etc.
-    patterns = [
-        r'(?:total|amount)[\s:]*\$?([0-9,]+\.?[0-9]*)',
-        r'\$([0-9,]+\.?[0-9]*)',
-        r'([0-9,]+\.?[0-9]*)\s*(?:usd|dollars)'
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, text, re.IGNORECASE)
-        if match:
-            # Clean the amount
-            amount = match.group(1).replace(',', '')
-            try:
-                float(amount)
-                return amount, 0.9
-            except ValueError:
-                continue
-    
-    return None, 0.0
+    return find_amount(TOTAL_PATTERNS, as_text_view(text).text, 0.9)
 
 def find_subtotal_amount(text):
     """Find subtotal amount in text"""
-    patterns = [
-        r'(?:subtotal|sub total)[\s:]*\$?([0-9,]+\.?[0-9]*)',
-        r'\$([0-9,]+\.?[0-9]*)\s*(?:subtotal|sub total)'
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, text, re.IGNORECASE)
-        if match:
-            # Clean the amount
-            amount = match.group(1).replace(',', '')
-            try:
-                float(amount)
-                return amount, 0.9
-            except ValueError:
-                continue
-    
-    return None, 0.0
+    return find_amount(SUBTOTAL_PATTERNS, as_text_view(text).text, 0.9)
 
 def find_vendor_name(text):
     """Find vendor name (simplified approach)"""
     # This is a simplified approach - in a real app, you'd have a more sophisticated method
-    lines = text.split('\n')
-    if lines:
-        # First non-empty line is often the vendor
-        for line in lines[:5]:  # Check first 5 lines
-            line = line.strip()
-            if line and len(line) > 3 and not re.search(r'\d', line):
-                return line, 0.7
+    # First non-empty line is often the vendor
+    for line in as_text_view(text).lines[:5]:  # Check first 5 lines
+        line = line.strip()
+        if line and len(line) > 3 and not DIGIT_PATTERN.search(line):
+            return line, 0.7
     
     return None, 0.0
 
 def find_merchant_name(text):
     """Find merchant name for receipts (usually at top, all caps)"""
-    lines = text.split('\n')
-    if lines:
-        # Look for merchant name in first few lines (often in all caps)
-        for i, line in enumerate(lines[:10]):
-            line = line.strip()
-            # Check if line is in all caps and not too short
-            if len(line) > 3 and line.isupper() and not re.search(r'[0-9]', line):
-                # Check if next line also contains address-like info
-                if i + 1 < len(lines):
-                    next_line = lines[i + 1].strip()
-                    if re.search(r'[0-9]', next_line) or re.search(r'[a-zA-Z]{2,}', next_line):
-                        return line, 0.8
-                return line, 0.7
+    view = as_text_view(text)
+    lines = view.lines
     
-    # For online purchase confirmations, look for "From:" or "Sold by:"
-    online_patterns = [
-        r'from[:\s]+([a-zA-Z\s]+)',
-        r'sold\s+by[:\s]+([a-zA-Z\s]+)',
-        r'merchant[:\s]+([a-zA-Z\s]+)'
-    ]
+    # Look for merchant name in first few lines (often in all caps)
+    for i, line in enumerate(lines[:10]):
+        line = line.strip()
+        # Check if line is in all caps and not too short
+        if len(line) > 3 and line.isupper() and not DIGIT_PATTERN.search(line):
+            # Check if next line also contains address-like info
+            if i + 1 < len(lines):
+                next_line = lines[i + 1].strip()
+                if DIGIT_PATTERN.search(next_line) or WORD_PATTERN.search(next_line):
+                    return line, 0.8
+            return line, 0.7
     
-    for pattern in online_patterns:
-        match = re.search(pattern, text, re.IGNORECASE)
+    # For online purchase confirmations, look for "From:" or "Sold by:"
+    for pattern in MERCHANT_PATTERNS:
+        match = pattern.search(view.text)
         if match:
             name = match.group(1).strip()
-            if len(name) > 2 and not re.search(r'\d', name):
+            if len(name) > 2 and not DIGIT_PATTERN.search(name):
                 return name, 0.8
     
     # Fallback to general vendor name extraction
-    return find_vendor_name(text)
+    return find_vendor_name(view)
 
 def find_location(text):
     """Find store location/address"""
-    lines = text.split('\n')
-    address_pattern = r'\d+\s+[a-zA-Z0-9\s]+(?:st|street|ave|avenue|rd|road|blvd|boulevard|dr|drive|ln|lane|ct|court|pl|place|way|pkwy|parkway|cir|circle)\.?\s*[a-zA-Z]{2,}'
+    view = as_text_view(text)
     
-    for line in lines:
-        line = line.strip()
-        match = re.search(address_pattern, line, re.IGNORECASE)
+    for line in view.lines:
+        match = ADDRESS_PATTERN.search(line.strip())
         if match:
             return match.group(0), 0.8
     
     # For online purchases, look for shipping address
-    shipping_patterns = [
-        r'shipping\s+address[:\s]+(.+?)(?:\n|$)',
-        r'deliver\s+to[:\s]+(.+?)(?:\n|$)',
-        r'ship\s+to[:\s]+(.+?)(?:\n|$)'
-    ]
-    
-    for pattern in shipping_patterns:
-        match = re.search(pattern, text, re.IGNORECASE | re.DOTALL)
+    for pattern in SHIPPING_PATTERNS:
+        match = pattern.search(view.text)
         if match:
             address = match.group(1).strip()
             # Clean up the address
-            address = re.sub(r'\s+', ' ', address)
+            address = WHITESPACE_PATTERN.sub(' ', address)
             if len(address) > 10:
                 return address, 0.7
     
@@ -254,106 +537,63 @@ def find_location(text):
 
 def find_payment_method(text):
     """Find payment method"""
-    text_lower = text.lower()
-    payment_methods = {
-        'cash': ['cash', 'cashier'],
-        'credit': ['credit', 'visa', 'mastercard', 'amex', 'discover', 'credit card'],
-        'debit': ['debit', 'debit card'],
-        'check': ['check', 'cheque'],
-        'paypal': ['paypal'],
-        'digital wallet': ['apple pay', 'google pay', 'samsung pay']
-    }
-    
-    for method, keywords in payment_methods.items():
-        for keyword in keywords:
-            if keyword in text_lower:
-                return method, 0.9
+    method = get_keyword_index().first_group(as_text_view(text).keyword_hits, 'payment_methods')
+    if method:
+        return method, 0.9
     
     return None, 0.0
 
 def find_tip_amount(text):
     """Find tip amount in text"""
-    patterns = [
-        r'(?:tip|gratuity)[\s:]*\$?([0-9,]+\.?[0-9]*)',
-        r'\$([0-9,]+\.?[0-9]*)\s*(?:tip|gratuity)'
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, text, re.IGNORECASE)
-        if match:
-            # Clean the amount
-            amount = match.group(1).replace(',', '')
-            try:
-                float(amount)
-                return amount, 0.9
-            except ValueError:
-                continue
-    
-    return None, 0.0
+    return find_amount(TIP_PATTERNS, as_text_view(text).text, 0.9)
 
 def find_tax_amount(text):
     """Find tax amount in text"""
-    patterns = [
-        r'(?:tax|gst|hst)[\s:]*\$?([0-9,]+\.?[0-9]*)',
-        r'\btax\b.*?\$([0-9,]+\.?[0-9]*)'
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, text, re.IGNORECASE)
-        if match:
-            amount = match.group(1).replace(',', '')
-            try:
-                float(amount)
-                return amount, 0.8
-            except ValueError:
-                continue
-    
-    return None, 0.0
+    return find_amount(TAX_PATTERNS, as_text_view(text).text, 0.8)
 
 def find_cashier_name(text):
     """Find cashier/server name"""
-    patterns = [
-        r'(?:cashier|server)[\s:]*([a-zA-Z\s]+)',
-        r'([a-zA-Z\s]+)\s*(?:cashier|server)'
-    ]
+    view = as_text_view(text)
     
-    for pattern in patterns:
-        match = re.search(pattern, text, re.IGNORECASE)
+    # Both patterns need one of the keywords, so skip the (slow) searches when neither appears
+    if 'cashier' not in view.lower and 'server' not in view.lower:
+        return None, 0.0
+    
+    for pattern in CASHIER_PATTERNS:
+        match = pattern.search(view.text)
         if match:
             name = match.group(1).strip()
             # Check if it looks like a name (not too long, no numbers)
-            if 2 < len(name) < 30 and not re.search(r'\d', name):
+            if 2 < len(name) < 30 and not DIGIT_PATTERN.search(name):
                 return name, 0.7
     
     return None, 0.0
 
 def find_receipt_number(text):
     """Find receipt/transaction number"""
-    patterns = [
-        r'(?:receipt|transaction)[\s#:]*(?:no\.?)?[\s:]*([A-Z0-9\-]+)',
-        r'([A-Z0-9]{4,20})\s*(?:receipt|transaction)'
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, text, re.IGNORECASE)
-        if match:
-            return match.group(1).strip(), 0.8
+    match = search_patterns(RECEIPT_NUMBER_PATTERNS, as_text_view(text).text)
+    if match:
+        return match.group(1).strip(), 0.8
     
     return None, 0.0
 
 def find_line_items(text):
     """Find line items in text (simplified)"""
+    view = as_text_view(text)
+    if view.layout is not None:
+        # Rows rebuilt from word positions keep each description next to its amount
+        layout_items = layout_line_items(view.layout)
+        if layout_items:
+            return [{'description': item['item_name'], 'amount': f"{item['total_price']:.2f}"} for item in layout_items], 0.8
+    
     # This is a very simplified approach - a real implementation would be much more complex
-    lines = text.split('\n')
     items = []
     
     # Look for lines that might contain items (with prices)
-    price_pattern = r'\$([0-9,]+\.?[0-9]*)'
-    
-    for line in lines:
-        if re.search(price_pattern, line) and len(line.strip()) > 10:
+    for line in view.lines:
+        if '$' in line and PRICE_PATTERN.search(line) and len(line.strip()) > 10:
             # Extract description and amount
-            match = re.search(r'^(.*?)(\$[0-9,]+\.?[0-9]*)$', line)
+            match = PRICED_LINE_PATTERN.search(line)
             if match:
                 description = match.group(1).strip()
                 amount = match.group(2).replace('$', '')
@@ -369,26 +609,28 @@ def find_line_items(text):
 
 def find_detailed_line_items(text):
     """Find detailed line items with quantities and unit prices for receipts"""
-    lines = text.split('\n')
+    view = as_text_view(text)
+    if view.layout is not None:
+        # Multi-column receipts keep names, quantities and prices aligned by position
+        items = layout_line_items(view.layout)
+        if items:
+            return items, 0.85
     items = []
     
-    # Pattern for items with quantity x unit price = total
-    # e.g., "2 x $5.99 = $11.98" or "2 @ $5.99 $11.98"
-    detailed_patterns = [
-        r'(\d+(?:\.\d+)?)\s*[x@]\s*\$?([0-9,]+\.?[0-9]*)\s*(?:=\s*)?\$?([0-9,]+\.?[0-9]*)',
-        r'([a-zA-Z\s]+?)\s+(\d+(?:\.\d+)?)\s*[x@]\s*\$?([0-9,]+\.?[0-9]*)\s*\$?([0-9,]+\.?[0-9]*)'
-    ]
-    
-    for line in lines:
+    for line in view.lines:
+        # Both detailed patterns need an "x" or "@" between quantity and price
+        if 'x' not in line and '@' not in line:
+            continue
+        
         # Try first pattern (quantity first)
-        match = re.search(detailed_patterns[0], line)
+        match = DETAILED_ITEM_PATTERNS[0].search(line)
         if match:
             quantity = float(match.group(1))
             unit_price = float(match.group(2).replace(',', ''))
             total_price = float(match.group(3).replace(',', ''))
             
             # Extract item name (text before the pattern)
-            name_match = re.search(r'^(.*?)\s*\d', line)
+            name_match = ITEM_NAME_PATTERN.search(line)
             item_name = name_match.group(1).strip() if name_match else "Unknown Item"
             
             items.append({
@@ -399,7 +641,7 @@ def find_detailed_line_items(text):
             })
         else:
             # Try second pattern (name first)
-            match = re.search(detailed_patterns[1], line)
+            match = DETAILED_ITEM_PATTERNS[1].search(line)
             if match:
                 item_name = match.group(1).strip()
                 quantity = float(match.group(2))
@@ -416,9 +658,10 @@ def find_detailed_line_items(text):
     # For online purchase confirmations, look for itemized lists
     if not items:
         # Pattern for online purchases: "Item Name $XX.XX"
-        online_pattern = r'([a-zA-Z\s]{3,}?)\s*\$([0-9,]+\.?[0-9]*)'
-        for line in lines:
-            match = re.search(online_pattern, line)
+        for line in view.lines:
+            if '$' not in line:
+                continue
+            match = ONLINE_ITEM_PATTERN.search(line)
             if match:
                 item_name = match.group(1).strip()
                 total_price = float(match.group(2).replace(',', ''))
@@ -434,7 +677,7 @@ def find_detailed_line_items(text):
     
     # Fallback to simple line items if detailed pattern not found
     if not items:
-        simple_items, confidence = find_line_items(text)
+        simple_items, confidence = find_line_items(view)
         if simple_items:
             for item in simple_items:
                 items.append({
@@ -452,75 +695,64 @@ def find_detailed_line_items(text):
 
 def categorize_expense(text, merchant_name=None):
     """Categorize expense based on keywords"""
-    text_lower = text.lower()
-    
-    categories = {
-        'Food & Dining': ['restaurant', 'cafe', 'coffee', 'food', 'dining', 'meal', 'burger', 'pizza', 'steak', 'mcdonalds', 'starbucks', 'subway'],
-        'Grocery': ['grocery', 'market', 'supermarket', 'food store', 'whole foods', 'kroger', 'walmart', 'costco', 'aldi', 'target'],
-        'Transportation': ['gas', 'fuel', 'station', 'parking', 'uber', 'taxi', 'bus', 'train', 'airline', 'shell', 'bp', 'exxon'],
-        'Office Supplies': ['office', 'staples', 'office depot', 'paper', 'pen', 'printer', 'staples', 'best buy'],
-        'Travel': ['hotel', 'motel', 'airbnb', 'flight', 'airline', 'travel', 'booking', 'marriott', 'hilton'],
-        'Entertainment': ['movie', 'cinema', 'theater', 'concert', 'event', 'ticket', 'amusement', 'netflix', 'spotify'],
-        'Online Services': ['amazon', 'ebay', 'paypal', 'subscription', 'monthly fee', 'service charge']
-    }
+    index = get_keyword_index()
     
     # Check merchant name first
     if merchant_name:
-        merchant_lower = merchant_name.lower()
-        for category, keywords in categories.items():
-            for keyword in keywords:
-                if keyword in merchant_lower:
-                    return category, 0.9
+        category = index.first_group(index.scan(merchant_name.lower()), 'expense_categories')
+        if category:
+            return category, 0.9
     
     # Check document text
-    for category, keywords in categories.items():
-        for keyword in keywords:
-            if keyword in text_lower:
-                return category, 0.8
+    category = index.first_group(as_text_view(text).keyword_hits, 'expense_categories')
+    if category:
+        return category, 0.8
     
     return 'Other', 0.5
 
 def process_invoice(text):
     """Process invoice-specific fields"""
+    view = as_text_view(text)
     results = {}
     
     # Invoice number
-    invoice_num, confidence = find_invoice_number(text)
+    invoice_num, confidence = find_invoice_number(view)
     results['invoice_number'] = {
         'value': invoice_num,
         'confidence': confidence
     }
     
     # Date
-    date, confidence = find_date(text)
+    date, confidence = find_date(view)
     results['date'] = {
         'value': date,
-        'confidence': confidence
+        'confidence': confidence,
+        'normalized': normalize_date(date)
     }
     
     # Vendor name
-    vendor, confidence = find_vendor_name(text)
+    vendor, confidence = find_vendor_name(view)
     results['vendor'] = {
         'value': vendor,
         'confidence': confidence
     }
     
     # Total amount
-    total, confidence = find_total_amount(text)
+    total, confidence = find_total_amount(view)
     results['total'] = {
         'value': total,
         'confidence': confidence
     }
     
     # Tax amount
-    tax, confidence = find_tax_amount(text)
+    tax, confidence = find_tax_amount(view)
     results['tax'] = {
         'value': tax,
         'confidence': confidence
     }
     
     # Line items
-    items, confidence = find_line_items(text)
+    items, confidence = find_line_items(view)
     results['line_items'] = {
         'value': items,
         'confidence': confidence
@@ -530,42 +762,44 @@ def process_invoice(text):
 
 def process_receipt(text):
     """Process receipt-specific fields"""
+    view = as_text_view(text)
     results = {}
     
     # Merchant/store name
-    merchant, confidence = find_merchant_name(text)
+    merchant, confidence = find_merchant_name(view)
     results['merchant_name'] = {
         'value': merchant,
         'confidence': confidence
     }
     
     # Store location/address
-    location, confidence = find_location(text)
+    location, confidence = find_location(view)
     results['location'] = {
         'value': location,
         'confidence': confidence
     }
     
     # Receipt number/transaction ID
-    receipt_num, confidence = find_receipt_number(text)
+    receipt_num, confidence = find_receipt_number(view)
     results['receipt_number'] = {
         'value': receipt_num,
         'confidence': confidence
     }
     
     # Payment method
-    payment_method, confidence = find_payment_method(text)
+    payment_method, confidence = find_payment_method(view)
     results['payment_method'] = {
         'value': payment_method,
         'confidence': confidence
     }
     
     # Date and time
-    date, date_confidence = find_date(text)
-    time, time_confidence = find_time(text)
+    date, date_confidence = find_date(view)
+    time, time_confidence = find_time(view)
     results['date'] = {
         'value': date,
-        'confidence': date_confidence
+        'confidence': date_confidence,
+        'normalized': normalize_date(date)
     }
     results['time'] = {
         'value': time,
@@ -573,46 +807,46 @@ def process_receipt(text):
     }
     
     # Subtotal, tax, tip, total
-    subtotal, confidence = find_subtotal_amount(text)
+    subtotal, confidence = find_subtotal_amount(view)
     results['subtotal'] = {
         'value': subtotal,
         'confidence': confidence
     }
     
-    tax, confidence = find_tax_amount(text)
+    tax, confidence = find_tax_amount(view)
     results['tax'] = {
         'value': tax,
         'confidence': confidence
     }
     
-    tip, confidence = find_tip_amount(text)
+    tip, confidence = find_tip_amount(view)
     results['tip'] = {
         'value': tip,
         'confidence': confidence
     }
     
-    total, confidence = find_total_amount(text)
+    total, confidence = find_total_amount(view)
     results['total'] = {
         'value': total,
         'confidence': confidence
     }
     
     # Cashier/server name
-    cashier, confidence = find_cashier_name(text)
+    cashier, confidence = find_cashier_name(view)
     results['cashier_name'] = {
         'value': cashier,
         'confidence': confidence
     }
     
     # Detailed line items
-    items, confidence = find_detailed_line_items(text)
+    items, confidence = find_detailed_line_items(view)
     results['line_items'] = {
         'value': items,
         'confidence': confidence
     }
     
     # Expense category
-    category, confidence = categorize_expense(text, merchant)
+    category, confidence = categorize_expense(view, merchant)
     results['category'] = {
         'value': category,
         'confidence': confidence
@@ -620,31 +854,153 @@ def process_receipt(text):
     
     return results
 
+def process_text(text, layout=None):
+    """Classify extracted text and pull out the fields for its document type"""
+    # Lowercase and split the text once for every extractor
+    view = TextView(text, layout) if layout is not None else as_text_view(text)
+    
+    # Classify document type
+    doc_type, confidence = classify_document(view)
+    
+    # Process based on document type
+    if doc_type == 'receipt':
+        results = process_receipt(view)
+    else:
+        results = process_invoice(view)
+    
+    # Add document type to results
+    results['document_type'] = {
+        'value': doc_type,
+        'confidence': confidence
+    }
+    
+    return results
+
+def record_ocr_timings(timings):
+    """Add a document's OCR timings to the shared performance counters"""
+    counts = {'ocr_images': timings.get('images', 0)}
+    for name, seconds in timings.items():
+        if name != 'images':
+            counts[f"ocr_{name}_seconds"] = seconds
+    increment_performance_counters(counts)
+
+def get_ocr_stats():
+    """Get how many images were OCR'd and the average milliseconds each OCR stage took per image"""
+    counters = get_performance_counters('ocr_')
+    images = int(counters.pop('ocr_images', 0))
+    stages = {name[len('ocr_'):-len('_seconds')]: seconds for name, seconds in counters.items() if name.endswith('_seconds')}
+    roi = get_performance_counters('roi_')
+    roi_documents = int(roi.pop('roi_documents', 0))
+    roi_escalations = int(roi.pop('roi_escalations', 0))
+    return {
+        'backend': get_ocr_backend().name,
+        'images': images,
+        'total_seconds': {stage: round(seconds, 3) for stage, seconds in stages.items()},
+        'average_ms': {stage: round(seconds * 1000 / images, 1) if images else 0.0 for stage, seconds in stages.items()},
+        'regions_first': {
+            'enabled': Config.OCR_ROI_ENABLED,
+            'documents': roi_documents,
+            'escalations': roi_escalations,
+            'escalation_rate': roi_escalations / roi_documents if roi_documents else 0.0,
+            # Which required fields sent documents to full-page OCR
+            'missing_fields': {name[len('roi_missing_'):]: int(count) for name, count in roi.items()}
+        }
+    }
+
+def process_extracted_text(text, layouts=None):
+    """Extract fields from a document's text and any page word boxes, failing if there is no text"""
+    if not text.strip():
+        raise Exception("No text could be extracted from the document")
+    return process_text(text, merge_layouts(layouts) if layouts else None)
+
+def merge_layouts(layouts):
+    """Stack the word boxes of each page into one layout, page below page"""
+    if len(layouts) == 1:
+        return layouts[0]
+    merged = WordBoxes()
+    for boxes in layouts:
+        merged.extend(boxes, merged.page_height)
+    return merged
+
+def ocr_regions():
+    """Get the header and footer bands OCR'd in the first phase of region-of-interest OCR"""
+    return [(0.0, Config.OCR_ROI_HEADER_FRACTION), (1.0 - Config.OCR_ROI_FOOTER_FRACTION, 1.0)]
+
+def missing_required_fields(results):
+    """List the fields a document type requires that are missing or below the confidence threshold"""
+    required = Config.OCR_ROI_REQUIRED_FIELDS.get(results['document_type']['value'], [])
+    return [
+        field for field in required
+        if not results.get(field, {}).get('value') or results[field]['confidence'] < Config.OCR_ROI_MIN_CONFIDENCE
+    ]
+
+def analyze_regions_first(file_path, timings):
+    """OCR the header and footer bands first, escalating to full pages if required fields are missing, returning (text, results)"""
+    layouts = []
+    text = extract_text_from_file(file_path, timings, ocr_regions(), layouts)
+    if not timings.get('images'):
+        # Nothing needed OCR, so the text layer is already complete
+        return text, process_extracted_text(text)
+    
+    results = process_extracted_text(text, layouts) if text.strip() else None
+    missing = missing_required_fields(results) if results else ['text']
+    counts = {'roi_documents': 1}
+    if missing:
+        counts['roi_escalations'] = 1
+        counts.update({f"roi_missing_{field}": 1 for field in missing})
+        layouts = []
+        text = extract_text_from_file(file_path, timings, layouts=layouts)
+        results = process_extracted_text(text, layouts)
+    increment_performance_counters(counts)
+    return text, results
+
+def extraction_cache_version():
+    """Version the extraction cache by the extractor, the settings shaping its output and the OCR engine in use"""
+    settings = {name: getattr(Config, name) for name in EXTRACTION_SETTINGS}
+    # 'auto' resolves to whichever engine is installed, so the engine actually used is recorded
+    settings['ocr_backend'] = type(get_ocr_backend()).__name__
+    digest = hashlib.sha1(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+    return f"{EXTRACTOR_VERSION}-{digest}"
+
+def analyze_document(file_path, use_cache=True):
+    """Extract text and fields from a document, returning (text, results)"""
+    cache = None
+    if use_cache and Config.EXTRACTION_CACHE_ENABLED:
+        # Identical files are served from the cache without OCR or parsing
+        cache = get_extraction_cache(extraction_cache_version())
+        key = cache.key_for_file(file_path)
+        entry = cache.get(key)
+        if entry is not None:
+            return entry['text'], entry['results']
+    
+    start = time.perf_counter()
+    
+    # Extract text from document
+    timings = {}
+    if Config.OCR_ROI_ENABLED:
+        text, results = analyze_regions_first(file_path, timings)
+    else:
+        layouts = []
+        text = extract_text_from_file(file_path, timings, layouts=layouts)
+        results = process_extracted_text(text, layouts)
+    if timings:
+        record_ocr_timings(timings)
+    
+    if cache is not None:
+        cache.put(key, {
+            'text': text,
+            'results': results,
+            'elapsed': time.perf_counter() - start
+        })
+    
+    return text, results
+
 def process_document(file_path):
     """Main document processing function"""
     try:
-        # Extract text from document
-        text = extract_text_from_file(file_path)
-        
-        if not text.strip():
-            raise Exception("No text could be extracted from the document")
-        
-        # Classify document type
-        doc_type, confidence = classify_document(text)
-        
-        # Process based on document type
-        if doc_type == 'receipt':
-            results = process_receipt(text)
-        else:
-            results = process_invoice(text)
-        
-        # Add document type to results
-        results['document_type'] = {
-            'value': doc_type,
-            'confidence': confidence
-        }
-        
-        return results
+        text, results = analyze_document(file_path)
+        # The text itself is not stored, only the hash duplicate detection compares
+        return dict(results, text_minhash={'value': text_minhash(text), 'confidence': 1.0})
         
     except Exception as e:
-        raise Exception(f"Document processing failed: {str(e)}")
\ No newline at end of file
+        raise Exception(f"Document processing failed: {str(e)}")
@@ -0,0 +1,182 @@
+"""Re-run validation over stored documents after the rules change.
+
+Run from the backend directory, e.g. ``python revalidate.py --batch-id 12 --workers 4``.
+Documents already validated under the current rule set with unchanged inputs are skipped,
+so re-running after an interruption only checks what is left.
+"""
+import argparse
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime
+from config import Config
+from database import (
+    init_db, transaction, count_filtered_documents, iter_filtered_document_ids, get_validation_inputs,
+    insert_revalidation_job, start_revalidation_job, record_revalidation_progress, finish_revalidation_job
+)
+from validation import revalidate_inputs, store_revalidation, extracted_data_from_rows
+
+# Filters a revalidation can target documents by
+FILTER_NAMES = ('batch_id', 'date_from', 'date_to', 'vendor')
+
+def parse_filters(values):
+    """Check revalidation filters, dropping empty ones; dates are YYYY-MM-DD upload dates"""
+    filters = {}
+    for name in FILTER_NAMES:
+        value = values.get(name)
+        if value in (None, ''):
+            continue
+        if name == 'batch_id':
+            value = int(value)
+        elif name in ('date_from', 'date_to'):
+            # Raises ValueError for anything but a calendar date
+            value = datetime.strptime(value, '%Y-%m-%d').strftime('%Y-%m-%d')
+        filters[name] = value
+    return filters
+
+def parse_force(value):
+    """Read a request's force flag: a JSON boolean, or '1'/'0' and 'true'/'false' from a body or query string"""
+    if isinstance(value, bool):
+        return value
+    if value is None or str(value).strip().lower() in ('', '0', 'false'):
+        return False
+    if str(value).strip().lower() in ('1', 'true'):
+        return True
+    raise ValueError(f"force must be true or false, not {value!r}")
+
+def revalidate_chunk(document_ids, force=False):
+    """Run the rules over a chunk of documents, returning (updates, unchanged, failures)
+
+    Runs in a worker: it only reads, loading the whole chunk's inputs with one query per table.
+    updates lists the (document_id, issues, validation_state) to write, failures (document_id, error).
+    """
+    inputs = get_validation_inputs(document_ids)
+    updates = []
+    failures = []
+    unchanged = 0
+    for document_id in document_ids:
+        document = inputs[document_id]
+        try:
+            revalidation = revalidate_inputs(
+                document_id, extracted_data_from_rows(document['extractions']), document['receipt_items'],
+                document['receipt_details'], document['minhash'], document['validation_state'], force
+            )
+        except Exception as e:
+            failures.append((document_id, str(e)))
+            continue
+        if revalidation is None:
+            unchanged += 1
+        else:
+            updates.append((document_id,) + revalidation)
+    return updates, unchanged, failures
+
+class RevalidationReport:
+    """Running counts and throughput of a revalidation run"""
+
+    def __init__(self, job_id, total, interval=None):
+        self.job_id = job_id
+        self.total = total
+        self.interval = interval
+        self.start = time.perf_counter()
+        self.last_report = self.start
+        self.processed = 0
+        self.skipped = 0
+        self.changed = 0
+        self.failed = 0
+        self.issues_added = 0
+        self.issues_resolved = 0
+
+    def rate(self):
+        elapsed = time.perf_counter() - self.start
+        return self.processed / elapsed if elapsed else 0.0
+
+    def add(self, processed, skipped, changed, failed, issues_added, issues_resolved):
+        self.processed += processed
+        self.skipped += skipped
+        self.changed += changed
+        self.failed += failed
+        self.issues_added += issues_added
+        self.issues_resolved += issues_resolved
+        now = time.perf_counter()
+        if self.interval is not None and now - self.last_report >= self.interval:
+            self.last_report = now
+            print(self.summary(), flush=True)
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start
+        return (f"{self.processed}/{self.total} documents in {elapsed:.1f}s ({self.rate():.1f} docs/s): "
+                f"{self.skipped} unchanged, {self.changed} with new or resolved issues, {self.failed} failed, "
+                f"{self.issues_added} issues added, {self.issues_resolved} resolved")
+
+def commit_chunk(report, updates, unchanged, failures):
+    """Write a chunk's issue diffs and the job's progress in one transaction"""
+    changed = 0
+    issues_added = 0
+    issues_resolved = 0
+    with transaction():
+        for document_id, issues, validation_state in updates:
+            inserted, resolved, reopened = store_revalidation(document_id, issues, validation_state)
+            issues_added += inserted + reopened
+            issues_resolved += resolved
+            if inserted or resolved or reopened:
+                changed += 1
+        processed = len(updates) + unchanged + len(failures)
+        report.add(processed, unchanged, changed, len(failures), issues_added, issues_resolved)
+        record_revalidation_progress(report.job_id, processed, unchanged, changed, len(failures),
+                                     issues_added, issues_resolved, report.rate())
+
+def revalidate(filters=None, force=False, workers=None, chunk_size=None, job_id=None, report_interval=None):
+    """Revalidate the completed documents matching filters, returning the run's report
+
+    Document ids are streamed from SQLite in chunks; workers run the rules on whole chunks and
+    each chunk's diffs are written in one transaction. Progress is recorded on the job row,
+    which is created unless job_id names a queued one.
+    """
+    filters = filters or {}
+    workers = workers or Config.REVALIDATE_WORKERS
+    chunk_size = chunk_size or Config.REVALIDATE_CHUNK_SIZE
+    if job_id is None:
+        job_id = insert_revalidation_job(filters, force)
+
+    report = RevalidationReport(job_id, count_filtered_documents(filters), report_interval)
+    start_revalidation_job(job_id, report.total)
+    try:
+        chunks = iter_filtered_document_ids(filters, chunk_size)
+        if workers <= 1:
+            for document_ids in chunks:
+                commit_chunk(report, *revalidate_chunk(document_ids, force))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                in_flight = set()
+                for document_ids in chunks:
+                    in_flight.add(executor.submit(revalidate_chunk, document_ids, force))
+                    # Keep a bounded number of chunks queued so memory stays flat for any corpus
+                    if len(in_flight) >= workers * 2:
+                        done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            commit_chunk(report, *future.result())
+                for future in in_flight:
+                    commit_chunk(report, *future.result())
+    except Exception as e:
+        finish_revalidation_job(job_id, 'failed', str(e))
+        raise
+    finish_revalidation_job(job_id, 'completed')
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--batch-id', type=int, help='only documents in this batch')
+    parser.add_argument('--date-from', help='only documents uploaded on or after this date (YYYY-MM-DD)')
+    parser.add_argument('--date-to', help='only documents uploaded on or before this date (YYYY-MM-DD)')
+    parser.add_argument('--vendor', help='only documents whose vendor or merchant name contains this text')
+    parser.add_argument('--force', action='store_true', help='re-run the rules even on unchanged documents')
+    parser.add_argument('--workers', type=int, default=Config.REVALIDATE_WORKERS, help='processes running the rules')
+    parser.add_argument('--chunk-size', type=int, default=Config.REVALIDATE_CHUNK_SIZE, help='documents read and written per transaction')
+    args = parser.parse_args()
+
+    filters = parse_filters(vars(args))
+    init_db()
+    report = revalidate(filters, args.force, args.workers, args.chunk_size, report_interval=5.0)
+    print(f"Revalidation job {report.job_id}: {report.summary()}")
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,8 @@
 import os
 import json
+import tempfile
 import zipfile
-from flask import Blueprint, request, jsonify, send_file
+from flask import Blueprint, Response, request, jsonify, send_file
 from werkzeug.utils import secure_filename
 from config import Config
 from database import (
@@ -10,85 +11,75 @@ from database import (
     insert_receipt_item, get_receipt_items, insert_receipt_details, get_receipt_details,
     update_document_type, get_document_type, insert_batch_job, update_batch_status,
     get_batch_job, get_batch_documents, get_batch_history, insert_validation_issue,
-    get_validation_issues, acknowledge_validation_issue, get_unacknowledged_issues_count
+    get_validation_issues, acknowledge_validation_issue, get_unacknowledged_issues_count,
+    finalize_batch_total, record_batch_result, get_batch_extractions, get_batch_receipt_details,
+    get_batch_receipt_items, iter_batch_extraction_rows, iter_document_extraction_rows,
+    get_upload_session, insert_revalidation_job, get_revalidation_job, start_document_processing,
+    finish_document, finish_revalidation_job
+)
+from jobs import task, get_job_queue
+from processing import process_document, classify_document, get_ocr_stats, extraction_cache_version
+from cache import get_extraction_cache
+from pipeline import store_document_results
+from chunked_uploads import (
+    UploadError, allowed_file, session_status, begin_upload, append_chunk, commit_upload,
+    abort_upload, queue_document, queue_archive
+)
+from exports import (
+    stream_csv, stream_ndjson, stream_ndjson_documents, write_columnar_batch, COLUMNAR_FORMATS
 )
-from processing import process_document, classify_document
 from validation import validate_document, get_validation_summary
-import csv
-import io
+from revalidate import parse_filters, parse_force, revalidate
 
 api_bp = Blueprint('api', __name__)
 
-def allowed_file(filename):
-    """Check if file extension is allowed"""
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in Config.ALLOWED_EXTENSIONS
+def streaming_download(chunks, mimetype, download_name):
+    """Send generated text chunks as a file download without buffering the whole file"""
+    return Response(
+        (chunk.encode('utf-8') for chunk in chunks),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename={download_name}'}
+    )
 
-def process_single_document(file_path, filename, doc_id):
-    """Process a single document and update database"""
+def process_single_document(file_path, filename, doc_id, batch_id=None):
+    """Process a single document and update database, counting its outcome against batch_id if given
+    
+    Running it again for a document that already finished changes nothing, so a retried job
+    neither stores the results twice nor counts the document twice.
+    """
     try:
         # Process the document
-        update_document_status(doc_id, 'processing')
+        if not start_document_processing(doc_id):
+            return False, 'Document was already processed'
         results = process_document(file_path)
         
-        # Update document type
-        doc_type = results.get('document_type', {}).get('value', 'unknown')
-        update_document_type(doc_id, doc_type)
+        # Save results, validation issues, the completed status and the batch count together
+        store_document_results(doc_id, results, batch_id)
         
-        # Save extraction results to database
-        for field_name, data in results.items():
-            # Skip document_type as it's stored separately
-            if field_name == 'document_type':
-                continue
-                
-            insert_extraction(
-                doc_id, 
-                field_name, 
-                data.get('value'), 
-                data.get('confidence', 0.0)
-            )
-        
-        # Save receipt-specific data if it's a receipt
-        if doc_type == 'receipt':
-            # Save receipt details
-            merchant_name = results.get('merchant_name', {}).get('value')
-            location = results.get('location', {}).get('value')
-            payment_method = results.get('payment_method', {}).get('value')
-            tip_amount = results.get('tip', {}).get('value')
-            subtotal = results.get('subtotal', {}).get('value')
-            tax_amount = results.get('tax', {}).get('value')
-            total_amount = results.get('total', {}).get('value')
-            cashier_name = results.get('cashier_name', {}).get('value')
-            transaction_time = results.get('time', {}).get('value')
-            category = results.get('category', {}).get('value')
-            
-            insert_receipt_details(
-                doc_id, merchant_name, location, payment_method, tip_amount,
-                subtotal, tax_amount, total_amount, cashier_name, transaction_time, category
-            )
-            
-            # Save receipt items
-            line_items = results.get('line_items', {}).get('value', [])
-            if line_items:
-                for item in line_items:
-                    if isinstance(item, dict):
-                        insert_receipt_item(
-                            doc_id,
-                            item.get('item_name', ''),
-                            item.get('quantity', 1.0),
-                            item.get('unit_price', 0.0),
-                            item.get('total_price', 0.0)
-                        )
-        
-        # Run validation on the processed document
-        validate_document(doc_id)
-        
-        update_document_status(doc_id, 'completed')
         return True, None
     except Exception as e:
-        update_document_status(doc_id, 'failed')
+        finish_document(doc_id, 'failed', batch_id)
         return False, str(e)
 
+def fail_batch_document(error, file_path, filename, doc_id, batch_id):
+    """Mark a batch document failed when its job raised instead of returning"""
+    finish_document(doc_id, 'failed', batch_id)
+
+@task('process_batch_document', on_failure=fail_batch_document)
+def process_batch_document(file_path, filename, doc_id, batch_id):
+    """Process one queued batch document and record its outcome on the batch"""
+    success, error = process_single_document(file_path, filename, doc_id, batch_id)
+    return success
+
+def fail_revalidation(error, job_id, filters, force):
+    """Mark a revalidation job failed when it raised before recording its own failure"""
+    finish_revalidation_job(job_id, 'failed', error)
+
+@task('revalidate_documents', on_failure=fail_revalidation)
+def revalidate_documents(job_id, filters, force):
+    """Run one queued bulk revalidation job"""
+    revalidate(filters, force, job_id=job_id)
+
 @api_bp.route('/classify-document', methods=['POST'])
 def classify_document_endpoint():
     """Classify document as invoice or receipt"""
@@ -114,9 +105,9 @@ def classify_document_endpoint():
         file_path = os.path.join(Config.UPLOAD_FOLDER, filename)
         file.save(file_path)
         
-        # Extract text from document
-        from processing import extract_text_from_file
-        text = extract_text_from_file(file_path)
+        # Extract text from document (served from the extraction cache for known files)
+        from processing import analyze_document
+        text, _ = analyze_document(file_path)
         
         # Classify document
         doc_type, confidence = classify_document(text)
@@ -191,7 +182,7 @@ def upload_file():
 
 @api_bp.route('/upload-batch', methods=['POST'])
 def upload_batch():
-    """Upload and process multiple documents"""
+    """Upload multiple documents and queue them for background processing"""
     try:
         # Check if files are present in request
         if 'files' not in request.files:
@@ -210,8 +201,9 @@ def upload_batch():
         # Create batch job record
         batch_id = insert_batch_job(user_id, len(files))
         
-        # Process files
-        processed_count = 0
+        # Save files and queue them; the batch stays 'pending' until every file is queued
+        queue = get_job_queue()
+        queued_count = 0
         failed_count = 0
         document_ids = []
         
@@ -231,7 +223,7 @@ def upload_batch():
             else:
                 regular_files.append(file)
         
-        # Process regular files first
+        # Queue regular files first
         for file in regular_files:
             # Check if file type is allowed
             if not allowed_file(file.filename):
@@ -239,111 +231,124 @@ def upload_batch():
                 continue
             
             try:
-                # Secure the filename
-                filename = secure_filename(file.filename)
+                # Prefix with the batch ID so queued files cannot overwrite each other
+                filename = f"{batch_id}_{secure_filename(file.filename)}"
                 
                 # Save file to upload folder
                 file_path = os.path.join(Config.UPLOAD_FOLDER, filename)
                 file.save(file_path)
                 
-                # Insert document record in database with batch_id
-                doc_id = insert_document(filename, batch_id=batch_id)
-                document_ids.append(doc_id)
-                
-                # Process the document
-                success, error = process_single_document(file_path, filename, doc_id)
-                
-                if success:
-                    processed_count += 1
-                else:
-                    failed_count += 1
-                
-                # Update batch progress
-                update_batch_status(batch_id, 'processing', processed_count, failed_count)
+                # Insert document record in database with batch_id and queue it
+                document_ids.append(queue_document(queue, file_path, filename, batch_id))
+                queued_count += 1
                 
             except Exception as e:
                 failed_count += 1
-                update_batch_status(batch_id, 'processing', processed_count, failed_count)
                 continue
         
-        # Process ZIP files
-        import zipfile
-        import tempfile
-        
+        # Queue ZIP file contents, streaming each member straight into the upload folder
         for zip_file in zip_files:
             try:
-                # Create a temporary directory to extract files
-                with tempfile.TemporaryDirectory() as temp_dir:
-                    # Save ZIP file temporarily
-                    zip_filename = secure_filename(zip_file.filename) if zip_file.filename else 'batch_zip_file.zip'
-                    zip_path = os.path.join(temp_dir, zip_filename)
-                    zip_file.save(zip_path)
-                    
-                    # Extract ZIP file
-                    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                        zip_ref.extractall(temp_dir)
-                    
-                    # Process extracted files
-                    for extracted_file in os.listdir(temp_dir):
-                        # Skip the original ZIP file
-                        if extracted_file == zip_filename:
-                            continue
-                            
-                        extracted_path = os.path.join(temp_dir, extracted_file)
-                        
-                        # Check if it's a file (not directory)
-                        if os.path.isfile(extracted_path):
-                            # Check if file type is allowed
-                            if not allowed_file(extracted_file):
-                                failed_count += 1
-                                continue
-                            
-                            try:
-                                # Generate a unique filename to avoid conflicts
-                                unique_filename = f"{batch_id}_{extracted_file}"
-                                final_path = os.path.join(Config.UPLOAD_FOLDER, unique_filename)
-                                
-                                # Move file to upload folder
-                                os.rename(extracted_path, final_path)
-                                
-                                # Insert document record in database with batch_id
-                                doc_id = insert_document(unique_filename, batch_id=batch_id)
-                                document_ids.append(doc_id)
-                                
-                                # Process the document
-                                success, error = process_single_document(final_path, unique_filename, doc_id)
-                                
-                                if success:
-                                    processed_count += 1
-                                else:
-                                    failed_count += 1
-                                
-                                # Update batch progress
-                                update_batch_status(batch_id, 'processing', processed_count, failed_count)
-                                
-                            except Exception as e:
-                                failed_count += 1
-                                update_batch_status(batch_id, 'processing', processed_count, failed_count)
-                                continue
-                                
+                # The upload is already a seekable stream, so the archive is read in place
+                with zipfile.ZipFile(zip_file.stream) as archive:
+                    archive_queued, archive_failed, archive_document_ids = queue_archive(archive, batch_id, queue)
+                queued_count += archive_queued
+                failed_count += archive_failed
+                document_ids.extend(archive_document_ids)
+                
             except Exception as e:
                 failed_count += 1
-                update_batch_status(batch_id, 'processing', processed_count, failed_count)
                 continue
         
-        # Update batch status to completed
-        update_batch_status(batch_id, 'completed', processed_count, failed_count)
+        # All files are queued, so the batch can now complete as workers finish
+        finalize_batch_total(batch_id, queued_count + failed_count, failed_count)
         
         return jsonify({
             'batch_id': batch_id,
-            'message': f'Batch processing completed: {processed_count} succeeded, {failed_count} failed',
-            'processed_count': processed_count,
-            'failed_count': failed_count
-        }), 200
+            'message': f'Batch queued for processing: {queued_count} queued, {failed_count} failed',
+            'queued_count': queued_count,
+            'failed_count': failed_count,
+            'document_ids': document_ids
+        }), 202
         
     except Exception as e:
         return jsonify({'error': f'Batch processing failed: {str(e)}'}), 500
 
+@api_bp.route('/uploads', methods=['POST'])
+def begin_chunked_upload():
+    """Start a resumable upload for a file too large for a single request"""
+    try:
+        data = request.get_json(silent=True) or {}
+        total_size = data.get('total_size')
+        session = begin_upload(data.get('filename'), int(total_size) if total_size is not None else None,
+                               data.get('sha256'))
+        return jsonify(session_status(session)), 201
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    except Exception as e:
+        return jsonify({'error': f'Failed to start upload: {str(e)}'}), 500
+
+@api_bp.route('/uploads/<upload_id>', methods=['PUT'])
+def append_upload_chunk(upload_id):
+    """Append the raw request body to an upload at the given offset"""
+    try:
+        offset = request.args.get('offset', type=int)
+        if offset is None:
+            return jsonify({'error': 'offset is required'}), 400
+        
+        # The body is read straight from the socket, so Flask never buffers the chunk
+        session = append_chunk(upload_id, offset, request.stream)
+        return jsonify(session_status(session))
+    except UploadError as e:
+        response = {'error': str(e)}
+        if e.session:
+            response.update(session_status(e.session))
+        return jsonify(response), e.status
+    except Exception as e:
+        return jsonify({'error': f'Failed to write chunk: {str(e)}'}), 500
+
+@api_bp.route('/uploads/<upload_id>', methods=['GET'])
+def get_upload_status(upload_id):
+    """Get how much of an upload has arrived, so an interrupted client knows where to resume"""
+    try:
+        session = get_upload_session(upload_id)
+        if not session:
+            return jsonify({'error': 'Upload not found'}), 404
+        return jsonify(session_status(session))
+    except Exception as e:
+        return jsonify({'error': f'Failed to get upload status: {str(e)}'}), 500
+
+@api_bp.route('/uploads/<upload_id>/commit', methods=['POST'])
+def commit_chunked_upload(upload_id):
+    """Finish an upload and queue its documents for background processing"""
+    try:
+        batch_id, queued_count, failed_count, document_ids = commit_upload(upload_id)
+        return jsonify({
+            'batch_id': batch_id,
+            'message': f'Batch queued for processing: {queued_count} queued, {failed_count} failed',
+            'queued_count': queued_count,
+            'failed_count': failed_count,
+            'document_ids': document_ids
+        }), 202
+    except UploadError as e:
+        response = {'error': str(e)}
+        if e.session:
+            response.update(session_status(e.session))
+        return jsonify(response), e.status
+    except Exception as e:
+        return jsonify({'error': f'Failed to commit upload: {str(e)}'}), 500
+
+@api_bp.route('/uploads/<upload_id>', methods=['DELETE'])
+def abort_chunked_upload(upload_id):
+    """Abandon an upload and delete what has arrived so far"""
+    try:
+        abort_upload(upload_id)
+        return jsonify({'message': 'Upload aborted'})
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    except Exception as e:
+        return jsonify({'error': f'Failed to abort upload: {str(e)}'}), 500
+
 @api_bp.route('/batch-status/<int:batch_id>', methods=['GET'])
 def get_batch_status(batch_id):
     """Get batch processing status"""
@@ -352,6 +357,12 @@ def get_batch_status(batch_id):
         if not batch_job:
             return jsonify({'error': 'Batch job not found'}), 404
         
+        # Add live progress for clients polling a queued batch
+        done = (batch_job['processed_files'] or 0) + (batch_job['failed_files'] or 0)
+        total = batch_job['total_files'] or 0
+        batch_job['pending_files'] = max(total - done, 0)
+        batch_job['progress'] = round(done / total * 100, 1) if total else 100.0
+        
         return jsonify(batch_job), 200
     except Exception as e:
         return jsonify({'error': f'Failed to retrieve batch status: {str(e)}'}), 500
@@ -364,14 +375,17 @@ def get_batch_results(batch_id):
         if not batch_job:
             return jsonify({'error': 'Batch job not found'}), 404
         
-        # Get all documents in the batch
+        # Get all documents in the batch, with their results fetched batch-wide
         documents = get_batch_documents(batch_id)
+        batch_extractions = get_batch_extractions(batch_id)
+        batch_details = get_batch_receipt_details(batch_id)
+        batch_items = get_batch_receipt_items(batch_id)
         
-        # Get results for each document
+        # Assemble results for each document
         batch_results = []
         for doc in documents:
             doc_id = doc['id']
-            extractions = get_document_extractions(doc_id)
+            extractions = batch_extractions.get(doc_id, [])
             
             results = {}
             for extraction in extractions:
@@ -386,12 +400,19 @@ def get_batch_results(batch_id):
                 'confidence': 0.0
             }
             
-            batch_results.append({
+            document_results = {
                 'document_id': doc_id,
                 'filename': doc['filename'],
                 'status': doc['status'],
                 'results': results
-            })
+            }
+            
+            # Add receipt-specific data
+            if doc['document_type'] == 'receipt':
+                document_results['receipt_details'] = batch_details.get(doc_id)
+                document_results['receipt_items'] = batch_items.get(doc_id, [])
+            
+            batch_results.append(document_results)
         
         return jsonify({
             'batch_id': batch_id,
@@ -413,15 +434,16 @@ def download_batch_results(batch_id):
         if not batch_job:
             return jsonify({'error': 'Batch job not found'}), 404
         
-        # Get all documents in the batch
-        documents = get_batch_documents(batch_id)
-        
         if format_type == 'json':
+            # Get all documents in the batch, with their extractions fetched batch-wide
+            documents = get_batch_documents(batch_id)
+            batch_extractions = get_batch_extractions(batch_id)
+            
             # Create combined JSON
             batch_results = {}
             for doc in documents:
                 doc_id = doc['id']
-                extractions = get_document_extractions(doc_id)
+                extractions = batch_extractions.get(doc_id, [])
                 
                 results = {}
                 for extraction in extractions:
@@ -433,36 +455,39 @@ def download_batch_results(batch_id):
             return jsonify(batch_results), 200
             
         elif format_type == 'csv':
-            # Create combined CSV
-            output = io.StringIO()
-            writer = csv.writer(output)
-            
-            # Write header
-            writer.writerow(['Filename', 'Field Name', 'Field Value', 'Confidence Score'])
+            # Stream the combined CSV straight from the database cursor
+            row_chunks = (
+                [[row['filename'], row['field_name'], row['field_value'], row['confidence_score']]
+                 for row in rows if row['field_name'] is not None]
+                for rows in iter_batch_extraction_rows(batch_id)
+            )
+            return streaming_download(
+                stream_csv(['Filename', 'Field Name', 'Field Value', 'Confidence Score'], row_chunks),
+                'text/csv', f'batch_{batch_id}_results.csv'
+            )
             
-            # Write data for each document
-            for doc in documents:
-                doc_id = doc['id']
-                extractions = get_document_extractions(doc_id)
-                
-                for extraction in extractions:
-                    writer.writerow([
-                        doc['filename'],
-                        extraction['field_name'],
-                        extraction['field_value'],
-                        extraction['confidence_score']
-                    ])
+        elif format_type == 'ndjson':
+            # Stream one JSON object per document
+            return streaming_download(
+                stream_ndjson_documents(iter_batch_extraction_rows(batch_id)),
+                'application/x-ndjson', f'batch_{batch_id}_results.ndjson'
+            )
             
-            # Convert to bytes
-            mem = io.BytesIO()
-            mem.write(output.getvalue().encode('utf-8'))
-            mem.seek(0)
+        elif format_type in COLUMNAR_FORMATS:
+            # Typed documents and receipt items tables, zipped together
+            archive = tempfile.TemporaryFile()
+            with tempfile.TemporaryDirectory() as temp_dir:
+                paths = write_columnar_batch(batch_id, temp_dir, format_type)
+                with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+                    for path in paths:
+                        zip_file.write(path, os.path.basename(path))
+            archive.seek(0)
             
             return send_file(
-                mem,
-                mimetype='text/csv',
+                archive,
+                mimetype='application/zip',
                 as_attachment=True,
-                download_name=f'batch_{batch_id}_results.csv'
+                download_name=f'batch_{batch_id}_{format_type}.zip'
             )
             
         else:
@@ -557,11 +582,11 @@ def get_history():
 
 @api_bp.route('/export/<int:doc_id>/<format>', methods=['GET'])
 def export_results(doc_id, format):
-    """Export results in specified format (json/csv)"""
+    """Export results in specified format (json/csv/ndjson)"""
     try:
-        extractions = get_document_extractions(doc_id)
-        
         if format == 'json':
+            extractions = get_document_extractions(doc_id)
+            
             # Convert to dictionary
             results = {}
             for extraction in extractions:
@@ -571,31 +596,16 @@ def export_results(doc_id, format):
             return jsonify(results), 200
             
         elif format == 'csv':
-            # Create CSV in memory
-            output = io.StringIO()
-            writer = csv.writer(output)
-            
-            # Write header
-            writer.writerow(['Field Name', 'Field Value', 'Confidence Score'])
-            
-            # Write data
-            for extraction in extractions:
-                writer.writerow([
-                    extraction['field_name'],
-                    extraction['field_value'],
-                    extraction['confidence_score']
-                ])
-            
-            # Convert to bytes
-            mem = io.BytesIO()
-            mem.write(output.getvalue().encode('utf-8'))
-            mem.seek(0)
-            
-            return send_file(
-                mem,
-                mimetype='text/csv',
-                as_attachment=True,
-                download_name=f'invoice_{doc_id}.csv'
+            # Stream the CSV straight from the database cursor
+            return streaming_download(
+                stream_csv(['Field Name', 'Field Value', 'Confidence Score'], iter_document_extraction_rows(doc_id)),
+                'text/csv', f'invoice_{doc_id}.csv'
+            )
+        elif format == 'ndjson':
+            # Stream one JSON object per extracted field
+            return streaming_download(
+                stream_ndjson(iter_document_extraction_rows(doc_id)),
+                'application/x-ndjson', f'invoice_{doc_id}.ndjson'
             )
         else:
             return jsonify({'error': 'Unsupported format'}), 400
@@ -603,6 +613,17 @@ def export_results(doc_id, format):
     except Exception as e:
         return jsonify({'error': f'Export failed: {str(e)}'}), 500
 
+@api_bp.route('/stats', methods=['GET'])
+def get_stats():
+    """Get performance counters"""
+    try:
+        return jsonify({
+            'extraction_cache': get_extraction_cache(extraction_cache_version()).stats(),
+            'ocr': get_ocr_stats()
+        }), 200
+    except Exception as e:
+        return jsonify({'error': f'Failed to retrieve stats: {str(e)}'}), 500
+
 @api_bp.route('/login', methods=['POST'])
 def login():
     """Simple authentication endpoint"""
@@ -627,8 +648,13 @@ def login():
 def validate_document_endpoint(document_id):
     """Run validation checks on a document"""
     try:
-        # Run validation
-        issues = validate_document(document_id)
+        force = parse_force(request.args.get('force'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    try:
+        # Revalidate, skipping the rules when nothing changed unless forced
+        issues = validate_document(document_id, force=force)
         
         return jsonify({
             'document_id': document_id,
@@ -664,3 +690,43 @@ def get_validation_summary_endpoint(document_id):
         }), 200
     except Exception as e:
         return jsonify({'error': f'Failed to retrieve validation summary: {str(e)}'}), 500
+
+@api_bp.route('/revalidate', methods=['POST'])
+def start_revalidation():
+    """Queue a bulk revalidation of stored documents, optionally limited to a batch, upload dates or vendor"""
+    data = request.get_json(silent=True) or {}
+    try:
+        filters = parse_filters(data)
+    except (ValueError, TypeError) as e:
+        return jsonify({'error': f'Invalid filter: {str(e)}'}), 400
+    try:
+        force = parse_force(data.get('force'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    try:
+        job_id = insert_revalidation_job(filters, force)
+        get_job_queue().submit('revalidate_documents', job_id=job_id, filters=filters, force=force)
+        
+        return jsonify({
+            'job_id': job_id,
+            'status': 'queued',
+            'filters': filters,
+            'message': 'Revalidation queued; poll /api/revalidate/<job_id> for progress'
+        }), 202
+    except Exception as e:
+        return jsonify({'error': f'Failed to queue revalidation: {str(e)}'}), 500
+
+@api_bp.route('/revalidate/<int:job_id>', methods=['GET'])
+def get_revalidation_status(job_id):
+    """Get a bulk revalidation job's progress"""
+    try:
+        job = get_revalidation_job(job_id)
+        if not job:
+            return jsonify({'error': 'Revalidation job not found'}), 404
+        
+        total = job['total_documents'] or 0
+        job['progress'] = round(job['processed_documents'] / total * 100, 1) if total else (100.0 if job['status'] == 'completed' else 0.0)
+        return jsonify(job), 200
+    except Exception as e:
+        return jsonify({'error': f'Failed to retrieve revalidation job: {str(e)}'}), 500
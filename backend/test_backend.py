@@ -2,25 +2,83 @@ import os
 import sys
 import unittest
 from app import create_app
-from database import init_db, get_db
+from config import Config
+from database import init_db, get_db, close_db
 import tempfile
 import io
+import importlib.util
+
+# CI installs requirements-optional.txt and sets this, so tests of optional dependencies cannot silently skip
+REQUIRE_OPTIONAL_DEPENDENCIES = os.environ.get('REQUIRE_OPTIONAL_DEPENDENCIES') == '1'
+
+# An invoice long enough for its text MinHash signature to be meaningful
+SAMPLE_INVOICE_LINES = [
+    'ACME OFFICE SUPPLY INC', '1200 Market Street, Springfield', 'Phone (555) 201-7788',
+    'INVOICE', 'Invoice Number: INV-0042', 'Invoice Date: 03/14/2024', 'Due Date: 04/13/2024',
+    'Bill To: Northwind Traders, 88 Harbor Road, Portland',
+    'Description Qty Unit Price Amount', 'Consulting services for March 10 125.00 1,250.00',
+    'Subtotal 1,250.00', 'Tax 0.00', 'Total Due 1,250.00',
+    'Payment terms: net 30 days. Please include the invoice number with your payment.',
+    'Thank you for your business.',
+]
+
+def write_text_pdf(path, lines):
+    """Write a one-page PDF with a text layer, which processes without OCR"""
+    stream = 'BT /F1 12 Tf 72 720 Td 14 TL ' + ' '.join(f"({line}) '" for line in lines) + ' ET'
+    objects = [
+        '<< /Type /Catalog /Pages 2 0 R >>',
+        '<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+        '<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents 4 0 R /Resources << /Font << /F1 5 0 R >> >> >>',
+        f'<< /Length {len(stream)} >>\nstream\n{stream}\nendstream',
+        '<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>',
+    ]
+    output = '%PDF-1.4\n'
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(output))
+        output += f'{number} 0 obj\n{body}\nendobj\n'
+    xref = len(output)
+    output += f'xref\n0 {len(objects) + 1}\n0000000000 65535 f \n'
+    output += ''.join(f'{offset:010d} 00000 n \n' for offset in offsets)
+    output += f'trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n'
+    with open(path, 'w') as file:
+        file.write(output)
+
+def ocr_tsv(lines, block=1, left=120, top=40, line_height=40):
+    """Build Tesseract TSV output (image_to_data) for lines of text, one word every 120 pixels"""
+    rows = ['level\tpage_num\tblock_num\tpar_num\tline_num\tword_num\tleft\ttop\twidth\theight\tconf\ttext']
+    for line_number, line in enumerate(lines, 1):
+        for word_number, word in enumerate(line.split(), 1):
+            rows.append(f'5\t1\t{block}\t1\t{line_number}\t{word_number}\t{left + (word_number - 1) * 120}\t'
+                        f'{top + (line_number - 1) * line_height}\t100\t30\t95.0\t{word}')
+    return '\n'.join(rows)
+
+def start_up_in_process(start):
+    """Wait for start, then initialize the database the way each server process does"""
+    start.wait()
+    init_db()
 
 class BackendTestCase(unittest.TestCase):
     def setUp(self):
         """Set up test environment"""
+        # Create a temporary database for testing
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.original_database_path = Config.DATABASE_PATH
+        Config.DATABASE_PATH = os.path.join(self.temp_dir.name, 'test.db')
+        
         self.app = create_app()
         self.app.config['TESTING'] = True
         self.client = self.app.test_client()
         
-        # Create a temporary database for testing
         with self.app.app_context():
             init_db()
 
     def tearDown(self):
         """Clean up after tests"""
         # Clean up database
-        pass
+        close_db()
+        Config.DATABASE_PATH = self.original_database_path
+        self.temp_dir.cleanup()
 
     def test_index(self):
         """Test the index route"""
@@ -60,5 +118,1127 @@ class BackendTestCase(unittest.TestCase):
         data = response.get_json()
         self.assertIsInstance(data, list)
 
+    def test_upload_batch_returns_immediately(self):
+        """Test batch upload queues documents and reports progress"""
+        from unittest import mock
+        from jobs import InlineJobQueue, set_job_queue
+        from PIL import Image
+        set_job_queue(InlineJobQueue())
+        
+        # A blank image yields no text, so its document fails processing
+        image = io.BytesIO()
+        Image.new('RGB', (50, 50), 'white').save(image, 'PNG')
+        image.seek(0)
+        
+        with mock.patch.object(Config, 'UPLOAD_FOLDER', self.temp_dir.name):
+            response = self.client.post('/api/upload-batch', data={
+                'files': [(image, 'blank.png'), (io.BytesIO(b'text'), 'notes.txt')]
+            }, content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 202)
+        data = response.get_json()
+        self.assertEqual(data['queued_count'], 1)
+        self.assertEqual(data['failed_count'], 1)
+        
+        response = self.client.get(f"/api/batch-status/{data['batch_id']}")
+        status = response.get_json()
+        self.assertEqual(status['status'], 'completed')
+        self.assertEqual(status['total_files'], 2)
+        self.assertEqual(status['failed_files'], 2)
+        self.assertEqual(status['progress'], 100.0)
+
+    def test_sqlite_job_queue(self):
+        """Test the durable job queue drains submitted jobs"""
+        import threading
+        from jobs import task, SQLiteJobQueue
+        done = threading.Event()
+        received = []
+        
+        @task('test_record_value')
+        def record_value(value):
+            received.append(value)
+            done.set()
+        
+        queue = SQLiteJobQueue(workers=1, poll_interval=0.05)
+        try:
+            queue.submit('test_record_value', value=42)
+            self.assertTrue(done.wait(5))
+        finally:
+            queue.shutdown()
+        self.assertEqual(received, [42])
+
+        # A job another live worker is running is left alone until its lease lapses
+        from database import enqueue_job, claim_next_job, finish_job, transaction
+        job_id = enqueue_job('test_record_value', '{"value": 7}')
+        self.assertEqual(claim_next_job('worker-a', 60, 3)['id'], job_id)
+        self.assertIsNone(claim_next_job('worker-b', 60, 3))
+        with transaction() as cursor:
+            cursor.execute("UPDATE job_queue SET lease_expires = datetime('now', '-1 seconds') WHERE id = ?", (job_id,))
+        self.assertEqual(claim_next_job('worker-b', 60, 3)['id'], job_id)
+        # The worker that lost the job can no longer record its outcome
+        finish_job(job_id, 'worker-a', 'failed', 'stale')
+        job = get_db().execute("SELECT status, owner FROM job_queue WHERE id = ?", (job_id,)).fetchone()
+        self.assertEqual(tuple(job), ('running', 'worker-b'))
+
+        # A job whose worker died on every attempt is failed and handed to its failure handler
+        failures = []
+
+        @task('test_crash_worker', on_failure=lambda error, value: failures.append((value, error)))
+        def crash_worker(value):
+            received.append(value)
+
+        with transaction() as cursor:
+            cursor.execute("UPDATE job_queue SET status = 'completed' WHERE id = ?", (job_id,))
+        crashing_id = enqueue_job('test_crash_worker', '{"value": 8}')
+        with transaction() as cursor:
+            cursor.execute("""UPDATE job_queue SET status = 'running', attempts = 3, owner = 'worker-a',
+                              lease_expires = datetime('now', '-1 seconds') WHERE id = ?""", (crashing_id,))
+        done.clear()
+        queue = SQLiteJobQueue(workers=1, poll_interval=0.05, max_attempts=3)
+        try:
+            # The job behind it still runs
+            queue.submit('test_record_value', value=9)
+            self.assertTrue(done.wait(5))
+        finally:
+            queue.shutdown()
+        self.assertEqual(received, [42, 9])
+        self.assertEqual(failures, [(8, 'Worker stopped during each of 3 attempts')])
+        job = get_db().execute("SELECT status, error FROM job_queue WHERE id = ?", (crashing_id,)).fetchone()
+        self.assertEqual(tuple(job), ('failed', 'Worker stopped during each of 3 attempts'))
+
+    def test_pool_queue_marks_document_failed_when_job_raises(self):
+        """Test a batch job that raises on a pool marks its document failed instead of leaving the batch processing"""
+        from unittest import mock
+        import routes
+        from jobs import ThreadJobQueue
+        from database import insert_batch_job, insert_document, finalize_batch_total, get_batch_job, get_batch_documents
+        batch_id = insert_batch_job(1, 1)
+        doc_id = insert_document('crash.png', 'unknown', batch_id)
+        finalize_batch_total(batch_id, 1, 0)
+        queue = ThreadJobQueue(1)
+        with mock.patch.object(routes, 'process_single_document', side_effect=RuntimeError('worker crashed')):
+            queue.submit('process_batch_document', file_path='crash.png', filename='crash.png', doc_id=doc_id, batch_id=batch_id)
+            queue.shutdown()
+        self.assertEqual([document['status'] for document in get_batch_documents(batch_id)], ['failed'])
+        batch = get_batch_job(batch_id)
+        self.assertEqual((batch['status'], batch['failed_files']), ('completed', 1))
+
+    def test_ocr_pdf_pages_order_and_budget(self):
+        """Test page OCR keeps page order and honours the page budget"""
+        from unittest import mock
+        import processing
+        with mock.patch.object(processing, 'get_pdf_page_count', return_value=5), \
+             mock.patch.object(processing, 'ocr_pdf_page', side_effect=lambda path, page, timings=None, regions=None, layouts=None: f'page {page}'):
+            texts = processing.ocr_pdf_pages('scan.pdf', workers=1, max_pages=3)
+        self.assertEqual(texts, ['page 1', 'page 2', 'page 3'])
+
+    def test_iter_pdf_pages_streams_one_page_at_a_time(self):
+        """Test the rasterizer renders each page only when it is requested"""
+        from unittest import mock
+        from PIL import Image
+        import processing
+        convert = mock.Mock(side_effect=lambda *args, **kwargs: [Image.new('L', (10, 10))])
+        with mock.patch('pdf2image.convert_from_path', convert), \
+             mock.patch.object(processing, 'get_pdf_page_count', return_value=4):
+            pages = processing.iter_pdf_pages('scan.pdf', dpi=150, first_page=2)
+            page_number, image = next(pages)
+            self.assertEqual(page_number, 2)
+            self.assertEqual(convert.call_count, 1)
+            self.assertEqual([number for number, _ in pages], [3, 4])
+        convert.assert_called_with('scan.pdf', dpi=150, grayscale=True, first_page=4, last_page=4)
+
+    def test_mixed_pdf_only_ocrs_scanned_pages(self):
+        """Test pages with a text layer are kept and only scanned pages are OCR'd"""
+        from unittest import mock
+        import processing
+        page_texts = ['Invoice # INV-100 from ACME Office Supply Co', '', '. . . : :']
+        ocr = mock.Mock(return_value=['scanned page 2', 'scanned page 3'])
+        with mock.patch.object(processing, 'extract_pdf_page_texts', return_value=page_texts), \
+             mock.patch.object(processing, 'ocr_pdf_pages', ocr):
+            text = processing.extract_text_from_file('mixed.pdf')
+        ocr.assert_called_once_with('mixed.pdf', [2, 3], timings=None, regions=None, layouts=None)
+        self.assertEqual(text, 'Invoice # INV-100 from ACME Office Supply Co\nscanned page 2\nscanned page 3\n')
+
+    def test_ocr_preprocessing_stages(self):
+        """Test preprocessing uprights, shrinks and deskews a photo, timing each stage"""
+        from PIL import Image, ImageDraw
+        from preprocessing import preprocess_image, estimate_skew
+        page = Image.new('RGB', (1700, 2200), 'white')
+        draw = ImageDraw.Draw(page)
+        for row in range(20):
+            draw.rectangle((150, 150 + row * 90, 1500, 180 + row * 90), fill='black')
+        self.assertAlmostEqual(estimate_skew(page.rotate(3, expand=True, fillcolor='white')), -3, delta=0.3)
+
+        # A 12MP photo taken sideways: EXIF says rotate it, and it has no real DPI
+        photo = page.rotate(2, expand=True, fillcolor='white').resize((3000, 4000)).transpose(Image.ROTATE_90)
+        exif = photo.getexif()
+        exif[0x0112] = 8
+        path = os.path.join(self.temp_dir.name, 'photo.jpg')
+        photo.save(path, exif=exif, dpi=(72, 72))
+
+        timings = {}
+        with Image.open(path) as image:
+            cleaned = preprocess_image(image, stages=['exif_transpose', 'grayscale', 'resize', 'threshold', 'deskew'],
+                                       timings=timings)
+        self.assertEqual(cleaned.mode, 'L')
+        self.assertGreater(cleaned.height, cleaned.width)
+        self.assertLessEqual(max(cleaned.size), 3400)
+        self.assertAlmostEqual(estimate_skew(cleaned), 0, delta=0.3)
+        self.assertEqual(list(timings), ['exif_transpose', 'grayscale', 'resize', 'threshold', 'deskew'])
+        with self.assertRaises(Exception):
+            preprocess_image(page, stages=['sharpen'])
+
+    def test_ocr_pool_created_once_across_threads(self):
+        """Test job threads asking for the OCR pool at the same moment share one pool"""
+        import threading
+        import time
+        from unittest import mock
+        import processing
+        created = []
+
+        def slow_pool(**kwargs):
+            # Widen the window in which a second thread could also see no pool
+            time.sleep(0.05)
+            created.append(object())
+            return created[-1]
+
+        start = threading.Barrier(8)
+        pools = []
+
+        def get_pool():
+            start.wait()
+            pools.append(processing._get_ocr_executor())
+
+        with mock.patch.object(processing, '_ocr_executor', None), \
+             mock.patch.object(processing, 'ProcessPoolExecutor', slow_pool):
+            threads = [threading.Thread(target=get_pool) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(len(created), 1)
+        self.assertEqual(pools, created * 8)
+
+    def test_ocr_backend_selection_and_engine_reuse(self):
+        """Test tesserocr keeps one engine per thread and pytesseract is the fallback"""
+        import types
+        from unittest import mock
+        from PIL import Image
+        import processing
+
+        class FakeTessBaseAPI:
+            created = 0
+
+            def __init__(self, lang):
+                FakeTessBaseAPI.created += 1
+
+            def SetImage(self, image):
+                self.size = image.size
+
+            def GetUTF8Text(self):
+                return f'{self.size[0]}x{self.size[1]}'
+
+        with mock.patch.dict(sys.modules, {'tesserocr': types.SimpleNamespace(PyTessBaseAPI=FakeTessBaseAPI)}):
+            backend = processing.create_ocr_backend('auto')
+            self.assertEqual(backend.name, 'tesserocr')
+            texts = [backend.image_to_string(Image.new('L', (10 * n, 20))) for n in range(1, 4)]
+        self.assertEqual(texts, ['10x20', '20x20', '30x20'])
+        self.assertEqual(FakeTessBaseAPI.created, 1)
+
+        with mock.patch.dict(sys.modules, {'tesserocr': None}):
+            self.assertEqual(processing.create_ocr_backend('tesserocr').name, 'pytesseract')
+        with self.assertRaises(Exception):
+            processing.create_ocr_backend('cuneiform')
+
+    def test_region_ocr_escalates_when_fields_are_missing(self):
+        """Test region-first OCR reads only the header and footer unless a required field is missing"""
+        from unittest import mock
+        from PIL import Image
+        import processing
+        header = 'ACME Office Supply Co\nInvoice # INV-1042\nInvoice Date: 03/14/2024\nBill To: Example Corp'
+        footers = {'complete.png': 'Tax: $1.27\nTotal: $18.25', 'no_total.png': 'Thank you for your business'}
+
+        class FakeBackend:
+            name = 'fake'
+
+            def __init__(self):
+                self.heights = []
+                self.footer = ''
+
+            def image_to_data(self, image):
+                self.heights.append(image.height)
+                if image.height == 1000:
+                    return ocr_tsv(f'{header}\nPrinter Paper $16.98\nTotal: $18.25'.split('\n'))
+                return ocr_tsv((header if image.height == 250 else self.footer).split('\n'))
+
+        backend = FakeBackend()
+        heights = {}
+        with mock.patch.object(processing, '_ocr_backend', backend), \
+             mock.patch.object(processing, '_ocr_backend_pid', os.getpid()), \
+             mock.patch.object(Config, 'OCR_ROI_ENABLED', True), \
+             mock.patch.object(Config, 'OCR_PREPROCESS_STAGES', []):
+            for name, footer in footers.items():
+                path = os.path.join(self.temp_dir.name, name)
+                Image.new('L', (800, 1000), 255).save(path)
+                backend.footer = footer
+                backend.heights = []
+                _, results = processing.analyze_document(path, use_cache=False)
+                self.assertEqual(results['total']['value'], '18.25')
+                heights[name] = backend.heights
+
+        # The complete invoice needed only the two bands; the other went on to the full page
+        self.assertEqual(heights, {'complete.png': [250, 300], 'no_total.png': [250, 300, 1000]})
+        stats = processing.get_ocr_stats()['regions_first']
+        self.assertEqual((stats['documents'], stats['escalations'], stats['missing_fields']), (2, 1, {'total': 1}))
+
+    def test_layout_line_items_from_word_boxes(self):
+        """Test line items are read from word positions when OCR splits names and prices into columns"""
+        from layout import WordBoxes
+        from processing import process_text
+        names = ['CORNER CAFE', 'Thank you', 'Latte', 'Blueberry Muffin', 'Bottled Water', 'Subtotal', 'Tax', 'Total']
+        prices = ['2 x $4.50 $9.00', '$3.25', '3 @ 1.50 4.50', '$16.75', '$1.34', '$18.09']
+        tsv = ocr_tsv(names) + '\n' + ocr_tsv(prices, block=2, left=900, top=120).split('\n', 1)[1]
+        boxes = WordBoxes.from_tsv(tsv, 1000)
+
+        # Tesseract reads the price column as its own block, so the text loses the alignment
+        self.assertTrue(boxes.text().endswith('Total\n\n2 x $4.50 $9.00\n$3.25\n3 @ 1.50 4.50\n$16.75\n$1.34\n$18.09'))
+        self.assertEqual(boxes.rows()[3], ['Blueberry', 'Muffin', '$3.25'])
+
+        items = process_text(boxes.text(), boxes)['line_items']['value']
+        self.assertEqual([(item['item_name'], item['quantity'], item['unit_price'], item['total_price']) for item in items], [
+            ('Latte', 2.0, 4.5, 9.0), ('Blueberry Muffin', 1.0, 3.25, 3.25), ('Bottled Water', 3.0, 1.5, 4.5)
+        ])
+
+        # A zero quantity column does not stop the rest of the document from being extracted
+        from layout import layout_line_items
+        items = layout_line_items(WordBoxes.from_tsv(ocr_tsv(['Widget 0 5.00'])))
+        self.assertEqual([(item['quantity'], item['unit_price']) for item in items], [(1.0, 5.0)])
+
+    def test_extraction_cache_skips_reprocessing(self):
+        """Test re-processing an identical file is served from the cache"""
+        from unittest import mock
+        import processing
+        from cache import ExtractionCache
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache = ExtractionCache(os.path.join(temp_dir, 'cache'), 1024 * 1024, processing.EXTRACTOR_VERSION)
+            file_path = os.path.join(temp_dir, 'receipt.png')
+            with open(file_path, 'wb') as file:
+                file.write(b'same bytes')
+            
+            before = cache.stats()
+            extract = mock.Mock(return_value='Invoice # INV-7\nTotal: $12.50')
+            with mock.patch.object(processing, 'get_extraction_cache', return_value=cache), \
+                 mock.patch.object(processing, 'extract_text_from_file', extract):
+                first = processing.process_document(file_path)
+                second = processing.process_document(file_path)
+            
+            self.assertEqual(extract.call_count, 1)
+            self.assertEqual(first, second)
+            after = cache.stats()
+            self.assertEqual(after['hits'] - before['hits'], 1)
+            self.assertEqual(after['misses'] - before['misses'], 1)
+
+            # Settings that change the extraction are part of the key, so results extracted the old way are not served
+            import cache as cache_module
+            with mock.patch.object(Config, 'EXTRACTION_CACHE_DIR', os.path.join(temp_dir, 'keyed')), \
+                 mock.patch.object(cache_module, '_cache', None), \
+                 mock.patch.object(processing, 'extract_text_from_file', extract):
+                processing.process_document(file_path)
+                with mock.patch.object(Config, 'OCR_PREPROCESS_STAGES', ['grayscale', 'threshold']):
+                    processing.process_document(file_path)
+                processing.process_document(file_path)
+            self.assertEqual(extract.call_count, 3)
+
+    def test_extraction_cache_evicts_least_recently_used(self):
+        """Test the cache stays under its size limit by evicting old entries"""
+        from cache import ExtractionCache
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache = ExtractionCache(temp_dir, 300, '1')
+            cache.put('aa-v1', {'text': 'x' * 100})
+            os.utime(cache._path('aa-v1'), (0, 0))
+            cache.put('bb-v1', {'text': 'y' * 100})
+            cache.put('cc-v1', {'text': 'z' * 100})
+            self.assertIsNone(cache.get('aa-v1'))
+            self.assertIsNotNone(cache.get('cc-v1'))
+            self.assertLessEqual(cache.total_bytes, 300)
+
+    def test_connection_reused_in_wal_mode(self):
+        """Test each thread reuses one WAL-mode connection and failed writes roll back"""
+        from database import transaction, insert_document, get_document_history
+        conn = get_db()
+        self.assertIs(get_db(), conn)
+        self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], 'wal')
+        
+        with self.assertRaises(ValueError):
+            with transaction() as cursor:
+                cursor.execute("INSERT INTO documents (filename) VALUES ('rolled_back.pdf')")
+                raise ValueError('abort')
+        self.assertFalse(conn.in_transaction)
+        
+        insert_document('kept.pdf')
+        filenames = [doc['filename'] for doc in get_document_history()]
+        self.assertEqual(filenames, ['kept.pdf'])
+
+    def test_concurrent_startups_migrate_once(self):
+        """Test processes starting together on an old database apply each migration exactly once"""
+        import multiprocessing
+        from unittest import mock
+        import database
+        close_db()
+        os.remove(Config.DATABASE_PATH)
+        with mock.patch.object(database, 'MIGRATIONS', []):
+            init_db()
+        close_db()
+        
+        context = multiprocessing.get_context('fork')
+        start = context.Event()
+        processes = [context.Process(target=start_up_in_process, args=(start,)) for _ in range(4)]
+        for process in processes:
+            process.start()
+        start.set()
+        for process in processes:
+            process.join(30)
+        self.assertEqual([process.exitcode for process in processes], [0] * 4)
+        self.assertEqual(get_db().execute("PRAGMA user_version").fetchone()[0], database.MIGRATIONS[-1][0])
+        columns = [row['name'] for row in get_db().execute("PRAGMA table_info(validation_issues)")]
+        self.assertEqual(columns.count('fingerprint'), 1)
+
+    def test_process_single_document_persists_atomically(self):
+        """Test a document's results are written together, or not at all on failure"""
+        from unittest import mock
+        import routes
+        import pipeline
+        from database import insert_document, get_document_extractions, get_receipt_items, get_batch_documents
+        results = {
+            'document_type': {'value': 'receipt', 'confidence': 0.8},
+            'merchant_name': {'value': 'CORNER CAFE', 'confidence': 0.8},
+            'total': {'value': '10.80', 'confidence': 0.9},
+            'subtotal': {'value': '10.00', 'confidence': 0.9},
+            'tax': {'value': '0.80', 'confidence': 0.8},
+            'line_items': {'value': [{'item_name': 'Latte', 'quantity': 2.0, 'unit_price': 5.0, 'total_price': 10.0}], 'confidence': 0.8}
+        }
+        
+        doc_id = insert_document('receipt.png')
+        with mock.patch.object(routes, 'process_document', return_value=results):
+            success, error = routes.process_single_document('receipt.png', 'receipt.png', doc_id)
+        self.assertTrue(success, error)
+        self.assertEqual(len(get_document_extractions(doc_id)), 5)
+        self.assertEqual(get_receipt_items(doc_id)[0]['item_name'], 'Latte')
+        
+        failed_id = insert_document('broken.png')
+        with mock.patch.object(routes, 'process_document', return_value=results), \
+             mock.patch.object(pipeline, 'validate_results', side_effect=RuntimeError('boom')):
+            success, error = routes.process_single_document('broken.png', 'broken.png', failed_id)
+        self.assertFalse(success)
+        self.assertEqual(get_document_extractions(failed_id), [])
+        statuses = {doc['filename']: doc['status'] for doc in routes.get_document_history()}
+        self.assertEqual(statuses, {'receipt.png': 'completed', 'broken.png': 'failed'})
+
+        # A batch job that runs twice stores and counts its document once
+        from database import insert_batch_job, get_batch_job
+        batch_id = insert_batch_job(1, 1)
+        batch_doc_id = insert_document('batch.png', 'unknown', batch_id)
+        with mock.patch.object(routes, 'process_document', return_value=results):
+            for _ in range(2):
+                routes.process_batch_document('batch.png', 'batch.png', batch_doc_id, batch_id)
+        self.assertEqual(len(get_document_extractions(batch_doc_id)), 5)
+        self.assertEqual((get_batch_job(batch_id)['processed_files'], get_batch_job(batch_id)['failed_files']), (1, 0))
+
+    def test_results_validated_in_memory_match_stored_validation(self):
+        """Test documents are validated before saving, with the same issues the stored rows produce"""
+        from database import insert_document, get_validation_issues
+        from pipeline import store_document_results
+        from processing import process_text
+        from validation import run_validation_checks
+        from benchmark import SAMPLE_LINES
+        results = process_text('\n'.join(SAMPLE_LINES))
+        doc_id = insert_document('receipt.png')
+
+        conn = get_db()
+        statements = []
+        conn.set_trace_callback(statements.append)
+        try:
+            store_document_results(doc_id, results)
+        finally:
+            conn.set_trace_callback(None)
+        # Nothing the document just wrote is read back
+        reads = [statement for statement in statements if statement.lstrip().upper().startswith('SELECT')]
+        self.assertFalse([statement for statement in reads if 'extractions' in statement or 'receipt_' in statement])
+
+        stored = [(issue['issue_type'], issue['severity'], issue['description']) for issue in get_validation_issues(doc_id)]
+        self.assertTrue(stored)
+        revalidated = [(issue['issue_type'], issue['severity'], issue['description']) for issue in run_validation_checks(doc_id)]
+        self.assertEqual(sorted(revalidated), sorted(stored))
+
+    def test_dates_are_parsed_once_at_extraction(self):
+        """Test extracted dates are stored in ISO form, which validation reads instead of the raw value"""
+        import datetime
+        from dates import parse_date, normalize_date
+        from database import insert_document, get_document_extractions, transaction
+        from pipeline import store_document_results
+        from processing import process_text
+        from validation import validate_document
+        self.assertEqual(parse_date('03/14/2024'), datetime.date(2024, 3, 14))
+        self.assertEqual(parse_date('14/03/2024'), datetime.date(2024, 3, 14))
+        self.assertEqual(parse_date(' 2024/3/14 '), datetime.date(2024, 3, 14))
+        self.assertEqual(normalize_date('03-14-24'), '2024-03-14')
+        for invalid in ('02/30/2024', '2024-13-01', '03/14-2024', '3/14/202', 'March 14', None):
+            self.assertIsNone(parse_date(invalid))
+
+        doc_id = insert_document('invoice.pdf')
+        store_document_results(doc_id, process_text('\n'.join(SAMPLE_INVOICE_LINES)))
+        stored = {row['field_name']: row for row in get_document_extractions(doc_id)}
+        self.assertEqual((stored['date']['field_value'], stored['date']['normalized_value']), ('03/14/2024', '2024-03-14'))
+
+        with transaction() as cursor:
+            cursor.execute("UPDATE extractions SET normalized_value = '2999-01-01' WHERE id = ?", (stored['date']['id'],))
+        issues = validate_document(doc_id, force=True)
+        self.assertTrue(any(issue['description'].startswith('Future date detected: 03/14/2024') for issue in issues))
+
+    def test_revalidation_diffs_issues_and_skips_unchanged_documents(self):
+        """Test revalidating replaces issues in place, keeps acknowledgements and skips unchanged documents"""
+        from unittest import mock
+        import validation
+        from database import (
+            insert_document, get_validation_issues, acknowledge_validation_issue, transaction,
+            insert_validation_issue, _collapse_repeated_issues
+        )
+        from pipeline import store_document_results
+        from processing import process_text
+        from benchmark import SAMPLE_LINES
+        doc_id = insert_document('receipt.png')
+        store_document_results(doc_id, process_text('\n'.join(SAMPLE_LINES)))
+        issues = get_validation_issues(doc_id)
+        missing = [issue for issue in issues if issue['issue_type'] == 'MISSING_DATA']
+        self.assertEqual(len(missing), 1)
+        acknowledge_validation_issue(missing[0]['id'])
+
+        # The state saved with the results matches the stored rows, so revalidation skips the rules
+        with mock.patch.object(validation, 'run_checks', wraps=validation.run_checks) as run_checks:
+            for _ in range(3):
+                validation.validate_document(doc_id)
+            self.assertEqual(run_checks.call_count, 0)
+            validation.validate_document(doc_id, force=True)
+            self.assertEqual(run_checks.call_count, 1)
+        self.assertEqual([issue['id'] for issue in get_validation_issues(doc_id)], [issue['id'] for issue in issues])
+
+        # Changing the total rewords the mismatch it still causes in place and raises the issues it causes now
+        def correct_total(total):
+            with transaction() as cursor:
+                cursor.execute("UPDATE extractions SET field_value = ? WHERE document_id = ? AND field_name = 'total'", (str(total), doc_id))
+                cursor.execute("UPDATE receipt_details SET total_amount = ? WHERE document_id = ?", (total, doc_id))
+            return validation.validate_document(doc_id)
+
+        mismatch = [issue for issue in issues if issue['issue_type'] == 'MATH_ERROR']
+        with mock.patch.object(validation, 'run_checks', wraps=validation.run_checks) as run_checks:
+            current = correct_total(5000000)
+            self.assertEqual(run_checks.call_count, 1)
+        self.assertTrue(any('Unusually high amount' in issue['description'] for issue in current))
+        self.assertEqual([issue['description'] for issue in current if issue['id'] == mismatch[0]['id']],
+                         ['Total ($5000000.00) does not match subtotal + tax ($18.25)'])
+
+        # Correcting it to subtotal + tax resolves both
+        current = correct_total(18.25)
+        self.assertFalse(any(issue['issue_type'] in ('MATH_ERROR', 'SUSPICIOUS_AMOUNT') for issue in current))
+        history = get_validation_issues(doc_id, include_resolved=True)
+        self.assertEqual(len(history), len({issue['fingerprint'] for issue in history}))
+        self.assertTrue(any(issue['resolved_date'] for issue in history))
+        self.assertEqual(validation.get_validation_summary(doc_id)['total_issues'], len(current))
+        # The missing vendor is unaffected, so its row and acknowledgement survive
+        self.assertEqual([issue['acknowledged'] for issue in current if issue['id'] == missing[0]['id']], [1])
+
+        # Migrating collapses the copies earlier revalidations appended
+        other_id = insert_document('legacy.png')
+        for acknowledged in (False, True, False):
+            issue_id = insert_validation_issue(other_id, 'MISSING_DATA', 'WARNING', 'Missing critical fields: vendor')
+            if acknowledged:
+                acknowledge_validation_issue(issue_id)
+        with transaction() as cursor:
+            _collapse_repeated_issues(cursor)
+        legacy = get_validation_issues(other_id)
+        self.assertEqual(len(legacy), 1)
+        self.assertTrue(legacy[0]['acknowledged'])
+        self.assertIsNotNone(legacy[0]['fingerprint'])
+
+    def test_issues_keep_their_identity_when_details_change(self):
+        """Test an issue's row and acknowledgement survive a new description, and date rules rerun as days pass"""
+        import datetime
+        from unittest import mock
+        import validation
+        from database import (
+            insert_document, transaction, get_validation_issues, acknowledge_validation_issue,
+            insert_validation_issue, _collapse_repeated_issues
+        )
+        from pipeline import store_document_results
+        from processing import process_text
+
+        def days_from_now(days):
+            class Shifted(datetime.datetime):
+                @classmethod
+                def now(cls, tz=None):
+                    return datetime.datetime.now(tz) + datetime.timedelta(days=days)
+            return mock.patch.object(validation, 'datetime', Shifted)
+
+        def future_date_issues(issues):
+            return [issue for issue in issues if issue['description'].startswith('Future date detected')]
+
+        doc_id = insert_document('invoice.pdf')
+        store_document_results(doc_id, process_text('\n'.join(SAMPLE_INVOICE_LINES)))
+        tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+        with transaction() as cursor:
+            cursor.execute(
+                "UPDATE extractions SET field_value = ?, normalized_value = ? WHERE document_id = ? AND field_name = 'date'",
+                (tomorrow.strftime('%m/%d/%Y'), tomorrow.isoformat(), doc_id)
+            )
+        future = future_date_issues(validation.validate_document(doc_id))
+        self.assertEqual(len(future), 1)
+        acknowledge_validation_issue(future[0]['id'])
+
+        # A day earlier the description names another today, but it is the same issue
+        with days_from_now(-1):
+            reworded = future_date_issues(validation.validate_document(doc_id, force=True))
+        self.assertEqual([(issue['id'], issue['acknowledged']) for issue in reworded], [(future[0]['id'], 1)])
+        self.assertNotEqual(reworded[0]['description'], future[0]['description'])
+
+        # Once the date has passed, an ordinary revalidation reruns the rules and resolves it
+        with days_from_now(2):
+            self.assertEqual(future_date_issues(validation.validate_document(doc_id)), [])
+
+        # Migrating merges rows stored under descriptions that have since changed
+        other_id = insert_document('copy.pdf')
+        first = insert_validation_issue(other_id, 'DUPLICATE', 'ERROR', 'Possible duplicate of document 1 (same vendor, amount and date)')
+        acknowledge_validation_issue(first)
+        insert_validation_issue(other_id, 'DUPLICATE', 'ERROR', 'Possible duplicate of document 1, 3 (same vendor, amount and date)')
+        with transaction() as cursor:
+            _collapse_repeated_issues(cursor)
+        merged = get_validation_issues(other_id)
+        self.assertEqual([(issue['id'], issue['acknowledged']) for issue in merged], [(first, 1)])
+        self.assertIn('document 1, 3', merged[0]['description'])
+
+    def test_vendor_and_industry_tip_issues_resolve_separately(self):
+        """Test the restaurant tip rules keep their own issues, and every row under a fingerprint is resolved"""
+        import validation
+        from database import insert_document, transaction, get_validation_issues, _collapse_repeated_issues
+        from pipeline import store_document_results
+        from processing import process_text
+        doc_id = insert_document('receipt.png')
+        store_document_results(doc_id, process_text('\n'.join([
+            'CORNER CAFE', 'Date: 03/14/2024 8:15 AM', 'Latte 2 x $4.50 $9.00', 'Subtotal: $9.00',
+            'Tax: $0.68', 'Tip: $0.20', 'Total: $9.88'
+        ])))
+
+        def tip_issues():
+            return [issue for issue in get_validation_issues(doc_id) if 'tip percentage for' in issue['description']]
+
+        vendor_tip, industry_tip = tip_issues()
+        vendor_fingerprint = validation.issue_fingerprint('SUSPICIOUS_AMOUNT', 'vendor_restaurant_tip')
+        industry_fingerprint = validation.issue_fingerprint('SUSPICIOUS_AMOUNT', 'industry_restaurant_tip')
+
+        # Rows stored when both rules shared a rule id and wording are told apart by the migration
+        shared_fingerprint = validation.issue_fingerprint('SUSPICIOUS_AMOUNT', 'restaurant_tip')
+        with transaction() as cursor:
+            cursor.execute("UPDATE validation_issues SET fingerprint = ?, description = ? WHERE id IN (?, ?)",
+                           (shared_fingerprint, vendor_tip['description'], vendor_tip['id'], industry_tip['id']))
+            _collapse_repeated_issues(cursor)
+        fingerprints = {row['id']: row['fingerprint'] for row in get_db().execute("SELECT id, fingerprint FROM validation_issues")}
+        self.assertEqual((fingerprints[vendor_tip['id']], fingerprints[industry_tip['id']]), (vendor_fingerprint, industry_fingerprint))
+
+        # Once the tip is corrected, every row stored under the fingerprint is resolved, not just one
+        with transaction() as cursor:
+            cursor.execute("UPDATE validation_issues SET fingerprint = ? WHERE id = ?", (vendor_fingerprint, industry_tip['id']))
+            cursor.execute("UPDATE receipt_details SET tip_amount = 2.0 WHERE document_id = ?", (doc_id,))
+        validation.validate_document(doc_id, force=True)
+        self.assertEqual(tip_issues(), [])
+
+    def test_bulk_revalidation_job_targets_subset(self):
+        """Test bulk revalidation runs as a queued job over a filtered subset and skips unchanged documents"""
+        from unittest import mock
+        import validation
+        from jobs import InlineJobQueue, set_job_queue
+        from database import insert_document, insert_batch_job, get_validation_issues
+        from pipeline import store_document_results
+        from processing import process_text
+        from revalidate import revalidate
+        from benchmark import SAMPLE_LINES
+        set_job_queue(InlineJobQueue())
+        results = process_text('\n'.join(SAMPLE_LINES))
+        batches = [insert_batch_job(1, 3), insert_batch_job(1, 2)]
+        documents = {batch_id: [] for batch_id in batches}
+        for batch_id, count in zip(batches, (3, 2)):
+            for number in range(count):
+                doc_id = insert_document(f'receipt-{number}.png', batch_id=batch_id)
+                store_document_results(doc_id, results)
+                documents[batch_id].append(doc_id)
+
+        response = self.client.post('/api/revalidate', json={'date_from': '03/14/2024'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post('/api/revalidate', json={'batch_id': batches[0], 'force': 'yes'})
+        self.assertEqual(response.status_code, 400)
+
+        # The 7.5% tax on the sample is no longer a standard rate under the new rules
+        with mock.patch.object(validation, 'STANDARD_TAX_RATES', [0.05, 0.10]), \
+             mock.patch.object(validation, 'RULESET_VERSION', 'test-2'):
+            response = self.client.post('/api/revalidate', json={'batch_id': batches[0]})
+            self.assertEqual(response.status_code, 202)
+            job = self.client.get(f"/api/revalidate/{response.get_json()['job_id']}").get_json()
+            self.assertEqual(job['status'], 'completed')
+            self.assertEqual((job['total_documents'], job['processed_documents'], job['changed_documents']), (3, 3, 3))
+            self.assertGreaterEqual(job['issues_added'], 3)
+            self.assertEqual(job['progress'], 100.0)
+            self.assertGreater(job['docs_per_second'], 0)
+            for doc_id in documents[batches[0]]:
+                self.assertTrue(any('Unusual tax rate' in issue['description'] for issue in get_validation_issues(doc_id)))
+            for doc_id in documents[batches[1]]:
+                self.assertFalse(any('Unusual tax rate' in issue['description'] for issue in get_validation_issues(doc_id)))
+
+            # Rerunning finds nothing changed, across a process pool as well
+            report = revalidate({'vendor': 'acme'}, workers=2, chunk_size=2)
+            self.assertEqual((report.total, report.processed, report.skipped, report.changed), (5, 5, 3, 2))
+            report = revalidate({'date_from': '2000-01-01'}, workers=1)
+            self.assertEqual((report.processed, report.skipped, report.failed), (5, 5, 0))
+            report = revalidate({'batch_id': batches[1]}, force=True)
+            self.assertEqual((report.processed, report.skipped, report.changed), (2, 0, 0))
+        self.assertEqual(revalidate({'vendor': 'no such vendor'}).total, 0)
+        # Wildcard characters in the vendor filter are plain text
+        from database import count_filtered_documents
+        self.assertEqual(count_filtered_documents({'vendor': 'acme'}), 5)
+        self.assertEqual([count_filtered_documents({'vendor': vendor}) for vendor in ('%', 'a_me', '\\')], [0, 0, 0])
+
+        # The string "false" does not force a rerun
+        for value, expected in (('false', 0), ('0', 0), (False, 0), ('true', 1), (1, 1)):
+            response = self.client.post('/api/revalidate', json={'batch_id': batches[1], 'force': value})
+            job_id = response.get_json()['job_id']
+            self.assertEqual(get_db().execute("SELECT force FROM revalidation_jobs WHERE id = ?", (job_id,)).fetchone()[0], expected)
+
+        # Revalidating one document reads force the same way
+        import routes
+        doc_id = documents[batches[1]][0]
+        with mock.patch.object(routes, 'validate_document', return_value=[]) as validate:
+            for value, expected in (('true', True), ('1', True), ('false', False), ('', False)):
+                self.assertEqual(self.client.get(f'/api/validate/{doc_id}?force={value}').status_code, 200)
+                self.assertEqual(validate.call_args.kwargs['force'], expected)
+            self.assertEqual(self.client.get(f'/api/validate/{doc_id}?force=maybe').status_code, 400)
+
+    def test_invoice_validation_without_receipt_details(self):
+        """Test invoices, which have no receipt details, validate cleanly"""
+        from validation import validate_mathematical_rules
+        self.assertEqual(validate_mathematical_rules({}, [], None), [])
+
+    def test_duplicate_invoices_flagged_by_fingerprint(self):
+        """Test exact and near-duplicate documents get DUPLICATE issues from indexed fingerprint lookups"""
+        from database import insert_document, get_validation_issues
+        from pipeline import store_document_results
+        from duplicates import text_minhash, minhash_similarity
+        text = '\n'.join(SAMPLE_INVOICE_LINES)
+        invoice = {
+            'document_type': {'value': 'invoice', 'confidence': 0.9},
+            'invoice_number': {'value': 'INV-0042', 'confidence': 0.9},
+            'vendor': {'value': 'Acme Office Supply, Inc.', 'confidence': 0.9},
+            'date': {'value': '03/14/2024', 'confidence': 0.9},
+            'total': {'value': '1,250.00', 'confidence': 0.9},
+            'text_minhash': {'value': text_minhash(text), 'confidence': 1.0}
+        }
+        # The same invoice scanned again: punctuation and case differ, and OCR misread a word
+        rescanned = dict(invoice, invoice_number={'value': 'INV 0042', 'confidence': 0.9},
+                         vendor={'value': 'ACME OFFICE SUPPLY', 'confidence': 0.9},
+                         total={'value': '1250.0', 'confidence': 0.9},
+                         text_minhash={'value': text_minhash(text.replace('Consulting', 'Consu1ting')), 'confidence': 1.0})
+        self.assertGreaterEqual(minhash_similarity(invoice['text_minhash']['value'], rescanned['text_minhash']['value']), 0.85)
+        # A different invoice from the same vendor shares the layout but not the details
+        other_text = text.replace('INV-0042', 'INV-0057').replace('1,250.00', '310.00').replace('Consulting', 'Printer toner')
+        other = dict(invoice, invoice_number={'value': 'INV-0057', 'confidence': 0.9},
+                     total={'value': '310.00', 'confidence': 0.9},
+                     text_minhash={'value': text_minhash(other_text), 'confidence': 1.0})
+
+        first_id = insert_document('first.pdf')
+        store_document_results(first_id, invoice)
+        self.assertEqual([issue for issue in get_validation_issues(first_id) if issue['issue_type'] == 'DUPLICATE'], [])
+
+        second_id = insert_document('second.pdf')
+        store_document_results(second_id, rescanned)
+        duplicates = [issue for issue in get_validation_issues(second_id) if issue['issue_type'] == 'DUPLICATE']
+        self.assertEqual([issue['severity'] for issue in duplicates], ['ERROR'])
+        self.assertIn(f'document {first_id}', duplicates[0]['description'])
+
+        # Text alone flags a near duplicate whose fields were extracted differently
+        third_id = insert_document('third.pdf')
+        store_document_results(third_id, dict(rescanned, date={'value': '2024-03-15', 'confidence': 0.5}))
+        duplicates = [issue for issue in get_validation_issues(third_id) if issue['issue_type'] == 'DUPLICATE']
+        self.assertEqual([issue['severity'] for issue in duplicates], ['WARNING'])
+        self.assertIn('nearly identical', duplicates[0]['description'])
+
+        fourth_id = insert_document('fourth.pdf')
+        store_document_results(fourth_id, other)
+        self.assertEqual([issue for issue in get_validation_issues(fourth_id) if issue['issue_type'] == 'DUPLICATE'], [])
+
+        conn = get_db()
+        statements = []
+        conn.set_trace_callback(statements.append)
+        try:
+            store_document_results(insert_document('fifth.pdf'), rescanned)
+        finally:
+            conn.set_trace_callback(None)
+        for statement in statements:
+            if 'document_text_bands WHERE' in statement or 'exact_key =' in statement:
+                plan = ' '.join(row['detail'] for row in conn.execute(f"EXPLAIN QUERY PLAN {statement}"))
+                self.assertNotIn('SCAN document_fingerprints', plan)
+                self.assertNotIn('SCAN document_text_bands', plan)
+
+        # Only later copies are flagged: revalidating the original finds no duplicates
+        from validation import validate_document
+        self.assertEqual([issue for issue in validate_document(first_id, force=True) if issue['issue_type'] == 'DUPLICATE'], [])
+
+    def test_hot_queries_use_indexes(self):
+        """Test the per-document and per-batch queries in database.py are index lookups"""
+        import database
+        conn = get_db()
+        statements = []
+        conn.set_trace_callback(statements.append)
+        try:
+            database.get_document_extractions(1)
+            database.get_receipt_items(1)
+            database.get_receipt_details(1)
+            database.get_validation_issues(1)
+            database.get_unacknowledged_issues_count(1)
+            database.get_batch_documents(1)
+            database.get_batch_history(1)
+        finally:
+            conn.set_trace_callback(None)
+        
+        self.assertEqual(len(statements), 7)
+        for sql in statements:
+            plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}")]
+            for step in plan:
+                # Every table is reached by an index search, with no full scans or sorts
+                self.assertTrue(step.startswith('SEARCH'), f'{sql}: {plan}')
+                self.assertIn('USING', step, sql)
+
+    def test_batch_endpoints_use_constant_queries(self):
+        """Test batch results and downloads issue the same number of statements for any batch size"""
+        from database import insert_batch_job, insert_document, save_document_results
+
+        def create_batch(size):
+            batch_id = insert_batch_job(1, size)
+            for i in range(size):
+                doc_id = insert_document(f'receipt_{i}.png', 'receipt', batch_id)
+                save_document_results(
+                    doc_id, 'receipt', [('total', '10.80', 0.9), ('merchant_name', 'CORNER CAFE', 0.8)],
+                    receipt_details={'merchant_name': 'CORNER CAFE', 'total_amount': '10.80'},
+                    receipt_items=[{'item_name': 'Latte', 'quantity': 2.0, 'unit_price': 5.4, 'total_price': 10.8}],
+                    status='completed'
+                )
+            return batch_id
+
+        def count_statements(method, url, **kwargs):
+            conn = get_db()
+            statements = []
+            conn.set_trace_callback(statements.append)
+            try:
+                response = getattr(self.client, method)(url, **kwargs)
+            finally:
+                conn.set_trace_callback(None)
+            self.assertEqual(response.status_code, 200)
+            return len(statements), response
+
+        small, large = create_batch(2), create_batch(12)
+        for method, path, kwargs in [
+            ('get', '/api/batch-results/{}', {}),
+            ('post', '/api/download-batch/{}', {'json': {'format': 'json'}}),
+            ('post', '/api/download-batch/{}', {'json': {'format': 'csv'}}),
+        ]:
+            small_count, _ = count_statements(method, path.format(small), **kwargs)
+            large_count, response = count_statements(method, path.format(large), **kwargs)
+            self.assertEqual(small_count, large_count, path)
+
+        data = self.client.get(f'/api/batch-results/{large}').get_json()
+        self.assertEqual(len(data['results']), 12)
+        first = data['results'][0]
+        self.assertEqual(first['results']['total']['value'], '10.80')
+        self.assertEqual(first['receipt_details']['merchant_name'], 'CORNER CAFE')
+        self.assertEqual(first['receipt_items'][0]['item_name'], 'Latte')
+
+    def test_streaming_batch_export(self):
+        """Test CSV and NDJSON batch exports stream rows across small fetch chunks"""
+        import json
+        from unittest import mock
+        from database import insert_batch_job, insert_document, save_document_results
+        batch_id = insert_batch_job(1, 3)
+        for i, fields in enumerate([[('total', '1.00', 0.9), ('vendor', 'ACME', 0.7)], [], [('total', '3.00', 0.9)]]):
+            doc_id = insert_document(f'doc_{i}.pdf', 'invoice', batch_id)
+            save_document_results(doc_id, 'invoice', fields, status='completed')
+
+        # Fetch one row at a time so a document's rows straddle chunks
+        with mock.patch.object(Config, 'EXPORT_FETCH_SIZE', 1):
+            response = self.client.post(f'/api/download-batch/{batch_id}', json={'format': 'csv'})
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.is_streamed)
+            lines = response.get_data(as_text=True).splitlines()
+            self.assertEqual(lines[0], 'Filename,Field Name,Field Value,Confidence Score')
+            self.assertEqual(sorted(lines[1:]), ['doc_0.pdf,total,1.00,0.9', 'doc_0.pdf,vendor,ACME,0.7', 'doc_2.pdf,total,3.00,0.9'])
+
+            response = self.client.post(f'/api/download-batch/{batch_id}', json={'format': 'ndjson'})
+            records = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual([record['filename'] for record in records], ['doc_0.pdf', 'doc_1.pdf', 'doc_2.pdf'])
+        self.assertEqual(records[0]['results']['vendor'], {'value': 'ACME', 'confidence': 0.7})
+        self.assertEqual(records[1]['results'], {})
+
+        response = self.client.get(f"/api/export/{records[2]['document_id']}/ndjson")
+        self.assertEqual(json.loads(response.get_data(as_text=True)),
+                         {'field_name': 'total', 'field_value': '3.00', 'confidence_score': 0.9})
+
+    def create_columnar_batch(self):
+        """Create a batch with one receipt (with items) and one document with no results"""
+        from database import insert_batch_job, insert_document, save_document_results
+        batch_id = insert_batch_job(1, 2)
+        doc_id = insert_document('receipt.png', 'receipt', batch_id)
+        save_document_results(
+            doc_id, 'receipt', [('total', '12.50', 0.9), ('tax', 'n/a', 0.2), ('date', '03/14/2024', 0.8)],
+            receipt_items=[{'item_name': 'Latte', 'quantity': 2.0, 'unit_price': 6.25, 'total_price': 12.5}],
+            status='completed'
+        )
+        insert_document('blank.png', 'unknown', batch_id)
+        return batch_id
+
+    def test_columnar_pivot_is_typed(self):
+        """Test the batch pivot returns one typed row per document"""
+        import datetime
+        from database import iter_batch_pivot_rows
+        from exports import parse_date
+        batch_id = self.create_columnar_batch()
+        rows = [row for rows in iter_batch_pivot_rows(batch_id, ['total', 'tax', 'date'], {'total', 'tax'}) for row in rows]
+        self.assertEqual([row['filename'] for row in rows], ['receipt.png', 'blank.png'])
+        # filename .. upload_date, then (value, confidence) per field
+        self.assertEqual(tuple(rows[0])[5:], (12.5, 0.9, None, 0.2, '03/14/2024', 0.8))
+        self.assertEqual(tuple(rows[1])[5:], (None,) * 6)
+        self.assertEqual(parse_date('03/14/2024'), datetime.date(2024, 3, 14))
+        self.assertEqual(parse_date('2024-03-14'), datetime.date(2024, 3, 14))
+        self.assertIsNone(parse_date('14th March'))
+
+    @unittest.skipUnless(REQUIRE_OPTIONAL_DEPENDENCIES or importlib.util.find_spec('pyarrow'), 'pyarrow is not installed')
+    def test_parquet_batch_export(self):
+        """Test the Parquet export zips a typed documents table and an items table"""
+        import zipfile
+        import pyarrow.parquet as pq
+        batch_id = self.create_columnar_batch()
+        response = self.client.post(f'/api/download-batch/{batch_id}', json={'format': 'parquet'})
+        self.assertEqual(response.status_code, 200)
+        with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+            documents = pq.read_table(io.BytesIO(archive.read('documents.parquet')))
+            items = pq.read_table(io.BytesIO(archive.read('receipt_items.parquet')))
+        self.assertEqual(documents.num_rows, 2)
+        self.assertEqual(str(documents.schema.field('total').type), 'double')
+        self.assertEqual(str(documents.schema.field('date').type), 'date32[day]')
+        self.assertEqual(documents.column('total').to_pylist(), [12.5, None])
+        self.assertEqual(items.column('item_name').to_pylist(), ['Latte'])
+
+    @unittest.skipIf(importlib.util.find_spec('pyarrow'), 'pyarrow is installed')
+    def test_parquet_batch_export_without_pyarrow(self):
+        """Test the Parquet export explains the missing optional dependency"""
+        batch_id = self.create_columnar_batch()
+        response = self.client.post(f'/api/download-batch/{batch_id}', json={'format': 'parquet'})
+        self.assertEqual(response.status_code, 500)
+        self.assertIn('requires pyarrow', response.get_json()['error'])
+
+    def test_ingest_directory_and_zip_resumes(self):
+        """Test the bulk ingester loads directories and zip members, and skips them when re-run"""
+        import zipfile
+        from unittest import mock
+        from database import get_batch_job, get_batch_documents, get_document_extractions
+        from ingest import ingest
+        source_dir = os.path.join(self.temp_dir.name, 'scans')
+        os.makedirs(os.path.join(source_dir, 'march'))
+        write_text_pdf(os.path.join(source_dir, 'invoice_1.pdf'), ['Invoice # INV-101', 'Bill To: Example Corp', 'Amount Due: $120.50'])
+        write_text_pdf(os.path.join(source_dir, 'march', 'invoice_2.pdf'), ['Invoice # INV-102', 'Bill To: Example Corp', 'Amount Due: $80.00'])
+        with open(os.path.join(source_dir, 'march', 'broken.pdf'), 'w') as file:
+            file.write('not a pdf')
+        member_path = os.path.join(self.temp_dir.name, 'invoice_3.pdf')
+        write_text_pdf(member_path, ['Invoice # INV-103', 'Bill To: Example Corp', 'Amount Due: $42.00'])
+        with zipfile.ZipFile(os.path.join(source_dir, 'archive.zip'), 'w') as archive:
+            archive.write(member_path, 'april/invoice_3.pdf')
+            archive.writestr('notes.txt', 'ignored')
+
+        with mock.patch.object(Config, 'EXTRACTION_CACHE_ENABLED', False):
+            report = ingest([source_dir], workers=2, commit_every=2, report_interval=60)
+            self.assertEqual((report.completed, report.failed, report.skipped), (3, 1, 0))
+            
+            documents = get_batch_documents(report.batch_id)
+            self.assertEqual(sorted(doc['filename'] for doc in documents), ['april_invoice_3.pdf', 'broken.pdf', 'invoice_1.pdf', 'invoice_2.pdf'])
+            totals = {doc['filename']: {e['field_name']: e['field_value'] for e in get_document_extractions(doc['id'])}.get('total')
+                      for doc in documents}
+            self.assertEqual(totals['april_invoice_3.pdf'], '42.00')
+            batch_job = get_batch_job(report.batch_id)
+            self.assertEqual((batch_job['status'], batch_job['total_files'], batch_job['failed_files']), ('completed', 4, 1))
+            
+            # A second run finds everything already ingested
+            report = ingest([source_dir], workers=2, commit_every=2, report_interval=60)
+            self.assertEqual((report.completed, report.failed, report.skipped), (0, 0, 4))
+
+        # A worker opens an archive once for all of its members, not once per member
+        import ingest as ingest_module
+        large_path = os.path.join(self.temp_dir.name, 'large.zip')
+        with zipfile.ZipFile(large_path, 'w') as archive:
+            for index in range(5):
+                archive.write(member_path, f'scans/invoice_{index}.pdf')
+        sources = list(ingest_module.iter_file_sources(large_path))
+        with mock.patch.dict(ingest_module._open_archive, clear=True), \
+             mock.patch.object(ingest_module.zipfile, 'ZipFile', wraps=zipfile.ZipFile) as open_zip, \
+             mock.patch.object(ingest_module, 'process_document', lambda path: {'size': os.path.getsize(path)}):
+            results = [ingest_module.ingest_one(*source) for source in sources]
+            ingest_module._open_archive['archive'].close()
+        self.assertEqual(open_zip.call_count, 1)
+        self.assertEqual([result[1]['size'] for result in results], [os.path.getsize(member_path)] * 5)
+
+    def test_upload_batch_streams_zip_members(self):
+        """Test ZIP uploads queue members from nested folders and enforce the archive limits"""
+        import zipfile
+        from unittest import mock
+        from archives import ArchiveLimitError, archive_members
+        from jobs import InlineJobQueue, set_job_queue
+        set_job_queue(InlineJobQueue())
+        pdf_path = os.path.join(self.temp_dir.name, 'invoice.pdf')
+        write_text_pdf(pdf_path, ['Invoice # INV-200', 'Bill To: Example Corp', 'Amount Due: $75.00'])
+
+        upload = io.BytesIO()
+        with zipfile.ZipFile(upload, 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.write(pdf_path, 'top.pdf')
+            archive.write(pdf_path, 'march/week1/nested.pdf')
+            archive.writestr('readme.txt', 'not a document')
+        upload.seek(0)
+
+        with mock.patch.object(Config, 'UPLOAD_FOLDER', self.temp_dir.name), \
+             mock.patch.object(Config, 'EXTRACTION_CACHE_ENABLED', False):
+            response = self.client.post('/api/upload-batch', data={'files': [(upload, 'scans.zip')]},
+                                        content_type='multipart/form-data')
+        data = response.get_json()
+        self.assertEqual((data['queued_count'], data['failed_count']), (2, 1))
+        batch_id = data['batch_id']
+        self.assertTrue(os.path.exists(os.path.join(self.temp_dir.name, f'{batch_id}_march_week1_nested.pdf')))
+        results = self.client.get(f'/api/batch-results/{batch_id}').get_json()['results']
+        self.assertEqual([result['status'] for result in results], ['completed', 'completed'])
+
+        # Limits are checked against the central directory before anything is extracted
+        bomb = io.BytesIO()
+        with zipfile.ZipFile(bomb, 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr('zeros.pdf', b'\0' * (4 * 1024 * 1024))
+            archive.writestr('small.pdf', b'%PDF')
+        with zipfile.ZipFile(bomb) as archive:
+            with self.assertRaises(ArchiveLimitError):
+                archive_members(archive)
+            with self.assertRaises(ArchiveLimitError):
+                archive_members(archive, max_members=1, max_ratio=10000)
+            with self.assertRaises(ArchiveLimitError):
+                archive_members(archive, max_total_bytes=1024, max_ratio=10000)
+            self.assertEqual(len(archive_members(archive, max_ratio=10000)), 2)
+
+    def test_chunked_upload_resumes_and_commits(self):
+        """Test a ZIP uploaded in chunks is assembled on disk, rejects bad offsets and is queued on commit"""
+        import hashlib
+        import zipfile
+        from unittest import mock
+        from jobs import InlineJobQueue, set_job_queue
+        set_job_queue(InlineJobQueue())
+        pdf_path = os.path.join(self.temp_dir.name, 'invoice.pdf')
+        write_text_pdf(pdf_path, ['Invoice # INV-300', 'Bill To: Example Corp', 'Amount Due: $90.00'])
+
+        upload = io.BytesIO()
+        with zipfile.ZipFile(upload, 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.write(pdf_path, 'first.pdf')
+            archive.write(pdf_path, 'scans/second.pdf')
+        payload = upload.getvalue()
+        middle = len(payload) // 2
+
+        with mock.patch.object(Config, 'UPLOAD_FOLDER', self.temp_dir.name), \
+             mock.patch.object(Config, 'UPLOAD_PARTS_FOLDER', os.path.join(self.temp_dir.name, 'parts')), \
+             mock.patch.object(Config, 'EXTRACTION_CACHE_ENABLED', False):
+            response = self.client.post('/api/uploads', json={
+                'filename': 'scans.zip', 'total_size': len(payload), 'sha256': hashlib.sha256(payload).hexdigest()
+            })
+            self.assertEqual(response.status_code, 201)
+            upload_id = response.get_json()['upload_id']
+
+            response = self.client.put(f'/api/uploads/{upload_id}?offset=0', data=payload[:middle])
+            self.assertEqual(response.get_json()['received_bytes'], middle)
+
+            # A resent or skipped chunk is refused with the offset to resume from
+            response = self.client.put(f'/api/uploads/{upload_id}?offset=0', data=payload[:middle])
+            self.assertEqual((response.status_code, response.get_json()['received_bytes']), (409, middle))
+            response = self.client.post(f'/api/uploads/{upload_id}/commit')
+            self.assertEqual(response.status_code, 409)
+
+            self.client.put(f'/api/uploads/{upload_id}?offset={middle}', data=payload[middle:])
+            self.assertEqual(self.client.get(f'/api/uploads/{upload_id}').get_json()['received_bytes'], len(payload))
+
+            response = self.client.post(f'/api/uploads/{upload_id}/commit')
+            self.assertEqual(response.status_code, 202)
+            data = response.get_json()
+            self.assertEqual((data['queued_count'], data['failed_count']), (2, 0))
+            self.assertFalse(os.path.exists(os.path.join(self.temp_dir.name, 'parts', f'{upload_id}.part')))
+
+            # Committing twice cannot queue the documents again
+            self.assertEqual(self.client.post(f'/api/uploads/{upload_id}/commit').status_code, 409)
+
+        status = self.client.get(f'/api/uploads/{upload_id}').get_json()
+        self.assertEqual((status['status'], status['batch_id']), ('committed', data['batch_id']))
+        results = self.client.get(f"/api/batch-results/{data['batch_id']}").get_json()['results']
+        self.assertEqual([result['status'] for result in results], ['completed', 'completed'])
+
+    def test_abandoned_chunked_uploads_expire(self):
+        """Test sessions idle past the TTL are expired with their part files when a new upload starts"""
+        from unittest import mock
+        from database import transaction
+        parts_folder = os.path.join(self.temp_dir.name, 'parts')
+        with mock.patch.object(Config, 'UPLOAD_PARTS_FOLDER', parts_folder):
+            abandoned = self.client.post('/api/uploads', json={'filename': 'old.zip'}).get_json()['upload_id']
+            active = self.client.post('/api/uploads', json={'filename': 'new.zip'}).get_json()['upload_id']
+            self.client.put(f'/api/uploads/{abandoned}?offset=0', data=b'partial')
+            with transaction() as cursor:
+                cursor.execute("UPDATE upload_sessions SET updated_date = datetime('now', '-2 days') WHERE id = ?",
+                               (abandoned,))
+
+            self.client.post('/api/uploads', json={'filename': 'another.zip'})
+
+            self.assertEqual(self.client.get(f'/api/uploads/{abandoned}').get_json()['status'], 'expired')
+            self.assertFalse(os.path.exists(os.path.join(parts_folder, f'{abandoned}.part')))
+            self.assertEqual(self.client.put(f'/api/uploads/{abandoned}?offset=7', data=b'more').status_code, 409)
+            self.assertEqual(self.client.get(f'/api/uploads/{active}').get_json()['status'], 'open')
+            self.assertTrue(os.path.exists(os.path.join(parts_folder, f'{active}.part')))
+
+    def test_process_text_extracts_receipt_fields(self):
+        """Test the shared-view extractors on a sample receipt"""
+        from processing import process_text
+        text = '\n'.join([
+            'CORNER CAFE', '42 Main Street Springfield', 'Date: 03/14/2024 8:15 AM',
+            'Latte 2 x $4.50 $9.00', 'Subtotal: $9.00', 'Tax: $0.68', 'Total: $9.68',
+            'VISA ****1234', 'Thank you'
+        ])
+        results = process_text(text)
+        self.assertEqual(results['document_type']['value'], 'receipt')
+        self.assertEqual(results['merchant_name']['value'], 'CORNER CAFE')
+        self.assertEqual(results['date']['value'], '03/14/2024')
+        self.assertEqual(results['tax']['value'], '0.68')
+        self.assertEqual(results['payment_method']['value'], 'credit')
+        self.assertEqual(results['category']['value'], 'Food & Dining')
+        self.assertEqual(results['line_items']['value'], [
+            {'item_name': 'Latte', 'quantity': 2.0, 'unit_price': 4.5, 'total_price': 9.0}
+        ])
+
+    def test_keyword_index_matches_overlapping_keywords(self):
+        """Test the keyword automaton against substring matching, including configured tables"""
+        import json
+        from keywords import KeywordAutomaton, KeywordIndex, load_keyword_tables
+        keywords = ['cash', 'cashier', 'ash', 'he', 'she', 'hers', 'credit card', 'card']
+        for text in ['cashier: shelly', 'ushers paid by credit card', 'nothing here', 'cas', '']:
+            expected = {keyword for keyword in keywords if keyword in text}
+            self.assertEqual(KeywordAutomaton(keywords).find(text), expected, text)
+
+        # Extra keywords from the configured file extend the built-in tables
+        path = os.path.join(self.temp_dir.name, 'keywords.json')
+        with open(path, 'w') as file:
+            json.dump({'expense_categories': {'Grocery': ['Trader Joes'], 'Pets': ['petco']}}, file)
+        index = KeywordIndex(load_keyword_tables(path))
+        self.assertEqual(index.first_group(index.scan('trader joes #12'), 'expense_categories'), 'Grocery')
+        self.assertEqual(index.first_group(index.scan('petco store'), 'expense_categories'), 'Pets')
+        self.assertEqual(index.first_group(index.scan('coffee at the market'), 'expense_categories'), 'Food & Dining')
+        self.assertIsNone(index.first_group(index.scan('plain text'), 'payment_methods'))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -1,32 +1,199 @@
+import hashlib
+import json
 import re
 from datetime import datetime
 from database import (
-    get_document_extractions, get_receipt_items, get_receipt_details, 
-    insert_validation_issue, get_validation_issues
+    transaction, get_document_extractions, get_receipt_items, get_receipt_details,
+    get_validation_issues, apply_validation_issues, get_validation_state, set_validation_state
 )
+from keywords import get_keyword_index
+from duplicates import find_duplicates, duplicate_issues, stored_minhash
+from dates import parse_date
 
 # Standard tax rates to check against
 STANDARD_TAX_RATES = [0.05, 0.075, 0.10, 0.15]  # 5%, 7.5%, 10%, 15%
 
-def validate_document(document_id):
-    """Run all validation checks on a document"""
-    # Clear any existing validation issues for this document
-    # (In a real implementation, you might want to be more selective about this)
+# Bump whenever a rule changes, so documents validated under older rules are checked again
+RULESET_VERSION = '3'
+
+# Columns of stored receipt rows that rules read (ids and timestamps are left out of input hashes)
+RECEIPT_ITEM_FIELDS = ('item_name', 'quantity', 'unit_price', 'total_price')
+RECEIPT_DETAIL_FIELDS = (
+    'merchant_name', 'location', 'payment_method', 'tip_amount', 'subtotal',
+    'tax_amount', 'total_amount', 'cashier_name', 'transaction_time', 'category'
+)
+DECIMAL_TEXT = re.compile(r'-?\d+\.\d+')
+
+# How each rule's description starts, to tell which rule raised an issue stored before issues
+# carried their rule; more specific prefixes come first
+ISSUE_RULE_PREFIXES = [
+    ('Line items sum', 'line_items_subtotal'),
+    ('Unusual tax rate:', 'tax_rate'),
+    ('Total (', 'total_subtotal_tax'),
+    ('Unusual tip percentage for restaurant:', 'vendor_restaurant_tip'),
+    ('Unusual tip percentage for Food & Dining:', 'industry_restaurant_tip'),
+    ('Unusual tip percentage:', 'tip_percentage'),
+    ('Error in mathematical validation:', 'math_error'),
+    ('Unusually high amount:', 'high_amount'),
+    ('Unusually low amount:', 'low_amount'),
+    ('Future date detected:', 'future_date'),
+    ('Weekend transaction outside', 'weekend_hours'),
+    ('Error in business rule validation:', 'business_error'),
+    ('Missing critical fields:', 'missing_fields'),
+    ('Low confidence OCR extractions:', 'low_confidence'),
+    ('Negative amounts detected', 'negative_amounts'),
+    ('Invalid date format:', 'date_format'),
+    ('Unusual gas purchase amount:', 'gas_amount'),
+    ('Unusual grocery purchase amount:', 'grocery_amount'),
+    ('Error in vendor-specific validation:', 'vendor_error'),
+    ('Unusual transportation amount:', 'transportation_amount'),
+    ('Unusual office supplies amount:', 'office_supplies_amount'),
+    ('Error in industry-specific validation:', 'industry_error'),
+    ('Possible duplicate of document', 'duplicate'),
+    ('Text nearly identical to document', 'near_duplicate'),
+]
+
+# Both tip rules once worded their issue as the vendor rule does; it runs first, so a second
+# such issue from the same run came from the rule mapped to here
+SHARED_WORDING_RULES = {'vendor_restaurant_tip': 'industry_restaurant_tip'}
+
+def validate_document(document_id, force=False):
+    """Revalidate a document's stored data, updating its issues in place, and return its open issues
+
+    Documents whose inputs and rule set are unchanged since they were last validated skip the
+    rules unless force is set. Otherwise only the differences are written: new issues are
+    inserted, issues no longer found are resolved, and acknowledgements are kept.
+    """
+    with transaction():
+        extracted_data, receipt_items, receipt_details = load_validation_inputs(document_id)
+        revalidation = revalidate_inputs(
+            document_id, extracted_data, receipt_items, receipt_details,
+            stored_minhash(document_id), get_validation_state(document_id), force
+        )
+        if revalidation is not None:
+            store_revalidation(document_id, *revalidation)
     
-    # Get document data
+    return get_validation_issues(document_id)
+
+def revalidate_inputs(document_id, extracted_data, receipt_items, receipt_details, minhash, validation_state, force=False):
+    """Run the rules on a stored document's inputs unless they were already validated under this rule set
+
+    Returns (issues, validation_state) to store, or None when the document is unchanged.
+    """
+    # Duplicate lookups read other documents, so their matches are part of the inputs
+    duplicates = find_duplicates(document_id, extracted_data, minhash)
+    input_hash = validation_input_hash(extracted_data, receipt_items, receipt_details, duplicates)
+    if not force and validation_state == (RULESET_VERSION, input_hash):
+        return None
+    issues = run_checks(document_id, extracted_data, receipt_items, receipt_details, duplicates=duplicates)
+    return issues, (RULESET_VERSION, input_hash)
+
+def store_revalidation(document_id, issues, validation_state):
+    """Write a revalidation's issue diff and state, returning (inserted, resolved, reopened)"""
+    with transaction():
+        counts = apply_validation_issues(document_id, issues)
+        set_validation_state(document_id, *validation_state)
+    return counts
+
+def extracted_data_from_rows(extractions):
+    """Key stored extraction rows by field name, as the rules read them"""
+    return {
+        extraction['field_name']: {
+            'value': extraction['field_value'],
+            'confidence': extraction['confidence_score'],
+            'normalized': extraction.get('normalized_value')
+        }
+        for extraction in extractions
+    }
+
+def load_validation_inputs(document_id):
+    """Read the fields, receipt items and receipt details validation runs on from the database"""
     extractions = get_document_extractions(document_id)
     receipt_items = get_receipt_items(document_id)
     receipt_details = get_receipt_details(document_id)
+    return extracted_data_from_rows(extractions), receipt_items, receipt_details
+
+def run_validation_checks(document_id):
+    """Run all validation checks on a document's stored data without storing the issues"""
+    extracted_data, receipt_items, receipt_details = load_validation_inputs(document_id)
+    return run_checks(document_id, extracted_data, receipt_items, receipt_details, stored_minhash(document_id))
+
+def _hash_value(value):
+    """Put a value in one form whether it came from extraction results or back from SQLite"""
+    if isinstance(value, (list, dict)):
+        # Serialized exactly as database.save_document_results stores it
+        return json.dumps(value)
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return repr(float(value))
+    # Amounts are strings like "10.80" in results but 10.8 once stored in a REAL column
+    if isinstance(value, str) and DECIMAL_TEXT.fullmatch(value):
+        return repr(float(value))
+    return value
+
+def _is_future_date(extracted_data):
+    """Tell whether a document's date is after today"""
+    parsed_date = field_date(extracted_data['date']) if extracted_data.get('date') else None
+    return bool(parsed_date and parsed_date > datetime.now().date())
+
+def validation_input_hash(extracted_data, receipt_items, receipt_details, duplicates):
+    """Hash everything the rules read, so revalidation can tell when nothing has changed"""
+    payload = {
+        'fields': {name: [_hash_value(data['value']), data['confidence']] for name, data in extracted_data.items()},
+        'items': [[_hash_value(item.get(field)) for field in RECEIPT_ITEM_FIELDS] for item in receipt_items],
+        'details': [_hash_value((receipt_details or {}).get(field)) for field in RECEIPT_DETAIL_FIELDS] if receipt_details else None,
+        'duplicates': list(duplicates),
+        # The future date rule depends on today as well, so passing the date reruns the rules
+        'future_date': _is_future_date(extracted_data)
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+
+def field_date(field_data):
+    """Get a date field's value as a date, from the ISO form stored at extraction when there is one"""
+    return parse_date(field_data.get('normalized') or field_data.get('value'))
+
+def issue_fingerprint(issue_type, rule):
+    """Identify an issue across validation runs by the rule that raised it
     
-    # Convert extractions to a dictionary for easier access
-    extracted_data = {}
-    for extraction in extractions:
-        extracted_data[extraction['field_name']] = {
-            'value': extraction['field_value'],
-            'confidence': extraction['confidence_score']
-        }
-    
-    # Run validation checks
+    Descriptions carry details that change between runs (amounts, today's date, the ids of
+    matching documents), so they are left out and a rerun updates the stored issue in place.
+    """
+    return hashlib.sha1(f"{issue_type}|{rule}".encode('utf-8')).hexdigest()
+
+def stored_issue_fingerprint(issue_type, description, repeated_in_run=False):
+    """Fingerprint an issue stored before issues carried their rule, recognising the rule by its description
+
+    repeated_in_run says the same run already stored an issue worded this way, which tells the
+    rules that once shared their wording apart.
+    """
+    for prefix, rule in ISSUE_RULE_PREFIXES:
+        if description.startswith(prefix):
+            if repeated_in_run:
+                rule = SHARED_WORDING_RULES.get(rule, rule)
+            return issue_fingerprint(issue_type, rule)
+    return issue_fingerprint(issue_type, description)
+
+def validate_results(document_id, extractions, receipt_details=None, receipt_items=None, minhash=None):
+    """Run all validation checks on a processed document's records before they are stored
+
+    Takes the records pipeline.results_to_records splits process_document results into, so
+    the issues match what validating the stored rows would find. Returns (issues, validation
+    state), the state being the (ruleset_version, input_hash) to store with the issues.
+    """
+    extracted_data = {
+        field_name: {'value': field_value, 'confidence': confidence_score, 'normalized': normalized[0] if normalized else None}
+        for field_name, field_value, confidence_score, *normalized in extractions
+    }
+    receipt_items = receipt_items or []
+    duplicates = find_duplicates(document_id, extracted_data, minhash)
+    input_hash = validation_input_hash(extracted_data, receipt_items, receipt_details, duplicates)
+    issues = run_checks(document_id, extracted_data, receipt_items, receipt_details, duplicates=duplicates)
+    return issues, (RULESET_VERSION, input_hash)
+
+def run_checks(document_id, extracted_data, receipt_items, receipt_details, minhash=None, duplicates=None):
+    """Run all validation checks on a document's fields, receipt items and receipt details
+
+    duplicates is the result of duplicates.find_duplicates, when the caller has already looked them up.
+    """
     validation_issues = []
     
     # 1. Mathematical validation
@@ -49,21 +216,22 @@ def validate_document(document_id):
     industry_issues = validate_industry_specific_rules(extracted_data, receipt_details)
     validation_issues.extend(industry_issues)
     
-    # Store validation issues in database
-    for issue in validation_issues:
-        insert_validation_issue(
-            document_id,
-            issue['issue_type'],
-            issue['severity'],
-            issue['description']
-        )
+    # 6. Duplicate detection
+    if duplicates is None:
+        duplicates = find_duplicates(document_id, extracted_data, minhash)
+    validation_issues.extend(duplicate_issues(*duplicates))
     
+    for issue in validation_issues:
+        issue['fingerprint'] = issue_fingerprint(issue['issue_type'], issue['rule'])
     return validation_issues
 
 def validate_mathematical_rules(extracted_data, receipt_items, receipt_details):
     """Validate mathematical relationships in the document"""
     issues = []
     
+    # Invoices have no receipt details row
+    receipt_details = receipt_details or {}
+    
     try:
         # Check if line items sum to subtotal
         if receipt_items and receipt_details:
@@ -74,6 +242,7 @@ def validate_mathematical_rules(extracted_data, receipt_items, receipt_details):
                 issues.append({
                     'issue_type': 'MATH_ERROR',
                     'severity': 'ERROR',
+                    'rule': 'line_items_subtotal',
                     'description': f'Line items sum (${calculated_subtotal:.2f}) does not match subtotal (${extracted_subtotal:.2f})'
                 })
         
@@ -92,6 +261,7 @@ def validate_mathematical_rules(extracted_data, receipt_items, receipt_details):
                 issues.append({
                     'issue_type': 'MATH_ERROR',
                     'severity': 'WARNING',
+                    'rule': 'tax_rate',
                     'description': f'Unusual tax rate: {tax_rate:.2%} (expected rates: {", ".join(f"{r:.0%}" for r in STANDARD_TAX_RATES)})'
                 })
             
@@ -100,6 +270,7 @@ def validate_mathematical_rules(extracted_data, receipt_items, receipt_details):
                 issues.append({
                     'issue_type': 'MATH_ERROR',
                     'severity': 'ERROR',
+                    'rule': 'total_subtotal_tax',
                     'description': f'Total (${total_amount:.2f}) does not match subtotal + tax (${calculated_total_with_tax:.2f})'
                 })
         
@@ -112,6 +283,7 @@ def validate_mathematical_rules(extracted_data, receipt_items, receipt_details):
                     issues.append({
                         'issue_type': 'MATH_ERROR',
                         'severity': 'WARNING',
+                        'rule': 'tip_percentage',
                         'description': f'Unusual tip percentage: {tip_percentage:.2%} (expected range: 10-25%)'
                     })
     
@@ -119,6 +291,7 @@ def validate_mathematical_rules(extracted_data, receipt_items, receipt_details):
         issues.append({
             'issue_type': 'MATH_ERROR',
             'severity': 'ERROR',
+            'rule': 'math_error',
             'description': f'Error in mathematical validation: {str(e)}'
         })
     
@@ -141,85 +314,61 @@ def validate_business_rules(extracted_data, receipt_details):
                 issues.append({
                     'issue_type': 'SUSPICIOUS_AMOUNT',
                     'severity': 'WARNING',
+                    'rule': 'high_amount',
                     'description': f'Unusually high amount: ${total_amount:.2f} (over $10,000)'
                 })
             elif total_amount < 1:
                 issues.append({
                     'issue_type': 'SUSPICIOUS_AMOUNT',
                     'severity': 'WARNING',
+                    'rule': 'low_amount',
                     'description': f'Unusually low amount: ${total_amount:.2f} (under $1.00)'
                 })
         
-        # Check for future dates
+        # Check for future dates (unparseable dates are a data quality issue, not a business rule issue)
         date_value = None
+        parsed_date = None
         if extracted_data.get('date'):
             date_value = extracted_data['date'].get('value')
+            parsed_date = field_date(extracted_data['date'])
         
-        if date_value:
-            try:
-                # Parse date (handle multiple formats)
-                parsed_date = None
-                for fmt in ['%m/%d/%Y', '%d/%m/%Y', '%Y-%m-%d', '%m-%d-%Y', '%d-%m-%Y']:
+        if parsed_date and parsed_date > datetime.now().date():
+            issues.append({
+                'issue_type': 'SUSPICIOUS_AMOUNT',
+                'severity': 'ERROR',
+                'rule': 'future_date',
+                'description': f'Future date detected: {date_value} (today is {datetime.now().date()})'
+            })
+        
+        # Check for weekend business hours (for receipts)
+        if receipt_details and receipt_details.get('transaction_time'):
+            time_value = receipt_details.get('transaction_time')
+            
+            # Check if it's a weekend
+            if parsed_date and parsed_date.weekday() >= 5:  # 5 = Saturday, 6 = Sunday
+                # Parse time (handle multiple formats)
+                parsed_time = None
+                for fmt in ['%H:%M', '%I:%M %p', '%H:%M:%S']:
                     try:
-                        parsed_date = datetime.strptime(date_value, fmt)
+                        parsed_time = datetime.strptime(time_value, fmt).time()
                         break
                     except ValueError:
                         continue
                 
-                if parsed_date and parsed_date.date() > datetime.now().date():
+                # Check if time is outside typical business hours (e.g., before 9am or after 9pm)
+                if parsed_time and (parsed_time.hour < 9 or parsed_time.hour >= 21):
                     issues.append({
                         'issue_type': 'SUSPICIOUS_AMOUNT',
-                        'severity': 'ERROR',
-                        'description': f'Future date detected: {date_value} (today is {datetime.now().date()})'
+                        'severity': 'INFO',
+                        'rule': 'weekend_hours',
+                        'description': f'Weekend transaction outside typical business hours: {time_value} on {date_value}'
                     })
-            except ValueError:
-                # If we can't parse the date, that's a data quality issue, not a business rule issue
-                pass
-        
-        # Check for weekend business hours (for receipts)
-        if receipt_details and receipt_details.get('transaction_time'):
-            time_value = receipt_details.get('transaction_time')
-            date_value = None
-            if extracted_data.get('date'):
-                date_value = extracted_data['date'].get('value')
-            
-            # Check if we have both date and time
-            if date_value and time_value:
-                try:
-                    # Parse date
-                    parsed_date = None
-                    for fmt in ['%m/%d/%Y', '%d/%m/%Y', '%Y-%m-%d', '%m-%d-%Y', '%d-%m-%Y']:
-                        try:
-                            parsed_date = datetime.strptime(date_value, fmt)
-                            break
-                        except ValueError:
-                            continue
-                    
-                    # Check if it's a weekend
-                    if parsed_date and parsed_date.weekday() >= 5:  # 5 = Saturday, 6 = Sunday
-                        # Parse time (handle multiple formats)
-                        parsed_time = None
-                        for fmt in ['%H:%M', '%I:%M %p', '%H:%M:%S']:
-                            try:
-                                parsed_time = datetime.strptime(time_value, fmt).time()
-                                break
-                            except ValueError:
-                                continue
-                        
-                        # Check if time is outside typical business hours (e.g., before 9am or after 9pm)
-                        if parsed_time and (parsed_time.hour < 9 or parsed_time.hour >= 21):
-                            issues.append({
-                                'issue_type': 'SUSPICIOUS_AMOUNT',
-                                'severity': 'INFO',
-                                'description': f'Weekend transaction outside typical business hours: {time_value} on {date_value}'
-                            })
-                except ValueError:
-                    pass
     
     except (ValueError, TypeError) as e:
         issues.append({
             'issue_type': 'SUSPICIOUS_AMOUNT',
             'severity': 'INFO',
+            'rule': 'business_error',
             'description': f'Error in business rule validation: {str(e)}'
         })
     
@@ -243,6 +392,7 @@ def validate_data_quality(extracted_data):
         issues.append({
             'issue_type': 'MISSING_DATA',
             'severity': 'ERROR' if 'total' in missing_fields or 'date' in missing_fields else 'WARNING',
+            'rule': 'missing_fields',
             'description': f'Missing critical fields: {", ".join(missing_fields)}'
         })
     
@@ -257,6 +407,7 @@ def validate_data_quality(extracted_data):
         issues.append({
             'issue_type': 'LOW_CONFIDENCE',
             'severity': 'WARNING',
+            'rule': 'low_confidence',
             'description': f'Low confidence OCR extractions: {", ".join(low_confidence_fields)}'
         })
     
@@ -279,27 +430,18 @@ def validate_data_quality(extracted_data):
         issues.append({
             'issue_type': 'MISSING_DATA',
             'severity': 'ERROR',
+            'rule': 'negative_amounts',
             'description': f'Negative amounts detected in fields: {", ".join(negative_amounts)}'
         })
     
     # Check for invalid date formats
     if 'date' in extracted_data and extracted_data['date'].get('value'):
         date_value = extracted_data['date']['value']
-        valid_formats = ['%m/%d/%Y', '%d/%m/%Y', '%Y-%m-%d', '%m-%d-%Y', '%d-%m-%Y']
-        is_valid = False
-        
-        for fmt in valid_formats:
-            try:
-                datetime.strptime(date_value, fmt)
-                is_valid = True
-                break
-            except ValueError:
-                continue
-        
-        if not is_valid:
+        if field_date(extracted_data['date']) is None:
             issues.append({
                 'issue_type': 'MISSING_DATA',
                 'severity': 'WARNING',
+                'rule': 'date_format',
                 'description': f'Invalid date format: {date_value}'
             })
     
@@ -319,11 +461,10 @@ def validate_vendor_specific_rules(extracted_data, receipt_details):
         if not merchant_name:
             return issues
         
-        merchant_lower = merchant_name.lower()
+        vendor_types = get_keyword_index().scan(merchant_name.lower())['vendor_types']
         
         # Restaurant-specific validation
-        restaurant_keywords = ['restaurant', 'cafe', 'coffee', 'diner', 'bar', 'grill']
-        if any(keyword in merchant_lower for keyword in restaurant_keywords):
+        if 'restaurant' in vendor_types:
             # Check tip percentage for restaurants (10-25% range)
             total_amount = None
             if receipt_details and receipt_details.get('total_amount'):
@@ -341,12 +482,12 @@ def validate_vendor_specific_rules(extracted_data, receipt_details):
                     issues.append({
                         'issue_type': 'SUSPICIOUS_AMOUNT',
                         'severity': 'INFO',
+                        'rule': 'vendor_restaurant_tip',
                         'description': f'Unusual tip percentage for restaurant: {tip_percentage:.2%} (expected range: 10-25%)'
                     })
         
         # Gas station validation
-        gas_keywords = ['gas', 'fuel', 'shell', 'bp', 'exxon', 'chevron']
-        if any(keyword in merchant_lower for keyword in gas_keywords):
+        if 'gas' in vendor_types:
             # Check for reasonable gas amounts (typically $10-$200)
             total_amount = None
             if receipt_details and receipt_details.get('total_amount'):
@@ -358,12 +499,12 @@ def validate_vendor_specific_rules(extracted_data, receipt_details):
                 issues.append({
                     'issue_type': 'SUSPICIOUS_AMOUNT',
                     'severity': 'INFO',
+                    'rule': 'gas_amount',
                     'description': f'Unusual gas purchase amount: ${total_amount:.2f} (typical range: $10-$200)'
                 })
         
         # Grocery store validation
-        grocery_keywords = ['grocery', 'market', 'supermarket', 'walmart', 'costco', 'aldi', 'kroger']
-        if any(keyword in merchant_lower for keyword in grocery_keywords):
+        if 'grocery' in vendor_types:
             # Check for reasonable grocery amounts (typically $20-$500)
             total_amount = None
             if receipt_details and receipt_details.get('total_amount'):
@@ -375,6 +516,7 @@ def validate_vendor_specific_rules(extracted_data, receipt_details):
                 issues.append({
                     'issue_type': 'SUSPICIOUS_AMOUNT',
                     'severity': 'INFO',
+                    'rule': 'grocery_amount',
                     'description': f'Unusual grocery purchase amount: ${total_amount:.2f} (typical range: $20-$500)'
                 })
     
@@ -382,6 +524,7 @@ def validate_vendor_specific_rules(extracted_data, receipt_details):
         issues.append({
             'issue_type': 'MISSING_DATA',
             'severity': 'INFO',
+            'rule': 'vendor_error',
             'description': f'Error in vendor-specific validation: {str(e)}'
         })
     
@@ -421,7 +564,8 @@ def validate_industry_specific_rules(extracted_data, receipt_details):
                     issues.append({
                         'issue_type': 'SUSPICIOUS_AMOUNT',
                         'severity': 'INFO',
-                        'description': f'Unusual tip percentage for restaurant: {tip_percentage:.2%} (expected range: 10-25%)'
+                        'rule': 'industry_restaurant_tip',
+                        'description': f'Unusual tip percentage for Food & Dining: {tip_percentage:.2%} (expected range: 10-25%)'
                     })
         
         # Transportation industry validation
@@ -437,6 +581,7 @@ def validate_industry_specific_rules(extracted_data, receipt_details):
                 issues.append({
                     'issue_type': 'SUSPICIOUS_AMOUNT',
                     'severity': 'INFO',
+                    'rule': 'transportation_amount',
                     'description': f'Unusual transportation amount: ${total_amount:.2f} (typical range: $10-$200)'
                 })
         
@@ -453,6 +598,7 @@ def validate_industry_specific_rules(extracted_data, receipt_details):
                 issues.append({
                     'issue_type': 'SUSPICIOUS_AMOUNT',
                     'severity': 'INFO',
+                    'rule': 'office_supplies_amount',
                     'description': f'Unusual office supplies amount: ${total_amount:.2f} (typical range: $5-$500)'
                 })
     
@@ -460,6 +606,7 @@ def validate_industry_specific_rules(extracted_data, receipt_details):
         issues.append({
             'issue_type': 'MISSING_DATA',
             'severity': 'INFO',
+            'rule': 'industry_error',
             'description': f'Error in industry-specific validation: {str(e)}'
         })
     